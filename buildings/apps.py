@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class BuildingsConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "buildings"
+
+    def ready(self):
+        # Connect the signal handlers
+        from . import signals  # noqa: F401
@@ -12,7 +12,8 @@ from datetime import datetime
 from collections import Counter
 from multiprocessing import Pool
 from django.db import connection
-from psycopg2.extras import execute_values
+from buildings.utils.bulk_load import copy_records
+from buildings.utils.roll_schema import UNIT_COLUMN_NAMES, unit_table_ddl
 from buildings.utils.utility import split_list_in_n, get_DB_conn
 
 from config.settings import BASE_DIR
@@ -33,39 +34,21 @@ EVALUNIT_TABLE = EvalUnit.objects.model._meta.db_table
 MURB_DISAG_TABLE = 'murb_disag'
 
 
-SQL_COPY_TEMPLATE = """(%(id)s, %(agg_id)s, %(lat)s, %(lng)s, %(point)s, %(lot_id)s, %(lot_geom)s, 
-    %(year)s, %(muni)s, %(muni_code)s, %(arrond)s, %(address)s, %(num_adr_inf)s, %(num_adr_inf_2)s, 
-    %(num_adr_sup)s, %(num_adr_sup_2)s, %(street_name)s, %(apt_num)s, %(apt_num_1)s, %(apt_num_2)s, 
-    %(mat18)s, %(cubf)s, %(file_num)s, %(nghbr_unit)s, %(owner_date)s, %(owner_type)s, %(owner_status)s, 
-    %(lot_lin_dim)s, %(lot_area)s, %(max_floors)s, %(const_yr)s, %(const_yr_real)s, %(floor_area)s, 
-    %(phys_link)s, %(const_type)s, %(num_dwelling)s, %(num_rental)s, %(num_non_res)s, %(apprais_date)s, 
-    %(lot_value)s, %(building_value)s, %(value)s, %(prev_value)s, %(date_added)s)"""
-
-SQL_COPY_DUPLICATES_TO_OTHER_TABLE = f"""INSERT INTO {MURB_DISAG_TABLE}
-    (id, agg_id, lat, lng, point, lot_id, lot_geom, year, muni, muni_code, arrond, address, num_adr_inf, 
-    num_adr_inf_2, num_adr_sup, num_adr_sup_2, street_name, apt_num, apt_num_1, apt_num_2, mat18, cubf, 
-    file_num, nghbr_unit, owner_date, owner_type, owner_status, lot_lin_dim, lot_area, max_floors, const_yr, 
-    const_yr_real, floor_area, phys_link, const_type, num_dwelling, num_rental, num_non_res, apprais_date, 
-    lot_value, building_value, value, prev_value, date_added) VALUES %s ON CONFLICT DO NOTHING"""
-
-SQL_INSERT_AGGREGATED_MURB = f"""INSERT INTO {EVALUNIT_TABLE}
-        (id, lat, lng, point, lot_id, lot_geom, year, muni, muni_code, arrond, address, street_name, 
-        mat18, cubf, nghbr_unit, owner_date, owner_type, owner_status, lot_lin_dim, lot_area, max_floors, 
-        const_yr, const_yr_real, floor_area, phys_link, const_type, num_dwelling, num_rental, num_non_res, 
-        apprais_date, lot_value, building_value, value, prev_value, date_added) 
-    VALUES
-        (%(id)s, %(lat)s, %(lng)s, %(point)s, %(lot_id)s, %(lot_geom)s, %(year)s, %(muni)s, %(muni_code)s, 
-        %(arrond)s, %(address)s, %(street_name)s, %(mat18)s, %(cubf)s, %(nghbr_unit)s, %(owner_date)s, 
-        %(owner_type)s, %(owner_status)s, %(lot_lin_dim)s, %(lot_area)s, %(max_floors)s, %(const_yr)s, 
-        %(const_yr_real)s, %(floor_area)s, %(phys_link)s, %(const_type)s, %(num_dwelling)s, %(num_rental)s, 
-        %(num_non_res)s, %(apprais_date)s, %(lot_value)s, %(building_value)s, %(value)s, 
-        %(prev_value)s, %(date_added)s) ON CONFLICT DO NOTHING"""
+# Columns of the disaggregated MURBs, i.e. their evaluation unit with the ID of their aggregated MURB
+MURB_DISAG_COLUMNS = ['id', 'agg_id', *UNIT_COLUMN_NAMES[1:]]
+
+# Columns of the individual units of a MURB, not written to their aggregated MURB
+MURB_UNIT_COLUMNS = ['num_adr_inf', 'num_adr_inf_2', 'num_adr_sup', 'num_adr_sup_2', 'apt_num', 'apt_num_1', 
+    'apt_num_2', 'file_num']
+AGGREGATED_MURB_COLUMNS = [column for column in UNIT_COLUMN_NAMES if column not in MURB_UNIT_COLUMNS] + ['num_votes']
+
+# Number of duplicated MURBs aggregated before writing them out together
+MURB_BATCH_SIZE = 500
 
 SQL_GET_DUPLICATES = f"""select * from {EVALUNIT_TABLE} 
     WHERE lat = %s and lng = %s and address = %s and muni = %s;"""
 
-# The parentheses around %s are important here
-SQL_DELETE_DUPLICATES = f"""DELETE FROM {EVALUNIT_TABLE} WHERE id in (%s)"""
+SQL_DELETE_DUPLICATES = f"""DELETE FROM {EVALUNIT_TABLE} WHERE id = ANY(%s)"""
 
 
 class Command(BaseCommand):
@@ -152,6 +135,11 @@ def aggregate_murbs(data):
     worker_id = data['id']
     duplicated_murbs = data['data']
 
+    # The current batch, written out every MURB_BATCH_SIZE MURBs
+    aggregated = []
+    disaggregated = []
+    all_dupe_ids = []
+
     for i, murb in tqdm(enumerate(duplicated_murbs), desc=f"Worker {worker_id}", 
                        total=len(duplicated_murbs), position=worker_id, leave=False
     ):
@@ -196,7 +184,7 @@ def aggregate_murbs(data):
             for dupe in duplicates:
 
                 # Gather all IDs to delete them after
-                dupe_ids.append((dupe['id'],))
+                dupe_ids.append(dupe['id'])
 
                 # Gather most frequent nghbr_unit, owner_type, status, const_yr, yr_real_est, phys_link
                 years.append(dupe['year'])
@@ -250,7 +238,6 @@ def aggregate_murbs(data):
                 # All dulicates should have the same point, lot id and geometry
                 'point': dupe['point'],
                 'lot_id': dupe['lot_id'],
-                'lot_geom': dupe['lot_geom'],
                 # All of these address fields should be the same for all duplicates, since they
                 # were concatenated to form the 'address' field, which is the same for all
                 'num_adr_inf': dupe['num_adr_inf'],
@@ -295,27 +282,39 @@ def aggregate_murbs(data):
                 'max_floors': infer_number_of_floors(max_apt_num, lat, lng),
                 'num_dwelling': murb['sum_dwellings'],
                 'date_added': datetime.now(),
+                'num_votes': 0,
             }
 
-            # Write out the new aggregated MURB
-            cursor.execute(SQL_INSERT_AGGREGATED_MURB, agg_data)
-            conn.commit()
+            aggregated.append(agg_data)
 
             # Set the foreign key of each duplicate to their aggregated version
             for dup in duplicates:
                 dup['agg_id'] = agg_id
-            
-            # Copy the duplicates to another table
-            execute_values(cursor, SQL_COPY_DUPLICATES_TO_OTHER_TABLE, duplicates, template=SQL_COPY_TEMPLATE)
-            conn.commit()
+            disaggregated.extend(duplicates)
+            all_dupe_ids.extend(dupe_ids)
 
-            # delete all the duplicates by ID
-            execute_values(cursor, SQL_DELETE_DUPLICATES, dupe_ids)
-            conn.commit()
+            if len(aggregated) >= MURB_BATCH_SIZE:
+                write_murbs(conn, cursor, aggregated, disaggregated, all_dupe_ids)
+                aggregated, disaggregated, all_dupe_ids = [], [], []
 
         except KeyboardInterrupt:
+            # The current batch is not written, its MURBs are still duplicated and get picked up by the next run
             return
-            
+
+    write_murbs(conn, cursor, aggregated, disaggregated, all_dupe_ids)
+    conn.close()
+
+
+def write_murbs(conn, cursor, aggregated, disaggregated, dupe_ids):
+    """
+    Write out the aggregated MURBs, copy their duplicates to the disaggregated table
+    and delete them from the evaluation units, all in the same transaction.
+    """
+    copy_records(cursor, EVALUNIT_TABLE, AGGREGATED_MURB_COLUMNS, aggregated)
+    copy_records(cursor, MURB_DISAG_TABLE, MURB_DISAG_COLUMNS, disaggregated)
+    cursor.execute(SQL_DELETE_DUPLICATES, (dupe_ids,))
+    conn.commit()
+
 
 
 def _sum_or_none(arr):
@@ -355,53 +354,7 @@ def create_disaggregated_MURBs_table_if_not_exists():
     They will then be deleted from the main table, and replaced by their aggregated entries.
     """
     conn, cursor = get_DB_conn(DB_CONN_STR)
-    cursor.execute(f"""
-        CREATE TABLE IF NOT EXISTS {MURB_DISAG_TABLE} (
-            id TEXT PRIMARY KEY CHECK(length(id)=23),
-            agg_id TEXT NOT NULL,
-            lat NUMERIC(20, 10) NOT NULL,
-            lng NUMERIC(20, 10) NOT NULL,
-            point GEOMETRY(POINT, 4326),
-            lot_id TEXT,
-            lot_geom GEOMETRY(MULTIPOLYGON, 4326),
-            year SMALLINT NOT NULL,
-            muni TEXT NOT NULL,
-            muni_code TEXT NOT NULL,
-            arrond TEXT,
-            address TEXT NOT NULL,
-            num_adr_inf TEXT,
-            num_adr_inf_2 TEXT,
-            num_adr_sup TEXT,
-            num_adr_sup_2 TEXT,
-            street_name TEXT,
-            apt_num TEXT,
-            apt_num_1 TEXT,
-            apt_num_2 TEXT,
-            mat18 TEXT NOT NULL CHECK(length(mat18)=18),
-            cubf SMALLINT NOT NULL,
-            file_num TEXT,
-            nghbr_unit TEXT,
-            owner_date DATE,
-            owner_type TEXT,
-            owner_status TEXT,
-            lot_lin_dim NUMERIC(8, 2),
-            lot_area NUMERIC(15, 2),
-            max_floors SMALLINT,
-            const_yr SMALLINT,
-            const_yr_real TEXT,
-            floor_area NUMERIC(8, 1),
-            phys_link TEXT,
-            const_type TEXT,
-            num_dwelling SMALLINT,
-            num_rental SMALLINT,
-            num_non_res SMALLINT,
-            apprais_date DATE,
-            lot_value INTEGER,
-            building_value INTEGER,
-            value INTEGER,
-            prev_value INTEGER,
-            date_added DATE
-        );""")
+    cursor.execute(unit_table_ddl(MURB_DISAG_TABLE, {'agg_id': 'TEXT NOT NULL'}))
     conn.commit()
     conn.close()
     
@@ -0,0 +1,202 @@
+import json
+import time
+import tempfile
+import resource
+from pathlib import Path
+from multiprocessing import get_context
+
+from bs4 import BeautifulSoup
+from django.db import connections, transaction
+from django.core.management.base import BaseCommand, CommandError
+
+from buildings.models import EvalUnit
+from buildings.utils.bulk_load import copy_objects
+from buildings.utils.columnar import import_pyarrow, write_parquet
+from buildings.utils.synthetic_roll import generate_roll
+from buildings.management.commands.process_roll_xml import (
+    iter_units_lxml, iter_units_pulldom, flatten_unit, flatten_soup, generate_mat18_from_fields, parse_unit_fields,
+    new_unit_data,
+)
+
+PARSERS = ['lxml', 'pulldom']
+LOADERS = ['copy', 'bulk_create', 'parquet']
+
+
+def parse_lxml(xml_files):
+    """Units of the XMLs, parsed like process_roll_xml's lxml parser"""
+    for xml_file in xml_files:
+        for muni_code, year_entered, elem in iter_units_lxml(xml_file):
+            fields, owners = flatten_unit(elem)
+            mat18 = generate_mat18_from_fields(fields)
+            yield parse_unit_fields(fields, owners, new_unit_data(muni_code, year_entered, mat18))
+
+
+def parse_pulldom(xml_files):
+    """Units of the XMLs, parsed like process_roll_xml's pulldom parser"""
+    for xml_file in xml_files:
+        for muni_code, year_entered, node in iter_units_pulldom(xml_file):
+            fields, owners = flatten_soup(BeautifulSoup(node.toxml(), 'lxml'))
+            mat18 = generate_mat18_from_fields(fields)
+            yield parse_unit_fields(fields, owners, new_unit_data(muni_code, year_entered, mat18))
+
+
+def run_parser(parser, xml_files):
+    """Returns the number of units parsed and the seconds it took"""
+    parse = parse_lxml if parser == 'lxml' else parse_pulldom
+    t0 = time.perf_counter()
+    num_units = sum(1 for _ in parse(xml_files))
+    return num_units, time.perf_counter() - t0
+
+
+def run_loader(loader, xml_files):
+    """
+    Returns the number of units loaded and the seconds it took, not counting their parsing.
+    The database loads are rolled back.
+    """
+    units = list(parse_lxml(xml_files))
+    t0 = time.perf_counter()
+
+    if loader == 'parquet':
+        with tempfile.TemporaryDirectory() as folder:
+            write_parquet(EvalUnit, units, Path(folder) / 'units.parquet')
+        return len(units), time.perf_counter() - t0
+
+    with transaction.atomic():
+        if loader == 'copy':
+            copy_objects(EvalUnit, units)
+        else:
+            EvalUnit.objects.bulk_create(units, batch_size=1000, ignore_conflicts=True)
+        seconds = time.perf_counter() - t0
+        transaction.set_rollback(True)
+    return len(units), seconds
+
+
+def measure(function, *args):
+    """Runs the function, returning its results with the peak RSS of the process and its growth while running"""
+    # On Linux, ru_maxrss is in KiB and starts at the RSS of the process when it was forked
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    results = function(*args)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return (*results, peak_rss, peak_rss - rss_before)
+
+
+def run_measured(function, *args):
+    """Runs measure in a new process, so the peak RSS of a backend isn't the one of another"""
+    with get_context('fork').Pool(processes=1) as pool:
+        return pool.apply(measure, (function, *args))
+
+
+class Command(BaseCommand):
+    help = ("Measure the throughput and memory of the roll XML parsers and unit loaders on synthetic roll XMLs, "
+            "without the real roll. The parsers don't need a database, the copy and bulk_create loaders do.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('-u', '--num-units',
+                            type=int,
+                            default=100_000,
+                            help="Number of synthetic units")
+
+        parser.add_argument('-f', '--num-files',
+                            type=int,
+                            default=8,
+                            help="Number of synthetic XMLs, i.e. municipalities")
+
+        parser.add_argument('-s', '--skew',
+                            type=float,
+                            default=1.0,
+                            help="Skew of the municipality sizes, 0 for XMLs of the same size")
+
+        parser.add_argument('--seed',
+                            type=int,
+                            default=0,
+                            help="Seed of the synthetic XMLs, the same seed gives the same XMLs")
+
+        parser.add_argument('-d', '--data-folder',
+                            type=Path,
+                            default=None,
+                            help="Folder to write the synthetic XMLs to and keep them in, a temporary folder by default")
+
+        parser.add_argument('-p', '--parsers',
+                            nargs='*',
+                            choices=PARSERS,
+                            default=PARSERS,
+                            help="Parsers to measure")
+
+        parser.add_argument('-l', '--loaders',
+                            nargs='*',
+                            choices=LOADERS,
+                            default=[],
+                            help="Loaders to measure, the copy and bulk_create loads into the database are rolled back")
+
+        parser.add_argument('--output',
+                            type=Path,
+                            default=None,
+                            help="Write the results to this JSON file, e.g. to use as a baseline")
+
+        parser.add_argument('--baseline',
+                            type=Path,
+                            default=None,
+                            help="Results of a previous run (see --output), fail if a backend got slower than it")
+
+        parser.add_argument('--tolerance',
+                            type=float,
+                            default=0.2,
+                            help="Fraction of the baseline throughput a backend can lose before failing")
+
+    def handle(self, *args, **options):
+        loaders = options['loaders']
+        if 'parquet' in loaders:
+            try:
+                import_pyarrow()
+            except ImportError as e:
+                raise CommandError(str(e))
+
+        with tempfile.TemporaryDirectory() as tmp_folder:
+            data_folder = options['data_folder'] or Path(tmp_folder)
+            xml_files = generate_roll(data_folder, options['num_units'], num_files=options['num_files'],
+                                      skew=options['skew'], seed=options['seed'])
+            num_bytes = sum(xml_file.stat().st_size for xml_file in xml_files)
+            self.stdout.write(f"Generated {len(xml_files)} XMLs with {options['num_units']} units, "
+                              f"{num_bytes / 1024 ** 2:.1f} MB in {data_folder}\n")
+
+            # The forked processes must not share the database connection
+            connections.close_all()
+
+            results = {}
+            benchmarks = [(f'parser:{parser}', run_parser, parser) for parser in options['parsers']]
+            benchmarks += [(f'loader:{loader}', run_loader, loader) for loader in loaders]
+
+            self.stdout.write(f"{'backend':<20} {'units':>10} {'seconds':>8} {'units/s':>10} {'MB/s':>8} "
+                              f"{'peak RSS MB':>12} {'+RSS MB':>8}")
+            for name, function, backend in benchmarks:
+                num_units, seconds, peak_rss, rss_growth = run_measured(function, backend, xml_files)
+                results[name] = {
+                    'units': num_units,
+                    'seconds': seconds,
+                    'units_per_sec': num_units / seconds,
+                    # For the loaders, the size of the XMLs the units were read from
+                    'bytes_per_sec': num_bytes / seconds,
+                    'peak_rss': peak_rss,
+                    'rss_growth': rss_growth,
+                }
+                self.stdout.write(
+                    f"{name:<20} {num_units:>10} {seconds:>8.2f} {num_units / seconds:>10.0f} "
+                    f"{num_bytes / seconds / 1024 ** 2:>8.2f} {peak_rss / 1024 ** 2:>12.1f} {rss_growth / 1024 ** 2:>8.1f}"
+                )
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=4)
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+
+            regressions = [
+                f"{name}: {result['units_per_sec']:.0f} units/s, {baseline[name]['units_per_sec']:.0f} in the baseline"
+                for name, result in results.items()
+                if name in baseline and result['units_per_sec'] < baseline[name]['units_per_sec'] * (1 - options['tolerance'])
+            ]
+            if regressions:
+                raise CommandError("Slower than the baseline:\n" + "\n".join(regressions))
+            self.stdout.write(self.style.SUCCESS("No regression from the baseline"))
@@ -0,0 +1,19 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+
+from buildings.models import SurveyQueueEntry
+
+
+class Command(BaseCommand):
+    help = """Rebuild the survey work queue from the HLM-linked evaluation units and their votes.
+        This needs to be run after the HLMs have been cross-referenced."""
+
+    def handle(self, *args, **options):
+        t0 = datetime.now()
+
+        num_queued = SurveyQueueEntry.objects.rebuild()
+
+        self.stdout.write(
+            self.style.SUCCESS(f'Queued {num_queued} units to survey in {datetime.now() - t0} s')
+        )
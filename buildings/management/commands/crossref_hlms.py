@@ -37,6 +37,7 @@ from config.settings import BASE_DIR, GOOGLE_MAPS_API_KEY, GOOGLE_SIGNING_SECRET
 
 from buildings.utils.constants import * 
 from buildings.models import HLMBuilding, EvalUnit
+from buildings.utils.bulk_load import copy_records
 from buildings.utils.utility import sign_url, download_file
 
 DEFAULT_OUT = BASE_DIR / 'data' 
@@ -59,24 +60,13 @@ URL_MAPBOX_V6 = f"https://api.mapbox.com/search/geocode/v6/forward"
 URL_STREETVIEW_METADATA = f"https://maps.googleapis.com/maps/api/streetview/metadata?key={GOOGLE_MAPS_API_KEY}"
 
 
-SQL_UPSERT_HLM = f"""INSERT INTO {HLM_TABLE}
-        (id, lat, lng, point, eval_unit_id, streetview_available, project_id, organism, service_center, address, 
-        street_num, street_name, muni, postal_code, num_dwellings, num_floors, area_footprint, area_total, ivp, 
-        disrepair_state, interest_adjust_date, contract_end_date, category, building_id) 
-    VALUES
-        (%(id)s, %(lat)s, %(lng)s, ST_SetSRID(ST_MakePoint(%(lng)s, %(lat)s), 4326), %(eval_unit_id)s, %(streetview_available)s, 
-        %(project_id)s, %(organism)s, %(service_center)s, %(address)s, %(street_num)s, %(street_name)s, %(muni)s, %(postal_code)s, 
-        %(num_dwellings)s, %(num_floors)s, %(area_footprint)s, %(area_total)s, %(ivp)s, %(disrepair_state)s, %(interest_adjust_date)s, 
-        %(contract_end_date)s, %(category)s, %(building_id)s) 
-    ON CONFLICT (id) DO UPDATE SET
-        id = EXCLUDED.id, lat = EXCLUDED.lat, lng = EXCLUDED.lng, point = EXCLUDED.point, eval_unit_id = EXCLUDED.eval_unit_id, 
-        streetview_available = EXCLUDED.streetview_available, project_id = EXCLUDED.project_id, organism = EXCLUDED.organism, 
-        service_center = EXCLUDED.service_center, address = EXCLUDED.address, street_num = EXCLUDED.street_num, 
-        street_name = EXCLUDED.street_name, muni = EXCLUDED.muni, postal_code = EXCLUDED.postal_code, 
-        num_dwellings = EXCLUDED.num_dwellings, num_floors = EXCLUDED.num_floors, area_footprint = EXCLUDED.area_footprint, 
-        area_total = EXCLUDED.area_total, ivp = EXCLUDED.ivp, disrepair_state = EXCLUDED.disrepair_state, 
-        interest_adjust_date = EXCLUDED.interest_adjust_date, contract_end_date = EXCLUDED.contract_end_date, 
-        category = EXCLUDED.category, building_id = EXCLUDED.building_id;"""
+HLM_COLUMNS = ['id', 'lat', 'lng', 'point', 'eval_unit_id', 'streetview_available', 'project_id', 'organism', 
+    'service_center', 'address', 'street_num', 'street_name', 'muni', 'postal_code', 'num_dwellings', 'num_floors', 
+    'area_footprint', 'area_total', 'ivp', 'disrepair_state', 'interest_adjust_date', 'contract_end_date', 
+    'category', 'building_id']
+
+# Number of cross-referenced HLMs upserted together
+HLM_BATCH_SIZE = 100
 
 
 class Command(BaseCommand):
@@ -210,7 +200,14 @@ def geocode_and_crossref_HLMs(work_split):
     mapbox_api_calls = 0
     google_api_calls = 0
 
+    # Cross-referenced HLMs waiting to be written out
+    found_hlms = []
+
     for i, row in tqdm(enumerate(data), desc=f"Worker {worker_id}", total=num_hlms, position=worker_id, leave=False):
+        if len(found_hlms) >= HLM_BATCH_SIZE:
+            write_hlms(conn, cursor, found_hlms)
+            found_hlms = []
+
         try:
             hlm = parse_HLM_csv_row(row)
 
@@ -333,8 +330,7 @@ def geocode_and_crossref_HLMs(work_split):
 
                 if res := cursor.fetchone():
                     hlm['eval_unit_id'] = res['id']
-                    cursor.execute(SQL_UPSERT_HLM, hlm)
-                    conn.commit()
+                    found_hlms.append(hlm_to_record(hlm))
                     num_found += 1
                     continue
 
@@ -351,8 +347,7 @@ def geocode_and_crossref_HLMs(work_split):
                 
                 if res := cursor.fetchone():
                     hlm['eval_unit_id'] = res['id']
-                    cursor.execute(SQL_UPSERT_HLM, hlm)
-                    conn.commit()
+                    found_hlms.append(hlm_to_record(hlm))
                     num_found += 1
                     continue
 
@@ -363,8 +358,7 @@ def geocode_and_crossref_HLMs(work_split):
                                WHERE h.eval_unit_id is null;""", (hlm['address'],))
                 if res := cursor.fetchone():
                     hlm['eval_unit_id'] = res['id']
-                    cursor.execute(SQL_UPSERT_HLM, hlm)
-                    conn.commit()
+                    found_hlms.append(hlm_to_record(hlm))
                     num_found += 1
                     continue
 
@@ -372,6 +366,7 @@ def geocode_and_crossref_HLMs(work_split):
                 # between inferior and superior street numbers
 
         except KeyboardInterrupt:
+            write_hlms(conn, cursor, found_hlms)
             return {
                 'num_found': num_found,
                 'unknown_muni': unknown_muni,
@@ -386,7 +381,7 @@ def geocode_and_crossref_HLMs(work_split):
             conn.reset()
             continue
 
-    conn.commit()
+    write_hlms(conn, cursor, found_hlms)
     return {
         'num_found': num_found,
         'unknown_muni': unknown_muni,
@@ -397,6 +392,37 @@ def geocode_and_crossref_HLMs(work_split):
 
 
 
+def hlm_to_record(hlm):
+    """Values of the HLM in the order of HLM_COLUMNS"""
+    hlm['point'] = f"SRID=4326;POINT({hlm['lng']} {hlm['lat']})"
+    return [hlm[column] for column in HLM_COLUMNS]
+
+
+def write_hlms(conn, cursor, hlms):
+    """
+    Upsert the HLMs, updating all the columns of those already in the table.
+    If the batch can't be written, the HLMs are written one at a time, so only the failing ones are lost.
+    """
+    # An upsert can't update the same row twice, an HLM listed more than once keeps its last record
+    hlms = list({hlm[0]: hlm for hlm in hlms}.values())
+    try:
+        copy_records(cursor, HLM_TABLE, HLM_COLUMNS, hlms, conflict_target='(id)', update_columns=HLM_COLUMNS[1:])
+        conn.commit()
+        return
+    except:
+        print(traceback.format_exc())
+        conn.rollback()
+
+    for hlm in hlms:
+        try:
+            copy_records(cursor, HLM_TABLE, HLM_COLUMNS, [hlm], conflict_target='(id)', update_columns=HLM_COLUMNS[1:])
+            conn.commit()
+        except:
+            print(traceback.format_exc())
+            print(hlm)
+            conn.rollback()
+
+
 def is_streetview_imagery_available(lat, lng, radius=100):
     """
     Query the Google Streetview Metadata API to 
@@ -1,16 +1,20 @@
 import os
-import math
-import subprocess
+import argparse
 import traceback
 
 from tqdm import tqdm
 from pathlib import Path
 from datetime import datetime
-from django.db import connection
+from multiprocessing import Pool
+from django.db import connection, connections
 from buildings.models import EvalUnit
-from django.core.management.base import BaseCommand
-from buildings.models.models import EvalUnitLot
+from django.core.management.base import BaseCommand, CommandError
+from buildings.models.models import EvalUnitLot, SQL_LOT_GEOJSON
 from buildings.utils.utility import download_file, get_DB_conn
+from buildings.utils.archives import find_files, open_shapefile, remove_file
+from buildings.utils.shapefile_polygons import shape_ewkb
+from buildings.utils.bulk_load import CopyStream, COPY_BUFFER_SIZE
+from buildings.utils.spatial_join import import_shapely, polygons_bounds, points_in_polygons
 
 from config.settings import BASE_DIR
 
@@ -18,7 +22,6 @@ DEFAULT_OUT = BASE_DIR / "data"
 
 EVALUNIT_TABLE = EvalUnit.objects.model._meta.db_table
 LOTS_TABLE = EvalUnitLot.objects.model._meta.db_table
-LOTS_TABLE_TMP = "lots_tmp"
 
 DB_NAME = connection.settings_dict["NAME"]
 DB_HOST = connection.settings_dict["HOST"]
@@ -27,6 +30,111 @@ DB_USER = connection.settings_dict["USER"]
 DB_PW = connection.settings_dict["PASSWORD"]
 DB_CONN_STR = f"postgresql://{DB_USER}:{DB_PW}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
+# Columns of the lots read from the shapefile's records, the gid is their position in the shapefiles
+# and the GeoJSON is computed from the simplified polygon
+LOT_FIELDS = [field for field in EvalUnitLot._meta.concrete_fields if field.column not in ("geom", "geojson")]
+LOT_COLUMNS = [field.column for field in LOT_FIELDS]
+LOT_CONVERTERS = {
+    field.column: {"BigIntegerField": int, "FloatField": float}.get(field.get_internal_type())
+    for field in LOT_FIELDS
+}
+
+# The records of a shapefile are copied to this table, then inserted in the lots with their polygon simplified
+LOTS_STAGING_TABLE = "lots_staging"
+SQL_CREATE_LOTS_STAGING = f"""
+    CREATE TEMP TABLE {LOTS_STAGING_TABLE} ON COMMIT DROP AS
+    SELECT {', '.join(LOT_COLUMNS)}, geom FROM {LOTS_TABLE} WITH NO DATA;
+"""
+SQL_COPY_LOTS_STAGING = f"COPY {LOTS_STAGING_TABLE} ({', '.join(LOT_COLUMNS)}, geom) FROM STDIN;"
+SQL_INSERT_LOTS = f"""
+    INSERT INTO {LOTS_TABLE} ({', '.join(LOT_COLUMNS)}, geom, geojson)
+    SELECT *,
+        --- Precompute the GeoJSON served to the survey page from the simplified polygon
+        {SQL_LOT_GEOJSON} AS geojson
+    FROM (
+        SELECT {', '.join(LOT_COLUMNS)},
+            --- Simplify the polygons to reduce their size
+            ST_Simplify(geom, 0.000005, true) AS geom
+        FROM {LOTS_STAGING_TABLE}
+    ) AS simplified
+    ON CONFLICT DO NOTHING;
+"""
+
+# Lots linked to their evaluation units at a time, in ranges of gids
+LINK_CHUNK_SIZE = 50_000
+
+# Joins the 'Multiple' lots to the units in the database, or in worker processes with shapely
+SPATIAL_ENGINES = ["postgis", "shapely"]
+# One CPU is left to the database, os.cpu_count() may not know the number of CPUs
+DEFAULT_NUM_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+
+# Bounds of the next chunk of lots, going down from the previous one (from the highest gid if None)
+SQL_NEXT_LOTS_CHUNK = f"""
+    SELECT min(gid), count(*) FROM (
+        SELECT gid FROM {LOTS_TABLE}
+        WHERE %(before)s IS NULL OR gid < %(before)s
+        ORDER BY gid DESC LIMIT %(limit)s
+    ) AS chunk;
+"""
+
+# (unit, lot) pairs of a chunk of lots, by provincial ID for the lots with a single one
+SQL_SINGLE_ID_LOTS_MATCHES = f"""
+            SELECT l.id_provinc AS id, l.gid
+            FROM {LOTS_TABLE} l
+            WHERE l.gid >= %(first)s AND (%(before)s IS NULL OR l.gid < %(before)s) AND l.id_provinc <> 'Multiple'"""
+# Lots without a single provincial ID (there are at least 30233) are linked
+# to the evaluation units whose point they contain
+SQL_MULTIPLE_ID_LOTS_MATCHES = f"""
+            SELECT e.id, l.gid
+            FROM {LOTS_TABLE} l
+            JOIN {EVALUNIT_TABLE} e ON ST_Intersects(l.geom, e.point)
+            WHERE l.gid >= %(first)s AND (%(before)s IS NULL OR l.gid < %(before)s) AND l.id_provinc = 'Multiple'"""
+
+# When several lots match a unit, the one with the smallest gid is kept whatever their kind, and
+# the chunks are linked from the highest gids down so the smallest gid overall is written last
+SQL_LINK_MATCHED_LOTS = f"""
+    UPDATE {EVALUNIT_TABLE} AS e
+    SET lot_id = m.gid
+    FROM (
+        SELECT DISTINCT ON (id) id, gid FROM ({{matches}}
+        ) AS matches
+        ORDER BY id, gid
+    ) AS m
+    WHERE e.id = m.id;
+"""
+SQL_LINK_LOTS = SQL_LINK_MATCHED_LOTS.format(
+    matches=SQL_SINGLE_ID_LOTS_MATCHES + "\n            UNION ALL" + SQL_MULTIPLE_ID_LOTS_MATCHES
+)
+# The shapely engine links the 'Multiple' lots afterwards
+SQL_LINK_SINGLE_ID_LOTS = SQL_LINK_MATCHED_LOTS.format(matches=SQL_SINGLE_ID_LOTS_MATCHES)
+
+# With the shapely engine, the 'Multiple' lots are joined to the units one municipality at a time
+SQL_MULTIPLE_ID_LOTS_MUNIS = f"SELECT DISTINCT code_mun FROM {LOTS_TABLE} WHERE id_provinc = 'Multiple';"
+SQL_MUNI_MULTIPLE_ID_LOTS = f"""
+    SELECT gid, ST_AsBinary(geom) FROM {LOTS_TABLE}
+    WHERE id_provinc = 'Multiple' AND code_mun IS NOT DISTINCT FROM %(code_mun)s AND geom IS NOT NULL;
+"""
+SQL_UNITS_IN_BOUNDS = f"""
+    SELECT id, ST_X(point), ST_Y(point) FROM {EVALUNIT_TABLE}
+    WHERE point && ST_MakeEnvelope(%(xmin)s, %(ymin)s, %(xmax)s, %(ymax)s, 4326);
+"""
+
+# The (unit, lot) pairs found by the workers are copied to this table, then written in a single UPDATE
+LOT_LINKS_TABLE = "lot_links_staging"
+LOT_LINKS_COLUMNS = ["id", "gid"]
+
+SQL_CREATE_LOT_LINKS = f"CREATE TEMP TABLE {LOT_LINKS_TABLE} (id TEXT, gid TEXT) ON COMMIT DROP;"
+SQL_COPY_LOT_LINKS = f"COPY {LOT_LINKS_TABLE} ({', '.join(LOT_LINKS_COLUMNS)}) FROM STDIN;"
+# The smallest gid wins, among the 'Multiple' lots and over the single-ID lot linked before
+SQL_UPDATE_FROM_LOT_LINKS = f"""
+    UPDATE {EVALUNIT_TABLE} AS e
+    SET lot_id = m.gid
+    FROM (
+        SELECT DISTINCT ON (id) id, gid FROM {LOT_LINKS_TABLE} ORDER BY id, gid
+    ) AS m
+    WHERE e.id = m.id AND (e.lot_id IS NULL OR m.gid < e.lot_id);
+"""
+
 
 class Command(BaseCommand):
     help = "Process the roll data and fill the database."
@@ -72,6 +180,22 @@ class Command(BaseCommand):
             help="Do not import the shapes (i.e. if they were already imported)",
         )
 
+        parser.add_argument(
+            "--spatial-engine",
+            choices=SPATIAL_ENGINES,
+            default="postgis",
+            help="Join the lots without a single provincial ID to the units in the database (postgis), "
+                 "or in parallel worker processes (shapely, needs shapely 2)",
+        )
+
+        parser.add_argument(
+            "-n",
+            "--num-workers",
+            type=positive_int,
+            default=DEFAULT_NUM_WORKERS,
+            help="Number of parallel workers of the shapely engine. Defaults to one less than the number of CPUs.",
+        )
+
     def handle(self, *args, **options):
 
         data_folder: Path = options["output_folder"]
@@ -83,24 +207,39 @@ class Command(BaseCommand):
         delete_data = options["delete_data"]
         skip_import = options["skip_import"]
         test = options["test"]
+        spatial_engine = options["spatial_engine"]
+
+        if spatial_engine == "shapely":
+            try:
+                import_shapely()
+            except ImportError as e:
+                raise CommandError(str(e))
 
         t0 = datetime.now()
         # Now process the lot polygons shapefile
         lots_shp_folder = data_folder / Path("lots_shp")
         lots_shp_folder.mkdir(exist_ok=True, parents=True)
 
+        # Archive contains 2 SHP files due to a max size limitation on shapefiles
+        # https://gis.stackexchange.com/questions/312739/why-are-shapefiles-limited-to-2gb-in-size
+        filenames = [
+            "usage_predominant_s_2022.shp",
+            "usage_predominant_s_2022_1.shp",
+        ]
+        if test:
+            filenames = [filenames[0]]
+
         try:
             if not skip_import:
 
-                # Search the data directory for the lots shapefile
+                # Search the data directory for the lots shapefile, extracted or in its archive
                 if (
-                    not list(lots_shp_folder.glob("**/usage_predominant_s_2022.shp"))
+                    not find_files(lots_shp_folder, "usage_predominant_s_2022.shp")
                     or download_data
                 ):
                     download_file(
                         "https://f005.backblazeb2.com/file/bit-data-public/quebec_lots_shapefiles.zip",
                         lots_shp_folder,
-                        unzip=True,
                     )
                     self.stdout.write(
                         self.style.SUCCESS(
@@ -113,49 +252,26 @@ class Command(BaseCommand):
                     )
                 )
 
-                # Archive contains 2 SHP files due to a max size limitation on shapefiles
-                # https://gis.stackexchange.com/questions/312739/why-are-shapefiles-limited-to-2gb-in-size
-                filenames = [
-                    "usage_predominant_s_2022.shp",
-                    "usage_predominant_s_2022_1.shp",
-                ]
-                if test:
-                    filenames = [filenames[0]]
-
-                # Creates a temporary table for the lots.
-                # PATH needs to contain the shp2pgsql program.
-                # Should be installed with PostGIS, but maybe not put on PATH.
-                # See https://postgis.net/docs/using_postgis_dbmanagement.html#shp2pgsql_usage
-                cmds = [
-                    f"shp2pgsql -D {'-a' if i > 0 else '-c'} -s 3857:4326 {lots_shp_folder}/{filename} {LOTS_TABLE_TMP} | psql -q {DB_CONN_STR}"
-                    for i, filename in enumerate(filenames)
-                ]
-                for cmd in cmds:
-                    subprocess.check_call(cmd, shell=True)
+                shp_files = {shp.name: shp for shp in find_files(lots_shp_folder, "*.shp")}
+                shp_files = [shp_files[filename] for filename in filenames]
 
+                # The shapefiles are read in parallel, numbering their records one after the other
+                count, num_without_cubf = import_lots(shp_files)
                 self.stdout.write(
                     self.style.SUCCESS(
-                        f"Finished importing lots to temporary table in {datetime.now() - t0}s"
+                        f"Imported {count} lots in {datetime.now() - t0}s, "
+                        f"skipped {num_without_cubf} lots that did not have a CUBF"
                     )
                 )
 
-                # Delete street lots
-                count = delete_lots_without_cubf()
-                self.stdout.write(
-                    self.style.SUCCESS(f"Deleted {count} lots that did not have a CUBF")
-                )
-
-                migrate_to_real_table()
-                self.stdout.write(
-                    self.style.SUCCESS(
-                        f"Finshed cleaning data and transfered to final lots table"
-                    )
-                )
+                # The polygons may have changed, don't serve the previously cached ones
+                EvalUnitLot.objects.invalidate_geojson_cache()
 
             # Now we will go through the lots and attempt to link each one to an evaluation unit
             # Here we can also simplify the polygons
             t0 = datetime.now()
-            link_lots_to_evalunits(self, delete_data=delete_data, test=test)
+            link_lots_to_evalunits(self, delete_data=delete_data, test=test, spatial_engine=spatial_engine,
+                                   num_workers=options["num_workers"])
             self.stdout.write(
                 self.style.SUCCESS(
                     f"Finished processing lots in {datetime.now() - t0}s"
@@ -163,9 +279,12 @@ class Command(BaseCommand):
             )
 
             if delete_data and not test:
+                # Looked up again, the import may have been skipped
+                shp_files = {shp.name: shp for shp in find_files(lots_shp_folder, "*.shp")}
                 for filename in filenames:
-                    os.remove(f"{lots_shp_folder}/{filename}")
-                    print(f"Deleted {lots_shp_folder}/{filename}")
+                    if filename in shp_files:
+                        remove_file(shp_files[filename])
+                        print(f"Deleted {shp_files[filename]}")
 
         except KeyboardInterrupt:
             self.stdout.write(self.style.ERROR("Interrupt received"))
@@ -176,108 +295,175 @@ class Command(BaseCommand):
             self.stdout.write(self.style.ERROR("Error running command"))
 
 
-def migrate_to_real_table():
-    conn, cursor = get_DB_conn(DB_CONN_STR, dict_cursor=False)
-    # Ignore the gid, we'll have our own autoincrement primary key in the lots table
-    # as we're going to duplicate some of these lots
-    cursor.execute(f"UPDATE {LOTS_TABLE_TMP} SET gid = objectid where gid is null;")
-    cursor.execute(
-        f"""
-                   INSERT INTO {LOTS_TABLE} SELECT 
-                    gid, objectid, co_mrc, code_mun, arrond, anrole, usag_predo, 
-                    no_lot, nb_poly_lo, utilisatio, id_provinc, sup_totale, descriptio, 
-                    nb_logemen, nb_locaux, shape_leng, shape_area, dat_acqui, dat_charg,
-                    --- Simplify the polygons to reduce their size
-                    st_simplify(geom, 0.000005, true) as geom
-                   FROM {LOTS_TABLE_TMP} ON CONFLICT DO NOTHING"""
-    )
-    cursor.execute(f"DROP TABLE {LOTS_TABLE_TMP}")
-    conn.commit()
+def positive_int(value):
+    """Argument type of the number of workers, a Pool needs at least one"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} isn't a positive number")
+    return number
 
 
-def delete_lots_without_cubf():
+def import_lots(shp_files):
     """
-    Delete lots without an 'utilisatio' (CUBF) field.
-    These seem to be associatd with streets, so we don't care about them.
-    This runs before we associate evalunits to lots, so it can speed up the matching.
+    Imports the lots of the shapefiles, one worker per shapefile. Their records are numbered
+    one after the other to get the gids, the first record of the first shapefile being 1.
+    Returns the number of lots imported and of lots skipped for not having a CUBF.
     """
-    conn, cursor = get_DB_conn(DB_CONN_STR, dict_cursor=False)
-    cursor.execute(f"SELECT count(*) FROM {LOTS_TABLE_TMP} WHERE utilisatio IS null")
-    count = cursor.fetchone()[0]
+    first_gids = []
+    num_records = 0
+    for shp_file in shp_files:
+        first_gids.append(num_records + 1)
+        with open_shapefile(shp_file) as reader:
+            num_records += len(reader)
 
-    cursor.execute(f"DELETE FROM {LOTS_TABLE_TMP} WHERE utilisatio IS null")
-    conn.commit()
+    # The forked workers must not share the database connection
+    connections.close_all()
+    with Pool(processes=len(shp_files)) as pool:
+        results = pool.starmap(import_lots_shapefile, zip(shp_files, first_gids, range(len(shp_files))))
 
-    cursor.execute(f"SELECT count(*) FROM {LOTS_TABLE_TMP} WHERE utilisatio IS null")
-    assert cursor.fetchone()[0] == 0
+    return tuple(sum(counts) for counts in zip(*results))
 
-    return count
+
+def import_lots_shapefile(shp_file, first_gid, position=0):
+    """
+    Streams the lots of the shapefile to the lots table with a COPY, reprojected to EPSG:4326.
+    Lots without an 'utilisatio' (CUBF) field are skipped: these seem to be associated with streets,
+    so we don't care about them, and skipping them speeds up the matching to the evaluation units.
+    """
+    conn, cursor = get_DB_conn(DB_CONN_STR, dict_cursor=False)
+    num_without_cubf = 0
+
+    with open_shapefile(shp_file) as reader:
+        fields = [field[0].lower() for field in reader.fields[1:]]
+        progress_bar = tqdm(total=len(reader), desc=f"Importing {shp_file.name}", position=position)
+
+        def lot_records():
+            nonlocal num_without_cubf
+            for gid, shape_record in enumerate(reader.iterShapeRecords(), start=first_gid):
+                progress_bar.update(1)
+                values = dict(zip(fields, shape_record.record))
+                # pyshp reads the empty text fields as empty strings, store them as NULLs
+                values = {field: None if value == "" else value for field, value in values.items()}
+                if values.get("utilisatio") is None:
+                    num_without_cubf += 1
+                    continue
+
+                values["gid"] = gid
+                yield [
+                    convert(value) if convert and value is not None else value
+                    for value, convert in ((values.get(column), LOT_CONVERTERS[column]) for column in LOT_COLUMNS)
+                ] + [shape_ewkb(shape_record.shape)]
+
+        cursor.execute(SQL_CREATE_LOTS_STAGING)
+        cursor.copy_expert(SQL_COPY_LOTS_STAGING, CopyStream(lot_records(), LOT_COLUMNS + ["geom"]),
+                           size=COPY_BUFFER_SIZE)
+        progress_bar.close()
+
+    cursor.execute(SQL_INSERT_LOTS)
+    count = cursor.rowcount
+    conn.commit()
+    conn.close()
+    return count, num_without_cubf
 
 
-def link_lots_to_evalunits(self, delete_data=False, test=False):
+def link_lots_to_evalunits(self, delete_data=False, test=False, spatial_engine="postgis", num_workers=1):
     """
-    Chose not to parallelize this as we're doing lots of quick writing to the DB.
+    Links the evaluation units to their lot with set-based UPDATEs over chunks of lots,
+    walking the gids down with keyset pagination and committing after each chunk.
+    With the shapely engine, the 'Multiple' lots are joined to the units afterwards, in worker processes.
+    In test mode, only the first two chunks (or municipalities) are linked.
     """
     self.stdout.write("\nLinking lots to evaluation units...")
     conn, cursor = get_DB_conn(DB_CONN_STR, dict_cursor=False)
 
-    # In an attempt to speed up the following operations
     cursor.execute(f"SELECT count(*) FROM {LOTS_TABLE};")
     num_lots = cursor.fetchone()[0]
+    if not num_lots:
+        return
 
-    NUM_CHUNKS = 100 if not test else 2
+    progress_bar = tqdm(total=num_lots, desc=f"Processing lots")
+    num_updated = 0
+    num_chunks = 0
+    # Exclusive upper bound of the next chunk, the gids are text so the first chunk has none
+    before = None
 
-    chunk_length = math.ceil(num_lots / NUM_CHUNKS)
+    while not (test and num_chunks == 2):
+        cursor.execute(SQL_NEXT_LOTS_CHUNK, {'before': before, 'limit': LINK_CHUNK_SIZE})
+        first, chunk_length = cursor.fetchone()
+        if not chunk_length:
+            break
 
-    progress_bar = tqdm(total=num_lots, desc=f"Processing lots")
+        bounds = {'first': first, 'before': before}
+        cursor.execute(SQL_LINK_LOTS if spatial_engine == "postgis" else SQL_LINK_SINGLE_ID_LOTS, bounds)
+        num_updated += cursor.rowcount
+        conn.commit()
 
-    # Split lots into 100 chunks
-    # The whole table is about 4GB so each chunk will be ~40MB and can be loaded in memory easily
-    # Donig the whole operation in the DB took a long time and we had no visibility on progress
+        progress_bar.update(chunk_length)
+        progress_bar.set_postfix(units_updated=num_updated)
+        before = first
+        num_chunks += 1
 
-    # We simplify the geometries here using st_simplify(geom, 0.000005, true)
-    # because drawing some of them on the streetview was getting expensive
-    for offset in range(0, num_lots, chunk_length):
+    progress_bar.close()
 
-        # ORDER BY clause is required to guarantee sequentiality of pages when using limit and offset
-        # https://www.postgresql.org/docs/current/queries-limit.html
-        cursor.execute(
-            f"SELECT gid, id_provinc FROM {LOTS_TABLE} ORDER BY gid DESC LIMIT {chunk_length} OFFSET {offset};"
-        )
-        lots = cursor.fetchall()
+    if spatial_engine == "shapely":
+        link_multiple_id_lots_in_workers(self, conn, cursor, num_workers, test=test)
 
-        for i, lot in enumerate(lots):
-            gid, id_provinc = lot
-
-            # For lots without a single provincial ID (there are at least 30233),
-            # do a spatial intersection search to find the associated eval units
-            if id_provinc == "Multiple":
-                cursor.execute(
-                    f"""
-                        UPDATE {EVALUNIT_TABLE} AS e 
-                        SET lot_id = %s 
-                        FROM (
-                            SELECT e.id as id
-                            FROM lots l 
-                            JOIN evalunits e ON ST_Intersects(l.geom, e.point) 
-                            WHERE l.gid = %s 
-                        ) AS r WHERE r.id = e.id;""",
-                    (gid, gid),
-                )
+    cursor.execute(f"SELECT count(*) FROM {EVALUNIT_TABLE} WHERE lot_id IS NOT NULL;")
+    self.stdout.write(self.style.SUCCESS(f"\nDone, {cursor.fetchone()[0]} evaluation units have a lot"))
+    conn.close()
 
-            # For lots with a single provincial ID, simply retrieve the evaluation unit
-            else:
-                cursor.execute(
-                    f"""
-                               UPDATE {EVALUNIT_TABLE} 
-                               SET lot_id = %s
-                               WHERE id = %s
-                               """,
-                    (gid, id_provinc),
-                )
-            progress_bar.update(1)
 
-            if i % 10_000:
-                conn.commit()
+def link_multiple_id_lots_in_workers(self, conn, cursor, num_workers, test=False):
+    """
+    Joins the 'Multiple' lots to the units whose point they contain, one municipality per task,
+    then writes all the (unit, lot) pairs found back with a COPY and a single UPDATE.
+    """
+    cursor.execute(SQL_MULTIPLE_ID_LOTS_MUNIS)
+    muni_codes = [code_mun for code_mun, in cursor.fetchall()]
+    if test:
+        muni_codes = muni_codes[:2]
+
+    links = []
+    # The forked workers must not share the database connection
+    connections.close_all()
+    with Pool(processes=num_workers) as pool:
+        for muni_links in tqdm(pool.imap_unordered(join_municipality_lots, muni_codes),
+                               total=len(muni_codes), desc="Joining 'Multiple' lots"):
+            links.extend(muni_links)
+
+    cursor.execute(SQL_CREATE_LOT_LINKS)
+    cursor.copy_expert(SQL_COPY_LOT_LINKS, CopyStream(links, LOT_LINKS_COLUMNS), size=COPY_BUFFER_SIZE)
+    # Statistics for the planner to pick a hash join
+    cursor.execute(f"ANALYZE {LOT_LINKS_TABLE};")
+    cursor.execute(SQL_UPDATE_FROM_LOT_LINKS)
+    num_updated = cursor.rowcount
+    conn.commit()
+    self.stdout.write(f"Found {len(links)} units in the 'Multiple' lots of {len(muni_codes)} municipalities, "
+                      f"linked {num_updated}")
+
 
-    self.stdout.write(self.style.SUCCESS("\nDone"))
+def join_municipality_lots(code_mun):
+    """
+    (unit ID, lot gid) pairs of the units whose point is in a 'Multiple' lot of the municipality,
+    joined with an STRtree of the lots. Only the units within the bounds of the lots are read.
+    """
+    conn, cursor = get_DB_conn(DB_CONN_STR, dict_cursor=False)
+    try:
+        cursor.execute(SQL_MUNI_MULTIPLE_ID_LOTS, {'code_mun': code_mun})
+        lots = cursor.fetchall()
+        if not lots:
+            return []
+
+        gids = [gid for gid, _ in lots]
+        polygons, (xmin, ymin, xmax, ymax) = polygons_bounds([bytes(wkb) for _, wkb in lots])
+        cursor.execute(SQL_UNITS_IN_BOUNDS, {'xmin': xmin, 'ymin': ymin, 'xmax': xmax, 'ymax': ymax})
+        units = cursor.fetchall()
+    finally:
+        conn.close()
+
+    if not units:
+        return []
+
+    ids, xs, ys = zip(*units)
+    lot_indices, unit_indices = points_in_polygons(polygons, xs, ys)
+    return [(ids[u], gids[l]) for l, u in zip(lot_indices.tolist(), unit_indices.tolist())]
@@ -1,16 +1,18 @@
 import shutil
 import IPython
 import traceback
-import shapefile
 import psycopg2.extras
 
 from tqdm import tqdm
 from pathlib import Path
 from datetime import datetime
 from django.db.models import Q
-from django.db import connection
+from django.db import connection, transaction
 from buildings.models import EvalUnit
+from buildings.utils.bulk_load import CopyStream, COPY_BUFFER_SIZE
 from buildings.utils.utility import download_file
+from buildings.utils.archives import find_files, open_shapefile
+from buildings.utils.shapefile_points import dbf_file, in_bbox, iter_deleted_flags, read_points
 from django.core.management.base import BaseCommand
 from config.settings import BASE_DIR
 
@@ -25,6 +27,24 @@ DB_USER = connection.settings_dict["USER"]
 DB_PW = connection.settings_dict["PASSWORD"]
 DB_CONN_STR = f"postgresql://{DB_USER}:{DB_PW}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
+# The coordinates of the shapefile are copied to this table, then joined to the units in a single UPDATE
+COORDS_TABLE = "roll_coords_staging"
+COORDS_COLUMNS = ["id", "lng", "lat"]
+
+SQL_CREATE_COORDS = f"""
+    CREATE TEMP TABLE {COORDS_TABLE} (id TEXT, lng DOUBLE PRECISION, lat DOUBLE PRECISION) ON COMMIT DROP;
+"""
+SQL_COPY_COORDS = f"COPY {COORDS_TABLE} ({', '.join(COORDS_COLUMNS)}) FROM STDIN;"
+SQL_UPDATE_FROM_COORDS = f"""
+    UPDATE {EVALUNIT_TABLE} e
+    SET
+        lng = c.lng,
+        lat = c.lat,
+        point = ST_SetSRID(ST_MakePoint(c.lng, c.lat), 4326)
+    FROM {COORDS_TABLE} c
+    WHERE e.id = c.id;
+"""
+
 
 class Command(BaseCommand):
     help = "Process the roll data and fill the database."
@@ -75,24 +95,23 @@ class Command(BaseCommand):
 
         t0 = datetime.now()
 
-        # Search the data directory for the shapefile
-        if not list(roll_shp_folder.glob("**/rol_unite_p.shp")) or download_data:
+        # Search the data directory for the shapefile, extracted or in its archive
+        if not find_files(roll_shp_folder, "rol_unite_p.shp") or download_data:
             download_file(
                 "https://donneesouvertes.affmunqc.net/role/ROLE2022_SHP.zip",
                 roll_shp_folder,
-                unzip=True,
             )
             self.stdout.write(
                 self.style.SUCCESS("Roll points shapefile downloaded successfully")
             )
 
-        shp_file = next(roll_shp_folder.glob("**/rol_unite_p.shp"))
+        shp_file = find_files(roll_shp_folder, "rol_unite_p.shp")[0]
 
         try:
-            parse_shapefile(shp_file, test=test)
+            num_updated = parse_shapefile(shp_file, test=test)
             self.stdout.write(
                 self.style.SUCCESS(
-                    f"Finished parsing shapefile in {datetime.now() - t0} s"
+                    f"Finished parsing shapefile in {datetime.now() - t0} s, located {num_updated} units"
                 )
             )
             if not test:
@@ -112,37 +131,87 @@ class Command(BaseCommand):
 
 
 def parse_shapefile(shp_file, test=False):
+    """
+    Sets the coordinates of the units from the roll points shapefile. The points are streamed
+    into a temporary table with COPY, then joined to the units in a single UPDATE.
+    Returns the number of units updated.
+    """
+    num_units = 10_000 if test else None
 
-    # This curosr will handle commiting transactions
-    with shapefile.Reader(shp_file) as shp, connection.cursor() as cursor:
-
-        if test:
-            num_units = 10_000
-        else:
-            num_units = len(shp)
-
-        print(f"Shapefile contains {num_units} units")
-
-        for i in tqdm(range(num_units), desc="Processing"):
-            # The ID field is globally unique for evaluation units
-            id = shp.record(i)[0]
-
-            # We don't need to transform the coordinates, the point
-            # has lat/lng in NAD83 which is compatbile with WSG84.
-            # In QGIS, changing the CRS from NAD83 to WDG84 performs the EPSG-1188
-            # transformation, which we see here https://epsg.io/1188 is a noop.
-            lng, lat = shp.shape(i).points[0]
-            cursor.execute(
-                f"""
-                UPDATE {EVALUNIT_TABLE} 
-                SET
-                    lng = %s,
-                    lat = %s,
-                    point = ST_SetSRID(ST_MakePoint(%s, %s), 4326)
-                    WHERE id = %s
-            """,
-                [lng, lat, lng, lat, id],
-            )
+    try:
+        coords = read_coords(shp_file, num_units=num_units)
+    except (ImportError, ValueError) as e:
+        print(f"{e}. Reading the points one by one with pyshp.")
+        coords = read_coords_pyshp(shp_file, num_units=num_units)
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(SQL_CREATE_COORDS)
+        cursor.copy_expert(SQL_COPY_COORDS, CopyStream(coords, COORDS_COLUMNS), size=COPY_BUFFER_SIZE)
+        # Statistics for the planner to pick a hash join
+        cursor.execute(f"ANALYZE {COORDS_TABLE};")
+        print("Updating the units' coordinates")
+        cursor.execute(SQL_UPDATE_FROM_COORDS)
+        return cursor.rowcount
+
+
+def read_coords(shp_file, num_units=None):
+    """
+    (id, lng, lat) of the roll points, all decoded at once by the vectorized reader.
+    The points outside of Quebec are dropped.
+    """
+    ids, lng, lat, num_outside = read_points(shp_file)
+    if num_outside:
+        print(f"Dropped {num_outside} points outside of Quebec")
+
+    ids, lng, lat = ids[:num_units], lng[:num_units], lat[:num_units]
+    print(f"Shapefile contains {len(ids)} units")
+    return tqdm(zip(ids.astype(str).tolist(), lng.tolist(), lat.tolist()), total=len(ids), desc="Copying points")
+
+
+def read_coords_pyshp(shp_file, num_units=None):
+    """
+    Same as read_coords, reading the records one at a time with pyshp. The deleted records,
+    null shapes and points outside of Quebec are dropped as well.
+    """
+    num_read = 0
+    num_outside = 0
+    with open_shapefile(shp_file) as shp:
+        # Read sequentially, the shapefile may be streamed from its archive
+        records = shp.iterRecords()
+        shapes = zip(shp.iterShapes(), iter_deleted_flags(dbf_file(shp_file)))
+        for shape, deleted in tqdm(shapes, total=len(shp), desc="Copying points"):
+            # iterRecords() skips the deleted records
+            if deleted:
+                continue
+            record = next(records)
+            if not shape.points:
+                continue
+
+            id, lng, lat = shape_record_to_coords(shape, record)
+            if not in_bbox(lng, lat):
+                num_outside += 1
+                continue
+
+            yield id, lng, lat
+            num_read += 1
+            if num_read == num_units:
+                break
+
+    if num_outside:
+        print(f"Dropped {num_outside} points outside of Quebec")
+    print(f"Shapefile contains {num_read} units")
+
+
+def shape_record_to_coords(shape, record):
+    # The ID field is globally unique for evaluation units
+    id = record[0]
+
+    # We don't need to transform the coordinates, the point
+    # has lat/lng in NAD83 which is compatbile with WSG84.
+    # In QGIS, changing the CRS from NAD83 to WDG84 performs the EPSG-1188
+    # transformation, which we see here https://epsg.io/1188 is a noop.
+    lng, lat = shape.points[0]
+    return id, lng, lat
 
 
 def cleanup_entries_without_coords():
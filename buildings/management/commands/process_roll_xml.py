@@ -1,6 +1,7 @@
 import os
+import re
+import json
 import time
-import heapq
 import shutil
 import django
 import IPython
@@ -8,20 +9,41 @@ import traceback
 
 from tqdm import tqdm
 from pathlib import Path
+from hashlib import md5
 from datetime import datetime
+from lxml import etree
 from bs4 import BeautifulSoup
 from django.db.models import Q
+from django.db import connection, connections, transaction
 from multiprocessing import Pool
 from xml.dom.pulldom import parse
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
-from buildings.models import EvalUnit
+from buildings.models import EvalUnit, RollIngestionChunk, RollIngestionFile
+from buildings.utils.bulk_load import copy_objects
+from buildings.utils.archives import ZipMember, find_files
+from buildings.utils.columnar import import_pyarrow, write_parquet, copy_parquet
 from buildings.utils.utility import sizeof_fmt, download_file
 from buildings.utils.constants import * 
+from buildings.utils.roll_schema import UNIT_COLUMNS, FIELD_EXTRACTORS, STREET_COMPONENTS
+from buildings.management.commands.aggregate_murbs import MURB_DISAG_TABLE
 
 from config.settings import BASE_DIR
 
 DEFAULT_OUT = BASE_DIR / 'data' 
+ROLL_ARCHIVE = "Roles_Donnees_Ouvertes_{year}.zip"
+ROLL_URL = "https://donneesouvertes.affmunqc.net/role/" + ROLL_ARCHIVE
+
+# Large XMLs are split in chunks of about this size, processed in parallel
+TASK_SIZE = 64 * 1024 * 1024
+READ_BLOCK_SIZE = 1024 * 1024
+# Opening tag of a unit, e.g. <RLUEx> or <ns:RLUEx ...>
+RE_UNIT_START = re.compile(rb'<(?:[\w.-]+:)?RLUEx[\s>]')
+
+# Fields read from the roll, updated when a delta updates a unit
+ROLL_FIELDS = [column.name for column in UNIT_COLUMNS if column.from_roll and column.name != 'id'] + ['content_hash']
+# Units deleted at a time by a delta
+DELETE_BATCH_SIZE = 10_000
 
 
 class Command(BaseCommand):
@@ -53,6 +75,43 @@ class Command(BaseCommand):
                             default=False,
                             help='Run in testing mode on a few XMLs')
 
+        parser.add_argument('-p', '--parser', 
+                            choices=['lxml', 'pulldom'],
+                            default='lxml',
+                            help="XML parsing backend. 'lxml' streams with lxml's iterparse and reads each unit in a single pass, "
+                                 "'pulldom' is the original pulldom + BeautifulSoup parser, kept for comparison.")
+
+        parser.add_argument('-r', '--restart', 
+                            action='store_true', 
+                            default=False,
+                            help="Process all the XMLs from the start, instead of skipping those completed "
+                                 "and resuming those interrupted by a previous run")
+
+        parser.add_argument('-y', '--year', 
+                            type=int, 
+                            default=2022,
+                            help="Year of the roll to download and process")
+
+        parser.add_argument('--delta', 
+                            action='store_true', 
+                            default=False,
+                            help="Apply a newer roll to the database: insert the new units, update those that changed "
+                                 "and delete those no longer in it, leaving the others and their surveys untouched. "
+                                 "The units imported before the content hashes were stored have none, the first delta "
+                                 "rewrites all of them.")
+
+        parser.add_argument('--to-parquet', 
+                            type=Path, 
+                            default=None,
+                            help="Write the parsed units to Parquet files in this folder, one subfolder per municipality, "
+                                 "instead of the database. Needs pyarrow.")
+
+        parser.add_argument('--from-parquet', 
+                            type=Path, 
+                            default=None,
+                            help="Load the units from the Parquet files written by --to-parquet, instead of parsing the XMLs. "
+                                 "Needs pyarrow.")
+
     def handle(self, *args, **options):
 
         data_folder: Path = options['output_folder'] / Path('roll_xml')
@@ -62,21 +121,60 @@ class Command(BaseCommand):
         delete_data = options['delete_data']
         num_workers = options['num_workers']
         test = options['test']
+        parser = options['parser']
+        restart = options['restart']
+        year = options['year']
+        delta = options['delta']
+        to_parquet = options['to_parquet']
+        from_parquet = options['from_parquet']
         
         t0 = datetime.now()
 
-        # If the folder is empty
-        if not list(data_folder.glob('**/*.xml')) or download_data:
-            download_file("https://donneesouvertes.affmunqc.net/role/Roles_Donnees_Ouvertes_2022.zip", data_folder, unzip=True)
+        if to_parquet or from_parquet:
+            try:
+                import_pyarrow()
+            except ImportError as e:
+                raise CommandError(str(e))
+        if (to_parquet or delta) and parser != 'lxml':
+            raise CommandError("--to-parquet and --delta are only supported by the lxml parser")
+        if delta and (to_parquet or from_parquet):
+            raise CommandError("--delta can't be combined with the Parquet snapshots")
 
         try:
-            results = launch_jobs(data_folder, num_workers, test=test)
-            self.stdout.write(
-                self.style.SUCCESS(f'\nFinished parsing XMLs in {datetime.now() - t0} s')
-            )
-            self.stdout.write(
-                self.style.SUCCESS(f'Total units parsed: {sum(results)}')
-            )
+            if from_parquet:
+                results = load_parquet_snapshot(from_parquet, num_workers)
+                self.stdout.write(
+                    self.style.SUCCESS(f'\nFinished loading the Parquet snapshot in {datetime.now() - t0} s')
+                )
+                self.stdout.write(
+                    self.style.SUCCESS(f'Total units loaded: {results}')
+                )
+            else:
+                # If the folder doesn't have the year's roll. The XMLs are read from the archive, without extracting it.
+                xml_files = find_roll_xmls(data_folder, year, extracted=not delta)
+                if not xml_files or download_data:
+                    download_file(ROLL_URL.format(year=year), data_folder)
+                    xml_files = find_roll_xmls(data_folder, year, extracted=not delta)
+
+                # Their hash can't be computed from the stored values, only from the roll's
+                if delta and EvalUnit.objects.filter(content_hash__isnull=True).exists():
+                    self.stdout.write(self.style.WARNING(
+                        "Some units don't have a content hash yet, this delta rewrites them all"
+                    ))
+
+                results = launch_jobs(xml_files, num_workers, test=test, parser=parser, restart=restart, 
+                                      parquet_folder=to_parquet, delta=delta)
+                self.stdout.write(
+                    self.style.SUCCESS(f'\nFinished parsing XMLs in {datetime.now() - t0} s')
+                )
+                self.stdout.write(
+                    self.style.SUCCESS(f'Total units parsed: {results}')
+                )
+
+            # The snapshot keeps all the units, they are filtered when loading it
+            if to_parquet:
+                return
+
             num_deleted = delete_units_without_street_numbers()
             self.stdout.write(
                 self.style.SUCCESS(f'Deleted {num_deleted} units without street numbers')
@@ -104,399 +202,689 @@ def delete_units_without_street_numbers():
     return count
 
 
-def launch_jobs(data_folder: Path, num_workers: int, test: bool = False):
+def launch_jobs(xml_files: list, num_workers: int, test: bool = False, parser: str = 'lxml', restart: bool = False,
+                parquet_folder: Path = None, delta: bool = False):
+    """
+    Parses the XMLs with a pool of workers pulling tasks from a shared queue, largest first.
+    With the lxml parser, large extracted XMLs (i.e. Montreal) are split in chunks of about TASK_SIZE bytes
+    so that no worker is left alone with a huge file at the end. Returns the number of units created.
+
+    If parquet_folder is given, the units are written to Parquet files in it instead of the database,
+    one subfolder per municipality code. With delta, only the units that changed since the stored roll
+    are written, and those no longer in the XMLs are deleted. Both parse all the XMLs without the manifest,
+    a delta is applied again from the start if interrupted, skipping the units it already wrote.
+    """
+    if parquet_folder or delta:
+        xml_files = [(xml_file, None) for xml_file in xml_files]
+    else:
+        xml_files = get_xmls_to_process(xml_files, restart=restart)
+
+    # For testing only, keep a few of the smaller files per worker
+    if test:
+        xml_files = sorted(xml_files, key=lambda x: x[0].stat().st_size)[num_workers * 10: num_workers * 30]
+        print(f'Truncated the input XMLs to {len(xml_files)}')
+
+    if parquet_folder:
+        # Rewrite the whole snapshot
+        for path in parquet_folder.glob('**/*.parquet'):
+            path.unlink()
+        tasks = plan_tasks_without_manifest(xml_files, parquet_folder=parquet_folder)
+    elif delta:
+        tasks = plan_tasks_without_manifest(xml_files, delta=True)
+    else:
+        tasks = plan_tasks(xml_files, split=parser == 'lxml')
+    if parser == 'pulldom' and any(task['chunk'].start > 0 for task in tasks):
+        raise CommandError("Some XMLs were split in chunks by the lxml parser, resume with it or use --restart")
+
+    parse_function = parse_xml_chunk if parser == 'lxml' else parse_xml_pulldom
+    print(f"Processing {sizeof_fmt(sum(task['size'] for task in tasks))} in {len(tasks)} tasks")
+
+    # The forked workers must not share the connection used to plan the tasks
+    connections.close_all()
 
-    # Split the XMLs evenly between the workers
-    splits = split_xmls_between_workers(data_folder, num_workers, test=test)
+    num_units = 0
+    # Units of each municipality missing from all the chunks of its XML, for a delta
+    removed_ids = {}
+    progress_bar = tqdm(total=sum(task['size'] for task in tasks), desc="Parsing XMLs",
+                        unit='iB', unit_scale=True, unit_divisor=1024)
 
     # Doesn't work without the initializer function
     # https://stackoverflow.com/questions/73295496/django-how-can-i-use-multiprocessing-in-a-management-command
     with Pool(processes=num_workers, initializer=django.setup) as pool:
-        results = pool.map(parse_xmls, splits)
-    
-    return results
+        for num_created, size, missing in pool.imap_unordered(parse_function, tasks):
+            num_units += num_created
+            progress_bar.update(size)
+            if missing is not None:
+                add_missing_ids(removed_ids, *missing)
 
+    progress_bar.close()
+    if delta:
+        num_deleted = delete_removed_units(removed_ids)
+        print(f'Deleted {num_deleted} units no longer in the roll')
+    elif not parquet_folder:
+        RollIngestionFile.objects.mark_completed()
+    return num_units
 
 
-def split_xmls_between_workers(data_folder: Path, num_workers: int, test: bool = False):
+def find_roll_xmls(data_folder: Path, year: int, extracted: bool = True):
     """
-    Partition the XMLs such that each worker has an approximately equal
-    total data size to process. This is because some municipalities (i.e. Montreal)
-    have vastly more data than others, and we want to parallelize as best as possible.
+    XMLs of the year's roll in the data folder: the members of its archive, as downloaded, else
+    the XMLs extracted in the folder if extracted is True. The archives of the other years are
+    ignored, so a newer roll can be downloaded next to an older one.
     """
+    xml_files = find_files(data_folder, '*.xml')
+    archive = ROLL_ARCHIVE.format(year=year)
+    members = [xml_file for xml_file in xml_files if isinstance(xml_file, ZipMember) and xml_file.zip_path.name == archive]
+    if members or not extracted:
+        return members
+    # Their year isn't known, only the archives are named after it
+    return [xml_file for xml_file in xml_files if not isinstance(xml_file, ZipMember)]
 
-    size_per_file = {}
-    for xml_file in data_folder.iterdir():
-        size_per_file[xml_file] = xml_file.stat().st_size
 
-    # For the real run, sort the files by size in descending order
-    size_per_file = dict(sorted(size_per_file.items(), key=lambda x: x[1], reverse=True))
-    
-    # For testing only, invert the sort order so smaller files are first
-    # and truncate it to keep only a few files per worker.
-    if test:
-        import itertools
-        size_per_file = dict(sorted(size_per_file.items(), key=lambda x: x[1]))
-        size_per_file = dict(itertools.islice(size_per_file.items(), num_workers * 10, num_workers * 30))
-        print(f'Truncated the input XMLs to {len(size_per_file)}')
-
-    # We iterate over the files, starting from the one with largest
-    # file size and distribute them among workers, always giving 
-    # the current to the worker with the least amount of data.
-    # Using a min heap, we quickly get the worker with the least amount of data.
-    # https://stackoverflow.com/questions/61648065/split-list-into-n-sublists-with-approximately-equal-sums
-    splits = [{'id': i + 1, 'files': [], 'size': 0} for i in range(num_workers)]
-    worker_heap = [ [0, worker_id] for worker_id in range(num_workers)]
-    heapq.heapify(worker_heap)
-
-    # Pop a first worker from the heap
-    lowest_worker = heapq.heappop(worker_heap)
-    for file, size in size_per_file.items():
-        # Get the worker's id
-        worker_id = lowest_worker[1]
-        # Add the file to the worker's split
-        splits[worker_id]['files'].append(file)
-        splits[worker_id]['size'] += size
-        # Add the file size to the worker's total size
-        lowest_worker[0] += size
-        # Push back the worker and pop the new lowest
-        lowest_worker = heapq.heappushpop(worker_heap, lowest_worker)
-    
-    # Print out results
-    for split in splits:
-        print(f"Worker {split['id']} will process {sizeof_fmt(split['size'])} in {len(split['files'])} files")
-
-    return splits
-
-
-            
-def parse_xmls(work_split):
-
-    worker_id = work_split['id']
-    xml_files = work_split['files']
-    worker_total_size = work_split['size']
-
-    worker_total_units = 0
-    progress_bar = tqdm(total=worker_total_size, desc=f"Worker {worker_id}", position=worker_id, 
-                        unit='iB', unit_scale=True, unit_divisor=1024, leave=False)
+def get_xmls_to_process(xml_files: list, restart: bool = False):
+    """
+    Roll XMLs not completed by a previous run, with their ingestion manifest entry.
+    Files that changed since they were recorded are processed again from the start.
+    """
+    if restart:
+        RollIngestionFile.objects.all().delete()
 
+    to_process = []
+    num_done = 0
+    num_resumed = 0
     for xml_file in xml_files:
+        entry = RollIngestionFile.objects.get_for_file(xml_file)
+        if entry.status == RollIngestionFile.Status.DONE:
+            num_done += 1
+        else:
+            num_resumed += entry.status == RollIngestionFile.Status.IN_PROGRESS
+            to_process.append((xml_file, entry))
 
-        # We use a streaming XML API for memory efficiency
-        # Reading the whole file to build a BeautifulSoup object from it was too much
-        event_stream = parse(str(xml_file))
-        last_offset = 0
-        
+    if num_done or num_resumed:
+        print(f'Skipping {num_done} XMLs completed by a previous run, resuming {num_resumed} others')
+    return to_process
 
-        # Get the municipal code and year entered first
-        # Those are applicable to the whole document
-        for i, (evt, node) in enumerate(event_stream):
-            if evt == 'START_ELEMENT':
-                if node.tagName == 'RLM01A':
-                    event_stream.expandNode(node)
-                    muni_code = node.childNodes[0].nodeValue
-
-                if node.tagName == 'RLM02A':
-                    event_stream.expandNode(node)
-                    year_entered = node.childNodes[0].nodeValue
-                    break
-        
-        current_units = []
-        
-        # Go through all the RLUEx tags - each represents a unit
-        for i, (evt, node) in enumerate(event_stream):
-
-            try:
-                if evt == 'START_ELEMENT':
-                    if node.tagName == 'RLUEx':
-                        # Parse until the closing tag
-                        event_stream.expandNode(node)
-                        unit_xml = BeautifulSoup(node.toxml(), 'lxml')
-                        # First get the MAT18 to create the provincial ID
-                        mat18 = get_mat18(unit_xml)
-                        id = muni_code + mat18
-
-                        # Check if the unit already exists before doing any more work
-                        if EvalUnit.objects.filter(id=id).first():
-
-                            if i % 5_000 == 0:
-                                current_offset = event_stream.stream.tell()
-                                if current_offset != last_offset:
-                                    offset_delta = current_offset - last_offset
-                                    progress_bar.update(offset_delta)
-                                    last_offset = current_offset
-                            continue
-                        
-                        # Start filling the unit values
-                        unit_data = {}
-                        unit_data['id'] = id
-                        unit_data['muni'] = MUNICIPALITIES[f'RL{muni_code}']
-                        unit_data['muni_code'] = muni_code
-                        unit_data['year'] = year_entered
-                        unit_data['mat18'] = mat18
-                        current_units.append(parse_unit_xml(unit_xml, unit_data))
-
-                # Print an update and commit latest writes
-                if len(current_units) % 1000 == 0 and len(current_units) > 0:
-                    current_offset = event_stream.stream.tell()
-                    if current_offset != last_offset:
-                        offset_delta = current_offset - last_offset
-                        progress_bar.update(offset_delta)
-                        last_offset = current_offset
-                    EvalUnit.objects.bulk_create(current_units)
-                    worker_total_units += len(current_units)
-                    current_units = []
-
-            except KeyboardInterrupt:
-                progress_bar.close()
-                return worker_total_units
-
-            except:
-                print(traceback.format_exc())
-                print(f"{xml_file} - around tag {i}")
-                print(unit_xml.prettify())
-                continue
 
+def plan_tasks(xml_files: list, split: bool = True):
+    """
+    The chunks of the XMLs left to process, largest first. XMLs processed for the first time are split
+    in chunks starting at unit boundaries, or kept whole if split is False. The chunks are recorded in the
+    manifest, so an interrupted run resumes with the same ones.
+    """
+    tasks = []
+    for xml_file, entry in xml_files:
+        chunks = list(entry.chunks.order_by('start'))
+        if not chunks:
+            starts = find_chunk_starts(xml_file) if split else [0]
+            chunks = RollIngestionChunk.objects.bulk_create([
+                RollIngestionChunk(file=entry, start=start, stop=stop)
+                for start, stop in zip(starts, starts[1:] + [None])
+            ])
+            entry.status = RollIngestionFile.Status.IN_PROGRESS
+            entry.save(update_fields=['status', 'date_modified'])
+
+        for chunk in chunks:
+            if not chunk.done:
+                size = (chunk.stop or entry.size) - chunk.start
+                tasks.append({'file': xml_file, 'chunk': chunk, 'size': size})
+
+    return sorted(tasks, key=lambda task: task['size'], reverse=True)
+
+
+def plan_tasks_without_manifest(xml_files: list, **options):
+    """
+    Same as plan_tasks for the Parquet snapshots and deltas, which don't record the chunks.
+    The options are added to the tasks, e.g. parquet_folder.
+    """
+    tasks = []
+    for xml_file, _ in xml_files:
+        size = xml_file.stat().st_size
+        starts = find_chunk_starts(xml_file)
+        for start, stop in zip(starts, starts[1:] + [None]):
+            tasks.append({
+                'file': xml_file,
+                'chunk': RollIngestionChunk(start=start, stop=stop),
+                'size': (stop or size) - start,
+                **options,
+            })
+
+    return sorted(tasks, key=lambda task: task['size'], reverse=True)
+
+
+def load_parquet_snapshot(parquet_folder: Path, num_workers: int):
+    """
+    Loads the Parquet files written by launch_jobs into the database, with a pool of workers
+    pulling them from a shared queue, largest first. Units already in the database are skipped.
+    Returns the number of units created.
+    """
+    paths = sorted(parquet_folder.glob('**/*.parquet'), key=lambda path: path.stat().st_size, reverse=True)
+    if not paths:
+        raise CommandError(f"No Parquet files found in {parquet_folder}")
 
-        # End of current file
-        current_offset = event_stream.stream.tell()
-        if current_offset != last_offset:
-            offset_delta = current_offset - last_offset
-            last_offset = current_offset
-            progress_bar.update(offset_delta)
-
-        # Flush out the current file's units
-        EvalUnit.objects.bulk_create(current_units)
-        worker_total_units += len(current_units)
-
-    progress_bar.close()
-    return worker_total_units
+    print(f"Loading {sizeof_fmt(sum(path.stat().st_size for path in paths))} in {len(paths)} files")
+    connections.close_all()
 
+    num_units = 0
+    with Pool(processes=num_workers, initializer=django.setup) as pool:
+        for num_created in tqdm(pool.imap_unordered(load_parquet_file, paths), total=len(paths), desc="Loading Parquet files"):
+            num_units += num_created
 
+    return num_units
 
 
-def get_mat18(unit):
-    # RL0104 - we'll use it to create the MAT18 and ID_PROVINC used in the GIS data
-    # Do this first to check if the unit has already been entered and skip work
-    rl0104 = unit.find('rl0104')
-    return generate_mat18(rl0104)
+def load_parquet_file(path: Path):
+    return copy_parquet(EvalUnit, path)
 
 
-def parse_unit_xml(unit_xml, unit_data: dict):
+def add_missing_ids(removed_ids, muni_code, missing_ids):
     """
-    Main parsing method
-    Parses the unit_xml and puts all relevant info into unit_data
+    Keeps the units of the municipality missing from all its chunks so far in removed_ids,
+    or None once a chunk couldn't tell which of its units are missing.
     """
+    if missing_ids is None or removed_ids.get(muni_code, missing_ids) is None:
+        removed_ids[muni_code] = None
+    elif muni_code in removed_ids:
+        removed_ids[muni_code] &= missing_ids
+    else:
+        removed_ids[muni_code] = missing_ids
 
-    # RL0101: Unit Identification Fields
-    # Every unit must have at least RL0101Gx, so RL0101 will always be present
-    # They made so that multiple RL0101x could be present, but in practice there's always a single one
-    rl0101x = unit_xml.find('rl0101x')
-    get_address_components_and_resolve(rl0101x, unit_data)
 
-    # Keep the apt number separate from the street address
-    # We can use this to merge MURBs that are disaggregated into indiviudal units
-    get_apt_num_components(rl0101x, unit_data)
+def delete_removed_units(removed_ids):
+    """
+    Deletes the units no longer in the roll, by municipality as given by add_missing_ids.
+    Nothing is deleted from a municipality with a unit that failed to parse without an ID.
+    Returns the number of units deleted.
+    """
+    skipped = sorted(muni_code for muni_code, ids in removed_ids.items() if ids is None)
+    if skipped:
+        print(f"Not deleting the units of {', '.join(skipped)}, some of their units couldn't be identified")
+    return delete_units(set().union(*(ids for ids in removed_ids.values() if ids is not None)))
 
-    # RL0102A 
-    unit_data['arrond'] = extract_field_or_none(unit_xml, 'rl0102a')
 
-    # CUBF is mandatory
-    unit_data['cubf'] = extract_field_or_none(unit_xml, 'rl0105a', type=int) 
+def delete_units(ids):
+    """Deletes the units with their votes, surveys and images, in batches. Returns the number of units deleted."""
+    ids = sorted(ids)
+    num_deleted = 0
+    for i in range(0, len(ids), DELETE_BATCH_SIZE):
+        _, deleted = EvalUnit.objects.filter(id__in=ids[i:i + DELETE_BATCH_SIZE]).delete()
+        num_deleted += deleted.get(EvalUnit._meta.label, 0)
+    return num_deleted
 
-    unit_data['file_num'] = extract_field_or_none(unit_xml, 'rl0106a')
-    unit_data['nghbr_unit'] = extract_field_or_none(unit_xml, 'rl0107a')
-    
 
-    # RL0201 - Owner Info
-    # These are all mandatory fields
-    # Most of it is redacted but we can know if the owner is a physical or moral person
-    rl0201 = unit_xml.find('rl0201')
+def find_chunk_starts(xml_file, chunk_size=TASK_SIZE):
+    """
+    Offsets splitting the XML in chunks of about chunk_size bytes, each one starting at
+    the opening tag of a unit, found by searching forward from every multiple of chunk_size.
+    The first chunk starts at 0 and includes the header.
 
-    # There can be multiple signup dates to the assessment roll
-    # Take only the latest one
-    max_date = datetime.strptime('1500-01-01', '%Y-%m-%d')
-    for rl0201x in rl0201.find_all('rl0201x'):
-        
-        rl0201gx_tmp = rl0201x.find('rl0201gx').text
-        date_time = datetime.strptime(rl0201gx_tmp, '%Y-%m-%d')
+    The XMLs still in their archive are kept whole: a ZIP member can't seek without decompressing
+    everything before the offset, so each chunk would decompress the file from its start again.
+    """
+    starts = [0]
+    size = xml_file.stat().st_size
+    if size <= chunk_size or isinstance(xml_file, ZipMember):
+        return starts
+
+    with xml_file.open('rb') as f:
+        for target in range(chunk_size, size, chunk_size):
+            # The previous search went past this target
+            if target <= starts[-1]:
+                continue
 
-        if date_time > max_date:
-            owner_date = rl0201gx_tmp
-            if rl0201x.find('rl0201hx').text == '1':
-                owner_type = 'physical'
+            f.seek(target)
+            offset = target
+            # Keep the end of the previous block, a tag may straddle two blocks
+            overlap = b''
+            while block := f.read(READ_BLOCK_SIZE):
+                data = overlap + block
+                if match := RE_UNIT_START.search(data):
+                    starts.append(offset - len(overlap) + match.start())
+                    break
+                overlap = data[-64:]
+                offset += len(block)
             else:
-                owner_type = 'moral'
+                # No more units after the target
+                break
 
-    unit_data['owner_date'] = owner_date
-    unit_data['owner_type'] = owner_type
+    return starts
 
-    # Resolve the owner status from an integer to human readable value
-    unit_data['owner_status'] = extract_field_or_none(rl0201, 'rl0201u', type=str)
-    if owner_status := unit_data['owner_status']:
-        if owner_status in OWNER_STATUSES:
-            unit_data['owner_status'] = OWNER_STATUSES[owner_status]
-        else:
-            print(f'\t\tWARNING: Unknown owner status {owner_status}')
-
-    # RL030Xx - Unit Characteristics
-    unit_data['lot_lin_dim'] = extract_field_or_none(unit_xml, 'rl0301a', type=float)
-    unit_data['lot_area'] = extract_field_or_none(unit_xml, 'rl0302a', type=float)
-    unit_data['max_floors'] = extract_field_or_none(unit_xml, 'rl0306a', type=int)
-    unit_data['const_yr'] = extract_field_or_none(unit_xml, 'rl0307a', type=int)
-    unit_data['const_yr_real'] = extract_field_or_none(unit_xml, 'rl0307b')
-    unit_data['floor_area'] = extract_field_or_none(unit_xml, 'rl0308a', type=float)
-
-    # Resolve physical link to human readable value
-    unit_data['phys_link'] = extract_field_or_none(unit_xml, 'rl0309a', type=str)
-    if phys_link := unit_data['phys_link']:
-        if phys_link in PHYSICAL_LINKS:
-            unit_data['phys_link'] = PHYSICAL_LINKS[phys_link]
-        else:
-            print(f'\t\tWARNING: Unknown physical link {phys_link}')
 
-    # Resolve construction type to human readable value
-    unit_data['const_type'] = extract_field_or_none(unit_xml, 'rl0310a', type=str)
-    if const_type := unit_data['const_type']:
-        if const_type in CONSTRUCTION_TYPES:
-            unit_data['const_type'] = CONSTRUCTION_TYPES[const_type]
-        else:
-            print(f'\t\tWARNING: Unknown construction type {const_type}')
+def read_header(f):
+    """Bytes of the XML before its first unit: the opening tags and the fields applying to the whole file"""
+    data = b''
+    while block := f.read(64 * 1024):
+        data += block
+        if match := RE_UNIT_START.search(data):
+            return data[:match.start()]
+    return data
 
-    unit_data['num_dwelling'] = extract_field_or_none(unit_xml, 'rl0311a', type=int)
-    unit_data['num_rental'] = extract_field_or_none(unit_xml, 'rl0312a', type=int)
-    unit_data['num_non_res'] = extract_field_or_none(unit_xml, 'rl0313a', type=int)
-    # rl0314 - rl0315 are related to agricultural zones, we ignore them here
 
-    # RL040XX - Value 
-    unit_data['apprais_date'] = extract_field_or_none(unit_xml, 'rl0401a')
-    unit_data['lot_value'] = extract_field_or_none(unit_xml, 'rl0402a', type=float)
-    unit_data['building_value'] = extract_field_or_none(unit_xml, 'rl0403a', type=float)
-    unit_data['value'] = extract_field_or_none(unit_xml, 'rl0404a', type=float)
-    unit_data['prev_value'] = extract_field_or_none(unit_xml, 'rl0405a', type=float)
+def parse_xml_pulldom(task):
+    """
+    Parses a whole XML with the original pulldom + BeautifulSoup parser.
+    Returns the number of units created and the size of the task.
+    """
+    xml_file = task['file']
+    # Units committed by a previous run are skipped
+    chunk = task['chunk']
+    num_units = 0
+    num_created = 0
+    existing_ids = None
+    current_units = []
+
+    for muni_code, year_entered, node in iter_units_pulldom(xml_file):
+        num_units += 1
+        if num_units <= chunk.num_units_done:
+            continue
+        if existing_ids is None:
+            existing_ids = get_existing_unit_ids(muni_code)
 
-    return EvalUnit(**unit_data)
+        try:
+            unit_xml = BeautifulSoup(node.toxml(), 'lxml')
+            fields, owners = flatten_soup(unit_xml)
+            # First get the MAT18 to create the provincial ID
+            mat18 = generate_mat18_from_fields(fields)
+            id = muni_code + mat18
+
+            # Check if the unit already exists before doing any more work
+            if id not in existing_ids:
+                current_units.append(parse_unit_fields(fields, owners, new_unit_data(muni_code, year_entered, mat18)))
+                existing_ids.add(id)
+
+        except:
+            print(traceback.format_exc())
+            print(f"{xml_file} - unit {num_units}")
+            print(unit_xml.prettify())
+            continue
+
+        # Commit latest writes
+        if len(current_units) >= 1000:
+            save_units(task, current_units, num_units)
+            num_created += len(current_units)
+            current_units = []
+
+    # Flush out the file's units
+    save_units(task, current_units, num_units, done=True)
+    num_created += len(current_units)
+
+    return num_created, task['size'], None
+
+
+def iter_units_pulldom(xml_file):
+    """Yields the municipal code and year entered of the XML with each of its RLUEx nodes, expanded"""
+    # We use a streaming XML API for memory efficiency
+    # Reading the whole file to build a BeautifulSoup object from it was too much
+    event_stream = parse(xml_file.open('rb'))
+
+    # Get the municipal code and year entered first
+    # Those are applicable to the whole document
+    for evt, node in event_stream:
+        if evt == 'START_ELEMENT':
+            if node.tagName == 'RLM01A':
+                event_stream.expandNode(node)
+                muni_code = node.childNodes[0].nodeValue
+
+            if node.tagName == 'RLM02A':
+                event_stream.expandNode(node)
+                year_entered = node.childNodes[0].nodeValue
+                break
+
+    # Go through all the RLUEx tags - each represents a unit
+    for evt, node in event_stream:
+        if evt == 'START_ELEMENT' and node.tagName == 'RLUEx':
+            # Parse until the closing tag
+            event_stream.expandNode(node)
+            yield muni_code, year_entered, node
+
+
+def parse_xml_chunk(task):
+    """
+    Parses a chunk of XML with lxml's pull parser, see iter_units_lxml. All the fields of a unit
+    are read in a single pass over its elements.
+    Returns the number of units created and the size of the task, and for a delta the municipality code
+    with the IDs of its units not in the chunk.
+
+    If the task has a parquet_folder, all the units of the chunk are written to a Parquet file
+    in its municipality's subfolder instead, whether they are in the database or not.
+    Otherwise, the units already in the database are skipped, see parse_new_units. For a delta,
+    the units are compared to the stored ones with their content hash, and only the new and changed
+    ones are written.
+    """
+    xml_file = task['file']
+    # Units committed by a previous run are skipped
+    chunk = task['chunk']
+    parquet_folder = task.get('parquet_folder')
+    delta = task.get('delta')
+    num_units = 0
+    num_created = 0
+    existing_ids = None
+    current_units = []
+    # Units of an import waiting to be checked against the database, see parse_new_units
+    unchecked_units = []
+
+    # Whether a unit of a delta failed to parse before its ID was known
+    unidentified_units = False
+
+    for muni_code, year_entered, elem in iter_units_lxml(xml_file, chunk.start, chunk.stop):
+        num_units += 1
+        # Skip the units committed by a previous run
+        if num_units <= chunk.num_units_done:
+            continue
+
+        if existing_ids is None:
+            # The units already read, to skip the duplicates of the chunk
+            existing_ids = set()
+            if delta:
+                stored_hashes = get_stored_unit_hashes(muni_code)
+                aggregated_murb_ids = get_aggregated_murb_ids(muni_code)
+                missing_ids = set(stored_hashes)
+
+        id = None
+        try:
+            fields, owners = flatten_unit(elem)
+            # First get the MAT18 to create the provincial ID
+            mat18 = generate_mat18_from_fields(fields)
+            id = muni_code + mat18
+
+            if id not in existing_ids:
+                existing_ids.add(id)
+                unit_data = new_unit_data(muni_code, year_entered, mat18)
+
+                if not parquet_folder and not delta:
+                    # Checked against the database in batches before doing any more work
+                    unchecked_units.append((fields, owners, unit_data))
+                elif not delta:
+                    current_units.append(parse_unit_fields(fields, owners, unit_data))
+                else:
+                    # Before parsing its other fields, so that a unit failing to parse is kept instead of deleted.
+                    # The units of an aggregated MURB are kept as part of it, it replaced them.
+                    missing_ids.discard(aggregated_murb_ids.get(id, id))
+                    unit = parse_unit_fields(fields, owners, unit_data)
+                    # The new units without street numbers aren't kept, and the stored ones losing them are updated
+                    # to be deleted, see delete_units_without_street_numbers
+                    has_street_numbers = unit.num_adr_inf is not None or unit.num_adr_sup is not None
+                    if id not in aggregated_murb_ids and stored_hashes.get(id) != unit.content_hash \
+                            and (has_street_numbers or id in stored_hashes):
+                        current_units.append(unit)
+        except:
+            unidentified_units |= delta and id is None
+            print(traceback.format_exc())
+            print(f"{xml_file} - unit {num_units} of chunk {chunk.start}")
+            print(etree.tostring(elem, pretty_print=True).decode())
+
+        if len(unchecked_units) >= 1000:
+            current_units += parse_new_units(unchecked_units, xml_file)
+            unchecked_units = []
+
+        # Commit latest writes
+        if len(current_units) >= 1000 and not parquet_folder:
+            save_units(task, current_units, num_units)
+            num_created += len(current_units)
+            current_units = []
+
+    if parquet_folder:
+        if current_units:
+            path = parquet_folder / muni_code / f"{Path(xml_file.name).stem}-{chunk.start:012d}.parquet"
+            write_parquet(EvalUnit, current_units, path)
+        return len(current_units), task['size'], None
+
+    # Flush out the chunk's units
+    current_units += parse_new_units(unchecked_units, xml_file)
+    save_units(task, current_units, num_units, done=True)
+    num_created += len(current_units)
+
+    if delta:
+        # A chunk without units doesn't know its municipality, and can't tell what is missing
+        if existing_ids is None:
+            return num_created, task['size'], None
+        # Nor can a chunk with a unit it couldn't identify, which may be any of the missing ones
+        return num_created, task['size'], (muni_code, None if unidentified_units else missing_ids)
+    return num_created, task['size'], None
+
+
+def iter_units_lxml(xml_file, start=0, stop=None):
+    """
+    Yields the municipal code and year entered of the XML with each of the RLUEx elements starting
+    in its byte range, read with lxml's pull parser fed the XML's header then the bytes of the range.
+    The units are cleared from the tree once processed, so memory stays flat whatever the file size.
+    """
+    # {*} matches the tags whether the document declares a namespace or not
+    parser = etree.XMLPullParser(events=('end',), tag=('{*}RLM01A', '{*}RLM02A', '{*}RLUEx'))
+
+    with xml_file.open('rb') as f:
+        # The chunks after the first one need the header for the root tags and the municipality
+        if start > 0:
+            parser.feed(read_header(f))
+            f.seek(start)
+
+        while True:
+            to_read = READ_BLOCK_SIZE if stop is None else min(READ_BLOCK_SIZE, stop - f.tell())
+            block = f.read(to_read) if to_read > 0 else b''
+            if block:
+                parser.feed(block)
+            elif stop is None:
+                # Raises if the end of the file is malformed. The other chunks end in the middle of the document.
+                parser.close()
+
+            for _, elem in parser.read_events():
+                tag = local_tag(elem.tag)
+
+                # The municipal code and year entered come first and apply to the whole document
+                if tag == 'RLM01A':
+                    muni_code = elem.text
+                elif tag == 'RLM02A':
+                    year_entered = elem.text
+                elif tag == 'RLUEx':
+                    yield muni_code, year_entered, elem
+
+                # Free the processed elements, including the references the root keeps to them
+                elem.clear(keep_tail=True)
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+
+            if not block:
+                break
+
+
+def save_units(task, units, num_units, done=False):
+    """
+    Commits the units with the progress of the task's chunk. For a delta, the changed units
+    are updated with their new roll values instead, and the chunk isn't recorded.
+    """
+    if task.get('delta'):
+        copy_objects(EvalUnit, units, update_fields=ROLL_FIELDS)
+        return
+
+    with transaction.atomic():
+        copy_objects(EvalUnit, units)
+        task['chunk'].checkpoint(num_units, done=done)
 
 
-def extract_field_or_none(unit_xml, field_id, type=None):
-    if field := unit_xml.find(field_id):
-        field = field.text
-        if type:
-            return type(field)
-        return field
-    # else
-    return None
+def get_existing_unit_ids(muni_code):
+    """
+    IDs of the municipality's units already in the database, loaded once per file by the pulldom
+    parser so that re-imports skip them without querying for each unit.
+    """
+    # Read from the (muni_code, id) index only
+    ids = EvalUnit.objects.filter(muni_code=muni_code).values_list('id', flat=True)
+    return set(ids.iterator(chunk_size=10_000))
 
-def extract_field_or_empty_string(unit_xml, field_id):
-    if field := unit_xml.find(field_id):
-        return field.text
-    return ''
-            
 
-def get_address_components_and_resolve(rl0101x, unit_data):
+def parse_new_units(unchecked_units, xml_file):
     """
-    Add address subfields and fully resolved address to unit_data
-    I opted not to include the unresolved way link, type and cardinal points
-    as they were not very interesting by themselves, instead keeping
-    a nicely formatted address and street name fields containing the info
+    Units of the (fields, owners, unit_data) read by flatten_unit which aren't in the database yet,
+    with one query for the whole batch so that re-imports skip them without querying for each unit.
+    A chunk only checks its own units, instead of loading all the IDs of its municipality.
     """
-    address_components = []
+    ids = [unit_data['id'] for _, _, unit_data in unchecked_units]
+    existing_ids = set(EvalUnit.objects.filter(id__in=ids).values_list('id', flat=True))
 
-    if num_adr_inf := rl0101x.find('rl0101ax'):
-        unit_data['num_adr_inf'] = num_adr_inf.text
-        address_components.append(num_adr_inf.text)
-    else:
-        unit_data['num_adr_inf'] = None
-    
-    if num_adr_inf_2 := rl0101x.find('rl0101bx'):
-        unit_data['num_adr_inf_2'] = num_adr_inf_2.text
-        address_components.append(num_adr_inf_2.text)
-    else:
-        unit_data['num_adr_inf_2'] = None
+    units = []
+    for fields, owners, unit_data in unchecked_units:
+        if unit_data['id'] in existing_ids:
+            continue
+        try:
+            units.append(parse_unit_fields(fields, owners, unit_data))
+        except:
+            print(traceback.format_exc())
+            print(f"{xml_file} - unit {unit_data['id']}")
+    return units
 
-    if num_adr_sup := rl0101x.find('rl0101cx'):
-        unit_data['num_adr_sup'] = num_adr_sup.text
-        address_components.append('-')
-        address_components.append(num_adr_sup.text)
-    else:
-        unit_data['num_adr_sup'] = None
 
-    if num_adr_sup_2 := rl0101x.find('rl0101dx'):
-        unit_data['num_adr_sup_2'] = num_adr_sup_2.text
-        address_components.append(num_adr_sup_2.text)
-    else:
-        unit_data['num_adr_sup_2'] = None
+def get_stored_unit_hashes(muni_code):
+    """Content hashes of the municipality's units in the database, by ID, compared by a delta"""
+    hashes = EvalUnit.objects.filter(muni_code=muni_code).values_list('id', 'content_hash')
+    return dict(hashes.iterator(chunk_size=10_000))
 
-    # Process the street name
-    street_components = []
-    if way_type := rl0101x.find('rl0101ex'):
-        # Resolve the way type
-        way_type = WAY_TYPES[way_type.text]
-        address_components.append(way_type)
-        street_components.append(way_type)
-
-    if way_link := rl0101x.find('rl0101fx'):
-        way_link = WAY_LINKS[way_link.text]
-        address_components.append(way_link)
-        street_components.append(way_link)
-
-    if street_name := rl0101x.find('rl0101gx'):
-        street_name = street_name.text
-        address_components.append(street_name)
-        street_components.append(street_name)
-
-    if cardinal_pt := rl0101x.find('rl0101hx'):
-        cardinal_pt = CARDINAL_POINTS[cardinal_pt.text]
-        address_components.append(cardinal_pt)
-        street_components.append(cardinal_pt)
 
-    unit_data['street_name'] = " ".join(street_components).title()
-    unit_data['address'] = " ".join(address_components).title()
+def get_aggregated_murb_ids(muni_code):
+    """
+    IDs of the aggregated MURBs replacing the municipality's disaggregated units, by the IDs
+    of these units, see aggregate_murbs. Empty if the MURBs were not aggregated yet.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT to_regclass(%s)", [MURB_DISAG_TABLE])
+        if cursor.fetchone()[0] is None:
+            return {}
+        cursor.execute(f"SELECT id, agg_id FROM {MURB_DISAG_TABLE} WHERE muni_code = %s", [muni_code])
+        return dict(cursor.fetchall())
+
+
+def new_unit_data(muni_code, year_entered, mat18):
+    """Values of a unit given by its XML's header and its MAT18, completed by the unit parsers"""
+    return {
+        'id': muni_code + mat18,
+        'muni': MUNICIPALITIES[f'RL{muni_code}'],
+        'muni_code': muni_code,
+        'year': year_entered,
+        'mat18': mat18,
+    }
+
+
+def unit_content_hash(unit_data):
+    """
+    Hash of the values read from the roll for a unit, the same as long as they don't change.
+    The year is left out, otherwise every unit of a newer roll would be different.
+    """
+    values = {key: value for key, value in unit_data.items() if key != 'year'}
+    return md5(json.dumps(values, sort_keys=True, default=str).encode()).hexdigest()
 
 
-def get_apt_num_components(rl0101x, unit_data):
-    apt_num_components = []
+def local_tag(tag):
+    """Tag name without its namespace, if any"""
+    return tag.rpartition('}')[2]
 
-    if apt_num_1 := rl0101x.find('rl0101ix'):
-        unit_data['apt_num_1'] = apt_num_1.text
-        apt_num_components.append(apt_num_1.text)
-    else:
-        unit_data['apt_num_1'] = None
 
-    if apt_num_2 := rl0101x.find('rl0101jx'):
-        unit_data['apt_num_2'] = apt_num_2.text
-        apt_num_components.append(apt_num_2.text)
-    else:
-        unit_data['apt_num_2'] = None
+def flatten_unit(unit):
+    """
+    Single pass over a RLUEx element. Returns the text of its leaf elements keyed by lowercased tag name,
+    keeping the first occurrence, and the (date, type) of each owner signup (RL0201x), the only repeated
+    group we use. Empty elements read as empty strings.
+    """
+    fields = {}
+    owners = []
+    for elem in unit.iter():
+        # Skip comments and processing instructions
+        if not isinstance(elem.tag, str):
+            continue
+        tag = local_tag(elem.tag).lower()
+        if tag == 'rl0201x':
+            owner = {local_tag(child.tag).lower(): child.text for child in elem if isinstance(child.tag, str)}
+            owners.append((owner.get('rl0201gx'), owner.get('rl0201hx')))
+        elif len(elem) == 0:
+            fields.setdefault(tag, elem.text or '')
+    return fields, owners
+
+
+def flatten_soup(unit_xml):
+    """Same as flatten_unit, for a unit parsed by BeautifulSoup"""
+    fields = {}
+    owners = []
+    for tag in unit_xml.find_all(True):
+        if tag.name == 'rl0201x':
+            owners.append((tag.find('rl0201gx').text, tag.find('rl0201hx').text))
+        elif tag.find(True) is None:
+            fields.setdefault(tag.name, tag.text)
+    return fields, owners
+
+
+def generate_mat18_from_fields(fields):
+    # rl0104a to c are guaranteed to be present, the optional others are padded with zeros
+    return fields['rl0104a'] + fields['rl0104b'] + fields['rl0104c'] \
+        + fields.get('rl0104d', '0') + fields.get('rl0104e', '000') + fields.get('rl0104f', '0000')
+
+
+def parse_unit_fields(fields, owners, unit_data: dict):
+    """
+    Puts the unit's values into unit_data, from the fields and owners read by flatten_unit,
+    and returns the unit. The columns read from a single field are given by the roll schema.
+    """
+    extract_fields(fields, unit_data)
 
-    if apt_num_components:
-        unit_data['apt_num'] = " ".join(apt_num_components)
-    else:
-        unit_data['apt_num'] = None
+    # RL0101: Unit Identification Fields
+    resolve_address(fields, unit_data)
 
+    # Keep the apt number separate from the street address
+    # We can use this to merge MURBs that are disaggregated into indiviudal units
+    apt_num_components = [apt_num for apt_num in [unit_data['apt_num_1'], unit_data['apt_num_2']] if apt_num is not None]
+    unit_data['apt_num'] = " ".join(apt_num_components) if apt_num_components else None
 
-def generate_mat18(rl0104):
-    mat18 = ''
-    # rl0104a to c are guaranteed to be present
-    mat18 += rl0104.find('rl0104a').text
-    mat18 += rl0104.find('rl0104b').text
-    mat18 += rl0104.find('rl0104c').text
+    # RL0201 - Owner Info, take only the latest signup to the assessment roll
+    # Most of it is redacted but we can know if the owner is a physical or moral person
+    max_date = datetime.strptime('1500-01-01', '%Y-%m-%d')
+    for owner_date_str, owner_type_code in owners:
+        date_time = datetime.strptime(owner_date_str, '%Y-%m-%d')
+        if date_time > max_date:
+            max_date = date_time
+            unit_data['owner_date'] = owner_date_str
+            unit_data['owner_type'] = 'physical' if owner_type_code == '1' else 'moral'
 
-    # These 3 are optional, if not present, pad with zeros
-    if chiffre_auto_verif := rl0104.find('rl0104d'):
-        mat18 += chiffre_auto_verif.text
-    else:
-        mat18 += '0'
+    unit_data['content_hash'] = unit_content_hash(unit_data)
+    return EvalUnit(**unit_data)
 
-    if num_bat := rl0104.find('rl0104e'):
-        mat18 += num_bat.text
-    else:
-        mat18 += '000'
 
-    if num_local := rl0104.find('rl0104f'):
-        mat18 += num_local.text
-    else:
-        mat18 += '0000'
+def extract_fields(fields, unit_data):
+    """Puts the values of the columns read from a single field into unit_data, None if the field is missing"""
+    for code, name, convert, lookup in FIELD_EXTRACTORS:
+        value = fields.get(code)
+        if value is not None:
+            if convert is not None:
+                value = convert(value)
+            # Resolve the codes to human readable values
+            elif lookup is not None and value:
+                if value in lookup:
+                    value = lookup[value]
+                else:
+                    print(f'\t\tWARNING: Unknown {name} {value}')
+        unit_data[name] = value
+
+
+def resolve_address(fields, unit_data):
+    """
+    Add the fully resolved address and street name to unit_data, from the street numbers
+    already in it and the street name components.
+    I opted not to include the unresolved way link, type and cardinal points
+    as they were not very interesting by themselves, instead keeping
+    a nicely formatted address and street name fields containing the info
+    """
+    address_components = []
+    for num in [unit_data['num_adr_inf'], unit_data['num_adr_inf_2']]:
+        if num is not None:
+            address_components.append(num)
+    if unit_data['num_adr_sup'] is not None:
+        address_components.append('-')
+        address_components.append(unit_data['num_adr_sup'])
+    if unit_data['num_adr_sup_2'] is not None:
+        address_components.append(unit_data['num_adr_sup_2'])
 
-    return mat18
+    # Process the street name
+    street_components = []
+    for code, values in STREET_COMPONENTS:
+        if (component := fields.get(code)) is not None:
+            if values is not None:
+                component = values[component]
+            address_components.append(component)
+            street_components.append(component)
 
+    unit_data['street_name'] = " ".join(street_components).title()
+    unit_data['address'] = " ".join(address_components).title()
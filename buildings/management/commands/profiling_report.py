@@ -0,0 +1,76 @@
+import json
+import statistics
+from pathlib import Path
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class Command(BaseCommand):
+    help = "Summarize the request profiling log (see REQUEST_PROFILING) per URL name."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-l",
+            "--log-file",
+            type=Path,
+            default=settings.REQUEST_PROFILING_LOG,
+            help="Profiling log to read, the rotated files next to it are read too",
+        )
+
+        parser.add_argument(
+            "-u",
+            "--url-name",
+            type=str,
+            default=None,
+            help="Only report on this URL name, e.g. buildings:survey_v1, and show its slowest queries",
+        )
+
+    def handle(self, *args, **options):
+        log_file: Path = options["log_file"]
+        url_name_filter = options["url_name"]
+
+        # The rotating handler moves older entries to profiling.log.1, .2, ...
+        files = sorted(log_file.parent.glob(f"{log_file.name}*"))
+        if not files:
+            raise CommandError(f"No profiling log found at {log_file}")
+
+        by_url_name = defaultdict(list)
+        for file in files:
+            with open(file) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if url_name_filter is None or entry["url_name"] == url_name_filter:
+                        by_url_name[entry["url_name"]].append(entry)
+
+        self.stdout.write(
+            f"{'URL name':<30} {'requests':>8} {'p50 ms':>8} {'p95 ms':>8} {'SQL ms':>8} {'queries':>8} {'max q.':>8}"
+        )
+        for url_name, entries in sorted(by_url_name.items(), key=lambda item: str(item[0])):
+            total_ms = [e["total_ms"] for e in entries]
+            self.stdout.write(
+                f"{str(url_name):<30} {len(entries):>8} "
+                f"{percentile(total_ms, 50):>8.1f} {percentile(total_ms, 95):>8.1f} "
+                f"{statistics.mean(e['sql_ms'] for e in entries):>8.1f} "
+                f"{statistics.mean(e['sql_count'] for e in entries):>8.1f} "
+                f"{max(e['sql_count'] for e in entries):>8}"
+            )
+
+        if url_name_filter and by_url_name:
+            slowest = sorted(
+                (query for e in by_url_name[url_name_filter] for query in e["slowest"]),
+                key=lambda query: query["ms"],
+                reverse=True,
+            )
+            self.stdout.write(f"\nSlowest queries of {url_name_filter}:")
+            for query in slowest[:10]:
+                self.stdout.write(f"{query['ms']:>10.1f} ms  {query['sql']}")
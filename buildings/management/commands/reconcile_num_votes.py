@@ -0,0 +1,47 @@
+from datetime import datetime
+
+from django.db import connection, transaction
+from django.core.management.base import BaseCommand
+
+from buildings.models import EvalUnit, SurveyQueueEntry, Vote
+
+EVALUNIT_TABLE = EvalUnit.objects.model._meta.db_table
+SURVEY_QUEUE_TABLE = SurveyQueueEntry.objects.model._meta.db_table
+VOTE_TABLE = Vote.objects.model._meta.db_table
+
+# Only rows whose count drifted are written
+SQL_RECONCILE_EVALUNITS = f"""
+    UPDATE {EVALUNIT_TABLE} e SET num_votes = COALESCE(v.num_votes, 0)
+    FROM {EVALUNIT_TABLE} e2 
+    LEFT OUTER JOIN (
+        SELECT eval_unit_id, COUNT(*) AS num_votes FROM {VOTE_TABLE} GROUP BY eval_unit_id
+    ) v ON v.eval_unit_id = e2.id
+    WHERE e.id = e2.id AND e.num_votes IS DISTINCT FROM COALESCE(v.num_votes, 0);
+"""
+
+SQL_RECONCILE_SURVEY_QUEUE = f"""
+    UPDATE {SURVEY_QUEUE_TABLE} q SET num_votes = e.num_votes
+    FROM {EVALUNIT_TABLE} e
+    WHERE e.id = q.eval_unit_id AND q.num_votes != e.num_votes;
+"""
+
+
+class Command(BaseCommand):
+    help = "Recompute the denormalized vote counts of the evaluation units and the survey queue from the votes table."
+
+    def handle(self, *args, **options):
+        t0 = datetime.now()
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            # Prevent votes from being added while we count them
+            cursor.execute(f"LOCK TABLE {VOTE_TABLE} IN SHARE MODE;")
+
+            cursor.execute(SQL_RECONCILE_EVALUNITS)
+            num_units = cursor.rowcount
+
+            cursor.execute(SQL_RECONCILE_SURVEY_QUEUE)
+            num_queued = cursor.rowcount
+
+        self.stdout.write(
+            self.style.SUCCESS(f'Fixed the vote count of {num_units} units and {num_queued} queued units in {datetime.now() - t0} s')
+        )
@@ -0,0 +1,81 @@
+from tqdm import tqdm
+from datetime import datetime
+
+from django.db import connection
+from django.core.management.base import BaseCommand, CommandError
+
+from buildings.models import EvalUnit
+from buildings.utils.utility import sizeof_fmt
+from buildings.utils.tiles import MAX_ZOOM, get_tile, tiles_in_bbox
+
+EVALUNIT_TABLE = EvalUnit.objects.model._meta.db_table
+
+# Bounding box of the municipality's evaluation units and their lots
+SQL_MUNI_BBOX = f"""
+    SELECT ST_XMin(b), ST_YMin(b), ST_XMax(b), ST_YMax(b) FROM (
+        SELECT ST_Extent(COALESCE(l.geom, e.point)) AS b
+        FROM {EVALUNIT_TABLE} e LEFT JOIN lots l ON l.gid = e.lot_id
+        WHERE e.muni_code = %(muni)s OR e.muni ILIKE %(muni)s
+    ) AS extent;
+"""
+
+
+class Command(BaseCommand):
+    help = "Generate the vector tiles covering a municipality ahead of time, so they are served from the disk cache."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "muni",
+            type=str,
+            help="Name or code of the municipality",
+        )
+
+        parser.add_argument(
+            "--min-zoom",
+            type=int,
+            default=11,
+            help="Lowest zoom level to generate",
+        )
+
+        parser.add_argument(
+            "--max-zoom",
+            type=int,
+            default=16,
+            help="Highest zoom level to generate",
+        )
+
+        parser.add_argument(
+            "-f",
+            "--force",
+            action="store_true",
+            default=False,
+            help="Regenerate the tiles already in the cache",
+        )
+
+    def handle(self, *args, **options):
+        min_zoom = options["min_zoom"]
+        max_zoom = options["max_zoom"]
+
+        if not 0 <= min_zoom <= max_zoom <= MAX_ZOOM:
+            raise CommandError(f"Zoom levels must be between 0 and {MAX_ZOOM}, with --min-zoom <= --max-zoom")
+
+        with connection.cursor() as cursor:
+            cursor.execute(SQL_MUNI_BBOX, {"muni": options["muni"]})
+            bbox = cursor.fetchone()
+
+        if bbox[0] is None:
+            raise CommandError(f"No evaluation units found for municipality {options['muni']}")
+
+        t0 = datetime.now()
+        tiles = [tile for z in range(min_zoom, max_zoom + 1) for tile in tiles_in_bbox(*bbox, z)]
+
+        total_size = 0
+        for z, x, y in tqdm(tiles, desc="Seeding tiles"):
+            mvt, _ = get_tile(z, x, y, refresh=options["force"])
+            total_size += len(mvt)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Seeded {len(tiles)} tiles ({sizeof_fmt(total_size)}) for zooms {min_zoom}-{max_zoom} in {datetime.now() - t0}s"
+            )
+        )
@@ -84,6 +84,8 @@ class Command(BaseCommand):
                         delete_data=delete_data, 
                         num_workers=num_workers, 
                         test=test)
+
+            call_command('build_survey_queue')
             
             self.stdout.write(
                 self.style.SUCCESS(f'\nFinished setting up DB in {datetime.now() - t0} s')
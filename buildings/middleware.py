@@ -0,0 +1,89 @@
+import json
+import time
+import heapq
+import logging
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+from django.core.exceptions import MiddlewareNotUsed
+
+# Written as one JSON object per line to the rotating log configured in settings
+log = logging.getLogger("buildings.profiling")
+
+NUM_SLOWEST_QUERIES = 5
+MAX_SQL_LENGTH = 500
+
+
+class QueryRecorder:
+    """Database execute wrapper counting and timing the queries, keeping the slowest ones"""
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.slowest = []
+
+    def __call__(self, execute, sql, params, many, context):
+        t0 = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - t0
+            self.count += 1
+            self.total_time += duration
+            # Min heap, the fastest of the slowest queries gets popped
+            entry = (duration, self.count, sql)
+            if len(self.slowest) < NUM_SLOWEST_QUERIES:
+                heapq.heappush(self.slowest, entry)
+            else:
+                heapq.heappushpop(self.slowest, entry)
+
+    def get_slowest(self):
+        return [
+            {"ms": round(duration * 1000, 2), "sql": sql[:MAX_SQL_LENGTH]}
+            for duration, _, sql in sorted(self.slowest, reverse=True)
+        ]
+
+
+class RequestProfilingMiddleware:
+    """
+    Opt-in with REQUEST_PROFILING=True. Records the wall time, number of SQL queries,
+    SQL time and slowest statements of each request, keyed by URL name (e.g. buildings:survey_v1).
+    They are sent back in a Server-Timing header and logged to REQUEST_PROFILING_LOG.
+    """
+
+    def __init__(self, get_response):
+        if not settings.REQUEST_PROFILING:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = QueryRecorder()
+        t0 = time.perf_counter()
+
+        with connection.execute_wrapper(recorder):
+            response = self.get_response(request)
+
+        total_ms = (time.perf_counter() - t0) * 1000
+        sql_ms = recorder.total_time * 1000
+        url_name = request.resolver_match.view_name if request.resolver_match else None
+
+        response["Server-Timing"] = ", ".join([
+            f"total;dur={total_ms:.1f}",
+            f'sql;dur={sql_ms:.1f};desc="{recorder.count} queries"',
+            f"app;dur={total_ms - sql_ms:.1f}",
+        ])
+
+        log.info(json.dumps({
+            "time": timezone.now().isoformat(),
+            "url_name": url_name,
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            "total_ms": round(total_ms, 2),
+            "sql_count": recorder.count,
+            "sql_ms": round(sql_ms, 2),
+            "slowest": recorder.get_slowest(),
+        }))
+
+        return response
@@ -0,0 +1,41 @@
+# Generated by Django 4.1.7 on 2026-10-17 22:56
+
+import buildings.models.models
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildings', '0004_rename_lot_id_evalunit_lot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SurveyQueueEntry',
+            fields=[
+                ('eval_unit', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='buildings.evalunit')),
+                ('num_votes', models.IntegerField(default=0)),
+                ('rand', models.FloatField(default=buildings.models.models.random_sort_key)),
+            ],
+            options={
+                'db_table': 'survey_queue',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='surveyqueueentry',
+            index=models.Index(fields=['num_votes', 'rand'], name='idx_survey_queue_bucket'),
+        ),
+        # Fill the queue with the existing HLM-linked eval units and their votes
+        migrations.RunSQL(
+            sql="""
+                INSERT INTO survey_queue (eval_unit_id, num_votes, rand)
+                SELECT e.id, COUNT(v.id), random() FROM evalunits e 
+                JOIN (SELECT DISTINCT eval_unit_id FROM hlms) h ON h.eval_unit_id = e.id 
+                LEFT OUTER JOIN buildings_vote v ON v.eval_unit_id = e.id 
+                GROUP BY e.id;
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.1.7 on 2026-10-17 22:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildings', '0005_survey_queue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='evalunit',
+            name='num_votes',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='evalunit',
+            index=models.Index(fields=['num_votes'], name='idx_num_votes'),
+        ),
+        # Backfill the vote counts of the units that already have votes
+        migrations.RunSQL(
+            sql="""
+                UPDATE evalunits e SET num_votes = v.num_votes
+                FROM (SELECT eval_unit_id, COUNT(*) AS num_votes FROM buildings_vote GROUP BY eval_unit_id) v
+                WHERE v.eval_unit_id = e.id;
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.1.7 on 2026-10-17 22:58
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildings', '0006_evalunit_num_votes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SurveyLease',
+            fields=[
+                ('eval_unit', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='buildings.evalunit')),
+                ('date_added', models.DateTimeField(default=django.utils.timezone.now, verbose_name='date added')),
+                ('date_expires', models.DateTimeField(verbose_name='date expires')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'survey_leases',
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.1.7 on 2026-10-17 23:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildings', '0007_survey_leases'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='evalunitlot',
+            name='geojson',
+            field=models.TextField(null=True),
+        ),
+        # Precompute the GeoJSON of the lots already imported, same as SQL_LOT_GEOJSON at the time
+        migrations.RunSQL(
+            sql="""
+                UPDATE lots SET geojson = json_build_object(
+                    'type', 'FeatureCollection',
+                    'crs', json_build_object('type', 'name', 'properties', json_build_object('name', 'EPSG:4326')),
+                    'features', json_build_array(json_build_object(
+                        'type', 'Feature', 'properties', json_build_object('gid', gid), 'geometry', ST_AsGeoJSON(geom, 6)::json
+                    ))
+                )::text;
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.1.7 on 2026-10-17 23:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildings', '0008_evalunitlot_geojson'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='evalunit',
+            name='idx_num_votes',
+        ),
+        migrations.AddIndex(
+            model_name='evalunit',
+            index=models.Index(fields=['num_votes', 'id'], name='idx_num_votes_id'),
+        ),
+        migrations.AddIndex(
+            model_name='evalunit',
+            index=models.Index(fields=['address', 'id'], name='idx_address_id'),
+        ),
+        migrations.AddIndex(
+            model_name='evalunit',
+            index=models.Index(fields=['cubf', 'id'], name='idx_cubf_id'),
+        ),
+        migrations.AddIndex(
+            model_name='evalunit',
+            index=models.Index(fields=['date_added', 'id'], name='idx_date_added_id'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 4.1.7 on 2026-10-17 23:07
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+import django.db.models.functions.text
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildings', '0009_evalunit_keyset_indexes'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddIndex(
+            model_name='evalunit',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('address'), name='gin_trgm_ops'), name='idx_address_trgm'),
+        ),
+        migrations.AddIndex(
+            model_name='evalunit',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('street_name'), name='gin_trgm_ops'), name='idx_street_name_trgm'),
+        ),
+        migrations.AddIndex(
+            model_name='evalunit',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('muni'), name='gin_trgm_ops'), name='idx_muni_trgm'),
+        ),
+        # Generated column for the free text search, not on the model since Django 4.1 has no generated fields.
+        # 'simple' keeps the street names as they are, without stemming or stop words.
+        migrations.RunSQL(
+            sql="""
+                ALTER TABLE evalunits ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (
+                    to_tsvector('simple',
+                        coalesce(address, '') || ' ' || coalesce(street_name, '') || ' ' ||
+                        coalesce(muni, '') || ' ' || coalesce(arrond, '')
+                    )
+                ) STORED;
+                CREATE INDEX idx_search_vector ON evalunits USING GIN (search_vector);
+            """,
+            reverse_sql="""
+                DROP INDEX idx_search_vector;
+                ALTER TABLE evalunits DROP COLUMN search_vector;
+            """,
+        ),
+    ]
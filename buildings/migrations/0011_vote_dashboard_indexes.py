@@ -0,0 +1,21 @@
+# Generated by Django 4.1.7 on 2026-10-17 23:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildings', '0010_evalunit_search'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='vote',
+            index=models.Index(fields=['-date_modified'], name='idx_vote_date_modified'),
+        ),
+        migrations.AddIndex(
+            model_name='vote',
+            index=models.Index(fields=['user', '-date_modified'], name='idx_vote_user_date_modified'),
+        ),
+    ]
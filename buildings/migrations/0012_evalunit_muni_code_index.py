@@ -0,0 +1,17 @@
+# Generated by Django 4.1.7 on 2026-10-17 23:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildings', '0011_vote_dashboard_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='evalunit',
+            index=models.Index(fields=['muni_code', 'id'], name='idx_muni_code_id'),
+        ),
+    ]
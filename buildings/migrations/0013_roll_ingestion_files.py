@@ -0,0 +1,28 @@
+# Generated by Django 4.1.7 on 2026-10-17 23:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildings', '0012_evalunit_muni_code_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollIngestionFile',
+            fields=[
+                ('file_name', models.TextField(primary_key=True, serialize=False)),
+                ('size', models.BigIntegerField()),
+                ('mtime', models.FloatField()),
+                ('sha256', models.TextField()),
+                ('status', models.TextField(choices=[('pending', 'Pending'), ('in_progress', 'In Progress'), ('done', 'Done')], default='pending')),
+                ('num_units_done', models.IntegerField(default=0)),
+                ('date_modified', models.DateTimeField(auto_now=True, verbose_name='date modified')),
+            ],
+            options={
+                'db_table': 'roll_ingestion_files',
+            },
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.1.7 on 2026-10-17 23:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildings', '0013_roll_ingestion_files'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='rollingestionfile',
+            name='num_units_done',
+        ),
+        migrations.CreateModel(
+            name='RollIngestionChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.BigIntegerField()),
+                ('stop', models.BigIntegerField(null=True)),
+                ('num_units_done', models.IntegerField(default=0)),
+                ('done', models.BooleanField(default=False)),
+                ('file', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='buildings.rollingestionfile')),
+            ],
+            options={
+                'db_table': 'roll_ingestion_chunks',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='rollingestionchunk',
+            constraint=models.UniqueConstraint(fields=('file', 'start'), name='unique_roll_ingestion_chunk_start'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.7 on 2026-10-17 23:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildings', '0014_roll_ingestion_chunks'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='evalunit',
+            name='content_hash',
+            field=models.TextField(blank=True, null=True),
+        ),
+    ]
@@ -8,6 +8,10 @@ from .models import (
     EvalUnitStreetViewImage,
     HLMBuilding,
     NoBuildingFlag,
+    RollIngestionChunk,
+    RollIngestionFile,
+    SurveyLease,
+    SurveyQueueEntry,
     Vote,
     User
 )
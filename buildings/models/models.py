@@ -1,43 +1,100 @@
+import re
+import json
+import time
 import random
+import unicodedata
 import logging
 from hashlib import md5
+from pathlib import Path
+from datetime import timedelta
 
 from django.conf import settings
+from django.core.cache import cache
 from django.db.models.query import QuerySet
 from django.utils import timezone
-from django.db import connection
+from django.db import connection, transaction
 from django.contrib.gis.db import models
-from django.db.models import Q, Count, Avg, TextField
-from django.db.models.functions import Cast, Coalesce
+from django.db.models import F, Q, Count, Avg, BooleanField, TextField
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Coalesce, Upper
+from django.contrib.postgres.indexes import GinIndex, OpClass
 from django.utils.translation import gettext_lazy as _
 from django.contrib.auth.models import AbstractUser, BaseUserManager
 
 from buildings.utils.constants import CUBF_TO_NAME_MAP
+from buildings.utils.utility import file_sha256
 
 log = logging.getLogger(__name__)
 
 
+# The icontains lookups on these columns are served by the trigram indexes of EvalUnit
 STRING_QUERIES_TO_FILTER = {
     "q_address": "address__icontains",
-    "q_locality": "locality__icontains",
-    "q_region": "region__icontains",
-    "q_cubf": "cubf_str__icontains",
+    "q_locality": "muni__icontains",
+    "q_region": "arrond__icontains",
 }
 
+# Columns all_buildings can be sorted on: scalars, each with a (column, id) index for the keyset pagination
+SORTABLE_FIELDS = ("id", "address", "cubf", "date_added", "num_votes")
+
+# Free text search over the generated search_vector column, see migration 0010.
+# Each word of the search matches as a prefix.
+SQL_SEARCH_VECTOR_MATCH = "evalunits.search_vector @@ to_tsquery('simple', %s)"
+
+
+def _strip_accents(text):
+    return unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode().lower()
+
+
+# (code as text, words of the name) of each CUBF, to resolve CUBF searches without touching the DB
+_CUBF_SEARCH_INDEX = [
+    (str(code), _strip_accents(name).split()) for code, name in CUBF_TO_NAME_MAP.items()
+]
+
+
+def match_cubf_codes(text):
+    """
+    Returns the CUBF codes starting with the text if it's a number,
+    otherwise the ones whose name has a word starting with each word of the text.
+    Case and accent insensitive, e.g. 'maison mob' matches 1211: 'Maison mobile'.
+    """
+    text = text.strip()
+    if text.isdigit():
+        return [int(code) for code, _ in _CUBF_SEARCH_INDEX if code.startswith(text)]
+
+    prefixes = _strip_accents(text).split()
+    return [
+        int(code) for code, words in _CUBF_SEARCH_INDEX
+        if all(any(word.startswith(prefix) for word in words) for prefix in prefixes)
+    ]
+
+
+def to_prefix_tsquery(text):
+    """'123 rue Saint' -> '123:* & rue:* & saint:*', or None if there is nothing to search"""
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    return " & ".join(f"{word}:*" for word in words)
+
+
+# Units leased to a user are not handed out to anyone else, see SurveyLease
+SQL_NOT_LEASED = """NOT EXISTS (
+        SELECT 1 FROM survey_leases l WHERE l.eval_unit_id = {id} AND l.date_expires > now()
+    )"""
 
 SQL_RANDOM_UNVOTED_ID = f"""
     SELECT e.id FROM evalunits e 
-    JOIN hlms h ON h.eval_unit_id = e.id 
-    LEFT OUTER JOIN buildings_vote v ON v.eval_unit_id = e.id
-    WHERE v.id is null 
+    WHERE e.num_votes = 0 
+    AND EXISTS (SELECT 1 FROM hlms h WHERE h.eval_unit_id = e.id)
+    AND {SQL_NOT_LEASED.format(id='e.id')}
     ORDER BY random() LIMIT 1;
 """
 
 SQL_RANDOM_UNVOTED_ID_WITH_EXCLUDE = f"""
     SELECT e.id FROM evalunits e 
-    JOIN hlms h ON h.eval_unit_id = e.id 
-    LEFT OUTER JOIN buildings_vote v ON v.eval_unit_id = e.id
-    WHERE v.id is null 
+    WHERE e.num_votes = 0 
+    AND EXISTS (SELECT 1 FROM hlms h WHERE h.eval_unit_id = e.id)
+    AND {SQL_NOT_LEASED.format(id='e.id')}
     AND e.id != %s
     ORDER BY random() LIMIT 1;
 """
@@ -45,40 +102,170 @@ SQL_RANDOM_UNVOTED_ID_WITH_EXCLUDE = f"""
 # The limit parameter gives the number of eval units from which we will randomly pick
 # ideally we want it somewaht large (though not too much that the query is expensive)
 # but it can't be less than the number of eval units minus 1, else the query won't work
+# Walks the num_votes index in order, so we don't need to count the votes of every unit
 SQL_RANDOM_LEAST_VOTED_ID = f"""
     SELECT sub.id FROM 
         (SELECT e.id FROM evalunits e
-        JOIN hlms h ON h.eval_unit_id = e.id 
-        LEFT OUTER JOIN buildings_vote v ON (e.id = v.eval_unit_id) 
-        GROUP BY e.id 
-        ORDER BY COUNT(v.id) ASC LIMIT %s) 
+        WHERE EXISTS (SELECT 1 FROM hlms h WHERE h.eval_unit_id = e.id)
+        AND {SQL_NOT_LEASED.format(id='e.id')}
+        ORDER BY e.num_votes ASC LIMIT %s) 
     AS sub ORDER BY RANDOM() LIMIT 1;
 """
 
 SQL_RANDOM_LEAST_VOTED_ID_WITH_EXCLUDE = f"""
     SELECT sub.id FROM 
         (SELECT e.id FROM evalunits e 
-        JOIN hlms h ON h.eval_unit_id = e.id 
-        LEFT OUTER JOIN buildings_vote v ON (e.id = v.eval_unit_id) 
-        WHERE e.id != %s 
-        GROUP BY e.id ORDER BY COUNT(v.id) ASC limit %s) 
+        WHERE EXISTS (SELECT 1 FROM hlms h WHERE h.eval_unit_id = e.id)
+        AND {SQL_NOT_LEASED.format(id='e.id')}
+        AND e.id != %s 
+        ORDER BY e.num_votes ASC limit %s) 
     AS sub ORDER BY RANDOM() LIMIT 1;
 """
 
+# Picks a random eval unit from the least voted bucket of the survey queue.
+# Both lookups are seeks on the (num_votes, rand) index, so the cost does
+# not grow with the number of queued units. The second half of the union
+# wraps around when the random threshold lands after the last unit of the bucket.
+SQL_NEXT_QUEUED_ID = f"""
+    WITH bucket AS (
+        SELECT sq.num_votes FROM survey_queue sq 
+        WHERE sq.eval_unit_id IS DISTINCT FROM %(exclude_id)s
+        AND {SQL_NOT_LEASED.format(id='sq.eval_unit_id')}
+        ORDER BY sq.num_votes ASC LIMIT 1
+    ), pick AS (SELECT random() AS r)
+    (SELECT q.eval_unit_id FROM survey_queue q, bucket b, pick p
+    WHERE q.num_votes = b.num_votes AND q.rand >= p.r
+    AND q.eval_unit_id IS DISTINCT FROM %(exclude_id)s
+    AND {SQL_NOT_LEASED.format(id='q.eval_unit_id')}
+    ORDER BY q.rand ASC LIMIT 1)
+    UNION ALL
+    (SELECT q.eval_unit_id FROM survey_queue q, bucket b, pick p
+    WHERE q.num_votes = b.num_votes AND q.rand < p.r
+    AND q.eval_unit_id IS DISTINCT FROM %(exclude_id)s
+    AND {SQL_NOT_LEASED.format(id='q.eval_unit_id')}
+    ORDER BY q.rand DESC LIMIT 1)
+    LIMIT 1;
+"""
+
+# Fill the survey queue with all HLM-linked eval units and their current vote counts
+SQL_REBUILD_SURVEY_QUEUE = f"""
+    INSERT INTO survey_queue (eval_unit_id, num_votes, rand)
+    SELECT e.id, e.num_votes, random() FROM evalunits e 
+    WHERE EXISTS (SELECT 1 FROM hlms h WHERE h.eval_unit_id = e.id);
+"""
+
+# Number of units leased to a user at once, and how long they keep them
+SURVEY_LEASE_BATCH_SIZE = 10
+SURVEY_LEASE_DURATION = timedelta(minutes=30)
+
+# Lease a batch of units from the least voted buckets of the survey queue to a user.
+# Queue rows being leased by a concurrent request are skipped instead of waited on,
+# and the conflict clause only takes over expired leases, so a unit can't end up
+# leased to two users at the same time.
+SQL_LEASE_QUEUED_IDS = f"""
+    WITH candidates AS (
+        SELECT q.eval_unit_id FROM survey_queue q
+        WHERE q.eval_unit_id IS DISTINCT FROM %(exclude_id)s
+        AND {SQL_NOT_LEASED.format(id='q.eval_unit_id')}
+        ORDER BY q.num_votes ASC, q.rand ASC LIMIT %(batch_size)s
+        FOR UPDATE OF q SKIP LOCKED
+    )
+    INSERT INTO survey_leases (eval_unit_id, user_id, date_added, date_expires)
+    SELECT eval_unit_id, %(user_id)s, now(), now() + %(duration)s FROM candidates
+    ON CONFLICT (eval_unit_id) DO UPDATE SET 
+        user_id = EXCLUDED.user_id, date_added = EXCLUDED.date_added, date_expires = EXCLUDED.date_expires
+    WHERE survey_leases.date_expires <= now()
+    RETURNING eval_unit_id;
+"""
+
+# GeoJSON FeatureCollection of a lot, precomputed by process_lots from the already simplified polygon.
+# Coordinates are rounded to 6 decimals (~10cm), plenty for drawing on the streetview.
+SQL_LOT_GEOJSON = """
+    json_build_object(
+        'type', 'FeatureCollection',
+        'crs', json_build_object('type', 'name', 'properties', json_build_object('name', 'EPSG:4326')),
+        'features', json_build_array(json_build_object(
+            'type', 'Feature', 'properties', json_build_object('gid', gid), 'geometry', ST_AsGeoJSON(geom, 6)::json
+        ))
+    )::text
+"""
+
+# Cached lot GeoJSON never expires on its own, bump the format version when SQL_LOT_GEOJSON changes.
+# process_lots also bumps the generation stored in the cache when it reimports the lots.
+LOT_GEOJSON_CACHE_VERSION = 1
+LOT_GEOJSON_CACHE_GENERATION_KEY = "lot_geojson:generation"
+
+# The vote signals invalidate the dashboard stats, the timeout only bounds how stale
+# they can get if votes are changed behind Django's back (e.g. in SQL)
+DASHBOARD_STATS_CACHE_KEY = "dashboard:stats"
+DASHBOARD_STATS_CACHE_TIMEOUT = 60 * 60
+
+
+def _user_num_votes_cache_key(user_id):
+    return f"dashboard:user_num_votes:{user_id}"
+
+
+# Everything the survey page needs about an eval unit for a given user, in a single round trip.
+# Also takes the unit out of the user's leased batch, and peeks at the next unit of the batch.
+SQL_SURVEY_PAGE_DATA = f"""
+    WITH released AS (
+        DELETE FROM survey_leases WHERE user_id = %(user_id)s AND eval_unit_id = %(eval_unit_id)s
+    )
+    SELECT e.*,
+        (SELECT json_build_object(
+            'hlms', json_agg(json_build_object(
+                'street_num', h.street_num, 'street_name', h.street_name, 'num_dwellings', h.num_dwellings, 
+                'num_floors', h.num_floors, 'ivp', h.ivp, 'disrepair_state', h.disrepair_state
+            ) ORDER BY h.street_num),
+            'num_hlms', COUNT(*),
+            'total_dwellings', SUM(h.num_dwellings),
+            'avg_ivp', ROUND(AVG(h.ivp)::numeric, 1)
+        ) FROM hlms h WHERE h.eval_unit_id = e.id) AS hlm_data,
+        (SELECT json_build_object('vote', row_to_json(v), 'survey', row_to_json(s)) 
+        FROM buildings_vote v JOIN buildings_surveyv1 s ON s.vote_id = v.id 
+        WHERE v.eval_unit_id = e.id AND v.user_id = %(user_id)s 
+        ORDER BY v.id LIMIT 1) AS survey_vote_data,
+        (SELECT row_to_json(v) 
+        FROM buildings_vote v JOIN buildings_nobuildingflag n ON n.vote_id = v.id 
+        WHERE v.eval_unit_id = e.id AND v.user_id = %(user_id)s 
+        ORDER BY v.id LIMIT 1) AS no_building_vote_data,
+        (SELECT json_build_object(
+            'eval_unit', d.eval_unit_id, 'sv_pano', d.sv_pano, 'sv_heading', d.sv_heading, 'sv_pitch', d.sv_pitch, 
+            'sv_zoom', d.sv_zoom, 'marker_lat', d.marker_lat, 'marker_lng', d.marker_lng
+        ) FROM buildings_evalunitlatestviewdata d WHERE d.eval_unit_id = e.id 
+        ORDER BY d.user_id = %(user_id)s DESC, d.date_added DESC LIMIT 1) AS latest_view_data,
+        (SELECT sl.eval_unit_id FROM survey_leases sl 
+        WHERE sl.user_id = %(user_id)s AND sl.date_expires > now() AND sl.eval_unit_id != e.id 
+        ORDER BY sl.date_added, sl.eval_unit_id LIMIT 1) AS next_leased_id
+    FROM evalunits e WHERE e.id = %(eval_unit_id)s;
+"""
+
 SQL_RANDOM_ID = f"""
     SELECT sub.id FROM 
-        (SELECT e.id FROM evalunits e LIMIT %s) 
+        (SELECT e.id FROM evalunits e 
+        WHERE {SQL_NOT_LEASED.format(id='e.id')} LIMIT %s) 
     AS sub ORDER BY RANDOM() LIMIT 1;
 """
 
 SQL_RANDOM_ID_WITH_EXCLUDE = f"""
     SELECT sub.id FROM 
         (SELECT e.id FROM evalunits e 
-        WHERE e.id != %s LIMIT %s) 
+        WHERE e.id != %s AND {SQL_NOT_LEASED.format(id='e.id')} LIMIT %s) 
     AS sub ORDER BY RANDOM() LIMIT 1;
 """
 
 
+def _model_from_json(model, data):
+    """Build a model instance from one of its rows serialized with row_to_json"""
+    if data is None:
+        return None
+    fields = model._meta.concrete_fields
+    # JSON has no date type, to_python parses the timestamps back
+    return model.from_db(
+        None, [f.attname for f in fields], [f.to_python(data[f.attname]) for f in fields]
+    )
+
+
 class UserQuerySet(models.QuerySet):
 
     def get_top_n(self, n) -> QuerySet:
@@ -136,9 +323,6 @@ class EvalUnitQuerySet(models.QuerySet):
             else:
                 return self.all()
         
-        # Use this to filter on CUBF as a string
-        # .annotate(cubf_str=Cast('cubf', output_field=TextField()))
-        
         lookups = {}
 
         # Add all string field queries to lookups if present
@@ -155,20 +339,36 @@ class EvalUnitQuerySet(models.QuerySet):
             else:
                 lookups[f"num_votes__{op}"] = query["q_num_votes"]
 
+        # Resolved in Python from the CUBF names, so the filter can use the cubf index
+        cubf_codes = None
+        if "q_cubf" in query:
+            cubf_codes = match_cubf_codes(query["q_cubf"])
+            lookups["cubf__in"] = cubf_codes
+
         log.info(lookups)
         lookups = Q(**lookups) 
 
         # Can split up the query into multiple steps too and merge the results
-        result = self.annotate(num_votes=Count('vote')) \
-                    .annotate(cubf_str=Cast('cubf', output_field=TextField())) \
-                    .filter(lookups)
+        # num_votes is a denormalized column, no need to aggregate the votes here
+        result = self.filter(lookups)
+        if cubf_codes == []:
+            # No CUBF matches the search, an empty IN can't be compiled to SQL
+            result = result.none()
+
+        if "q" in query and (tsquery := to_prefix_tsquery(query["q"])):
+            result = result.filter(RawSQL(SQL_SEARCH_VECTOR_MATCH, [tsquery], output_field=BooleanField()))
+
         if ordering:
             result = result.order_by(ordering)
 
         return result
     
     def get_unvoted(self):
-        return EvalUnit.objects.filter(vote = None)
+        return EvalUnit.objects.filter(num_votes = 0)
+
+    def add_votes(self, eval_unit_id, num_votes=1):
+        """Update the denormalized vote count. Use a negative number to remove votes."""
+        return self.filter(id=eval_unit_id).update(num_votes=F('num_votes') + num_votes)
     
     
     def get_random_unvoted_id(self, exclude_id=None):
@@ -212,13 +412,62 @@ class EvalUnitQuerySet(models.QuerySet):
         # Should not be None if there is at least 1 model
         return res[0]
 
-    def get_next_unit_to_survey(self, exclude_id=None, id_only=False):
+    def get_survey_page_data(self, eval_unit_id, user_id):
         """
-        Tries to get a random unvoted building. 
-        If all buildings were voted, returns a random least voted building.
+        Loads the eval unit along with everything the survey page shows about it, in one query.
+        Returns None if the unit does not exist. Otherwise, the following are set on the unit:
+            - hlms: list of the associated HLMs, ordered by street number
+            - hlm_info: number of HLMs, total dwellings and average IVP, or None without HLMs
+            - previous_survey_vote, previous_survey: the user's previous SurveyV1 vote for this unit
+            - previous_no_building_vote: the user's previous no building vote for this unit
+            - latest_view_data: the user's latest saved view, or the latest saved by anyone else
+            - lot_geojson: the lot polygon as a GeoJSON FeatureCollection, from the cache if possible
+            - next_leased_id: the next unit of the batch leased to the user
+        """
+        from buildings.models.surveys import SurveyV1
+
+        eval_unit = next(iter(self.raw(SQL_SURVEY_PAGE_DATA, {
+            'eval_unit_id': eval_unit_id, 
+            'user_id': user_id
+        })), None)
+        if eval_unit is None:
+            return None
+
+        hlm_data = eval_unit.hlm_data
+        if hlm_data['num_hlms'] > 0:
+            eval_unit.hlms = hlm_data.pop('hlms')
+            eval_unit.hlm_info = hlm_data
+        else:
+            eval_unit.hlms = []
+            eval_unit.hlm_info = None
+
+        if survey_vote_data := eval_unit.survey_vote_data:
+            eval_unit.previous_survey_vote = _model_from_json(Vote, survey_vote_data['vote'])
+            eval_unit.previous_survey = _model_from_json(SurveyV1, survey_vote_data['survey'])
+        else:
+            eval_unit.previous_survey_vote = None
+            eval_unit.previous_survey = None
+
+        eval_unit.previous_no_building_vote = _model_from_json(Vote, eval_unit.no_building_vote_data)
+        eval_unit.lot_geojson = EvalUnitLot.objects.get_geojson(eval_unit.lot_id)
+        return eval_unit
+
+    def get_next_unit_to_survey(self, exclude_id=None, id_only=False, user=None):
+        """
+        If a user is given, takes the next building from the batch leased to them.
+        Otherwise tries to get a random building from the least voted bucket of the survey queue.
+        If the queue is empty (i.e. it was never built), falls back to a random 
+        unvoted building, then a random least voted building.
+        None of these hand out a building leased to another user.
         TODO: Currently modified to return only buildings with associated HLMs
         """
-        id = self.get_random_unvoted_id(exclude_id=exclude_id)
+        id = None
+        if user is not None:
+            id = SurveyLease.objects.get_next_id(user, exclude_id=exclude_id)
+        if id is None:
+            id = SurveyQueueEntry.objects.get_next_id(exclude_id=exclude_id)
+        if id is None:
+            id = self.get_random_unvoted_id(exclude_id=exclude_id)
         if id is None:
             id = self.get_random_least_voted_id(exclude_id=exclude_id)
         if id is None:
@@ -232,7 +481,43 @@ class EvalUnitQuerySet(models.QuerySet):
 
 
 
+class EvalUnitLotQuerySet(models.QuerySet):
+
+    @staticmethod
+    def _geojson_cache_key(gid):
+        # If the generation was evicted, start a new one rather than risk serving stale entries
+        generation = cache.get_or_set(LOT_GEOJSON_CACHE_GENERATION_KEY, time.time_ns, timeout=None)
+        return f"lot_geojson:v{LOT_GEOJSON_CACHE_VERSION}:{generation}:{gid}"
+
+    def get_geojson(self, gid):
+        """
+        Returns the precomputed GeoJSON of the lot, without touching its geometry.
+        Served from the cache after the first fetch.
+        """
+        if gid is None:
+            return None
+
+        key = self._geojson_cache_key(gid)
+        geojson = cache.get(key)
+        if geojson is None:
+            geojson = self.filter(gid=gid).values_list("geojson", flat=True).first()
+            if geojson is None:
+                return None
+            geojson = json.loads(geojson)
+            cache.set(key, geojson, timeout=None)
+        return geojson
+
+    def invalidate_geojson_cache(self):
+        """Orphans all the cached lot GeoJSON, e.g. after the lots were reimported"""
+        try:
+            cache.incr(LOT_GEOJSON_CACHE_GENERATION_KEY)
+        except ValueError:
+            cache.set(LOT_GEOJSON_CACHE_GENERATION_KEY, time.time_ns(), timeout=None)
+
+
 class EvalUnitLot(models.Model):
+    objects = EvalUnitLotQuerySet.as_manager()
+
     class Meta:
         db_table = 'lots'
         indexes = [
@@ -259,6 +544,8 @@ class EvalUnitLot(models.Model):
     dat_acqui = models.DateField(blank=True, null=True)
     dat_charg = models.DateField(blank=True, null=True)
     geom = models.MultiPolygonField(null=True, spatial_index=True)
+    # Precomputed GeoJSON of the simplified polygon, see SQL_LOT_GEOJSON
+    geojson = models.TextField(null=True)
 
 
     
@@ -321,6 +608,12 @@ class EvalUnit(models.Model):
     # (e.g. HLMs) associated with this evaluation unit.
     associated = models.JSONField(null=True, blank=True)
     date_added = models.DateTimeField('date added', default=timezone.now)
+    # Denormalized count of the votes on this unit, kept up to date by the Vote signals
+    # in buildings/signals.py. Use the reconcile_num_votes command to recompute it.
+    num_votes = models.IntegerField(default=0)
+    # Hash of the values read from the roll, except the year, compared by process_roll_xml --delta
+    # to only write the units that changed in a newer roll
+    content_hash = models.TextField(null=True, blank=True)
 
     # Override the objects attribute of the model
     # in order to implement custom search functionality
@@ -328,10 +621,21 @@ class EvalUnit(models.Model):
 
     class Meta:
         db_table = 'evalunits'
+        # The (field, id) indexes back the keyset pagination of the sortable columns of all_buildings,
+        # in both directions since btrees can be scanned backwards
+        indexes = [
+            models.Index(fields=["num_votes", "id"], name="idx_num_votes_id"),
+            models.Index(fields=["address", "id"], name="idx_address_id"),
+            models.Index(fields=["cubf", "id"], name="idx_cubf_id"),
+            models.Index(fields=["date_added", "id"], name="idx_date_added_id"),
+            # Loading the IDs of a municipality's units when re-importing the roll
+            models.Index(fields=["muni_code", "id"], name="idx_muni_code_id"),
+            # Trigram indexes on the same expression as the icontains lookups, i.e. UPPER(column)
+            GinIndex(OpClass(Upper("address"), name="gin_trgm_ops"), name="idx_address_trgm"),
+            GinIndex(OpClass(Upper("street_name"), name="gin_trgm_ops"), name="idx_street_name_trgm"),
+            GinIndex(OpClass(Upper("muni"), name="gin_trgm_ops"), name="idx_muni_trgm"),
+        ]
 
-    def num_votes(self):
-        return len(self.vote_set)
-    
     def cubf_name(self):
         if self.cubf in CUBF_TO_NAME_MAP:
             return CUBF_TO_NAME_MAP[self.cubf]
@@ -351,11 +655,7 @@ class EvalUnit(models.Model):
             return "address"
         
         field = field.lower()
-        if field == "address":
-            return "address"
-        if field == "num_votes":
-            return field
-        elif field in self.get_field_names():
+        if field in SORTABLE_FIELDS:
             return field
         # elif field == 'score':
         #     return 'avg_score'
@@ -414,6 +714,39 @@ class EvalUnitLatestViewData(models.Model):
 class VoteQuerySet(models.QuerySet):
     def get_latest(self, n=10):
         return self.order_by('-date_added')[:n]
+
+    def get_dashboard_stats(self):
+        """
+        Total number of votes and top 3 voters, cached until a vote is added or deleted.
+        """
+        stats = cache.get(DASHBOARD_STATS_CACHE_KEY)
+        if stats is None:
+            top_3_users = list(User.objects.get_top_n(3))
+            stats = {
+                "total_votes": self.count(),
+                "top_3_users": top_3_users,
+                "top_3_total_votes": sum(u.num_votes for u in top_3_users),
+            }
+            cache.set(DASHBOARD_STATS_CACHE_KEY, stats, timeout=DASHBOARD_STATS_CACHE_TIMEOUT)
+        return stats
+
+    def count_for_user(self, user_id):
+        """Number of votes of the user, cached until they add or delete one"""
+        key = _user_num_votes_cache_key(user_id)
+        num_votes = cache.get(key)
+        if num_votes is None:
+            num_votes = self.filter(user_id=user_id).count()
+            cache.set(key, num_votes, timeout=DASHBOARD_STATS_CACHE_TIMEOUT)
+        return num_votes
+
+    def invalidate_dashboard_stats(self, user_id):
+        """
+        Called by the vote signals. Waits for the transaction to commit, 
+        otherwise a concurrent request could cache the stats from before the vote.
+        """
+        transaction.on_commit(
+            lambda: cache.delete_many([DASHBOARD_STATS_CACHE_KEY, _user_num_votes_cache_key(user_id)])
+        )
     
 
 class Vote(models.Model):
@@ -428,10 +761,118 @@ class Vote(models.Model):
     date_modified  = models.DateTimeField('date modified', auto_now=True)
 
     objects = VoteQuerySet.as_manager()
+
+    class Meta:
+        # For the latest activity listings of the dashboard
+        indexes = [
+            models.Index(fields=["-date_modified"], name="idx_vote_date_modified"),
+            models.Index(fields=["user", "-date_modified"], name="idx_vote_user_date_modified"),
+        ]
+
     def __str__(self):
         return f'{self.user.username} voted on {self.eval_unit.address} on {self.date_added}'
 
 
+def random_sort_key():
+    return random.random()
+
+
+class SurveyQueueQuerySet(models.QuerySet):
+
+    def get_next_id(self, exclude_id=None):
+        with connection.cursor() as cursor:
+            cursor.execute(SQL_NEXT_QUEUED_ID, {'exclude_id': exclude_id})
+            res = cursor.fetchone()
+        if res is None:
+            return res
+        return res[0]
+
+    def add_votes(self, eval_unit_id, num_votes=1):
+        """Move the eval unit to another vote count bucket. Use a negative number to remove votes."""
+        return self.filter(eval_unit_id=eval_unit_id).update(num_votes=F('num_votes') + num_votes)
+
+    def rebuild(self):
+        """Empty the queue and refill it from the HLM-linked eval units and their votes."""
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f"TRUNCATE {self.model._meta.db_table};")
+            cursor.execute(SQL_REBUILD_SURVEY_QUEUE)
+            return cursor.rowcount
+
+
+class SurveyQueueEntry(models.Model):
+    """
+    Work queue of the eval units to survey, bucketed by their number of votes.
+    Lets us hand out the next unit to survey without scanning the votes table.
+    Vote counts are kept up to date by the Vote signals in buildings/signals.py.
+    """
+    class Meta:
+        db_table = 'survey_queue'
+        indexes = [
+            models.Index(fields=["num_votes", "rand"], name="idx_survey_queue_bucket"),
+        ]
+
+    eval_unit = models.OneToOneField(EvalUnit, on_delete=models.CASCADE, primary_key=True)
+    num_votes = models.IntegerField(default=0)
+    # Random sort key, used to pick a random unit within a bucket using the index
+    rand = models.FloatField(default=random_sort_key)
+
+    objects = SurveyQueueQuerySet.as_manager()
+
+
+class SurveyLeaseQuerySet(models.QuerySet):
+
+    def get_next_id(self, user, exclude_id=None):
+        """
+        Returns the next unit of the batch leased to the user, the oldest lease first.
+        If the batch is used up, leases a new one from the survey queue.
+        """
+        # The leases of a batch are added at the same time, the unit ID breaks the tie
+        leased_ids = self.filter(user=user, date_expires__gt=timezone.now()) \
+                .exclude(eval_unit_id=exclude_id) \
+                .order_by('date_added', 'eval_unit_id') \
+                .values_list('eval_unit_id', flat=True)
+        id = leased_ids.first()
+        if id is None and self.lease_batch(user, exclude_id=exclude_id):
+            id = leased_ids.first()
+        return id
+
+    def lease_batch(self, user, exclude_id=None, batch_size=SURVEY_LEASE_BATCH_SIZE):
+        # Drop the user's expired leases before taking new ones
+        self.filter(user=user, date_expires__lte=timezone.now()).delete()
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(SQL_LEASE_QUEUED_IDS, {
+                'exclude_id': exclude_id,
+                'user_id': user.id,
+                'batch_size': batch_size,
+                'duration': SURVEY_LEASE_DURATION,
+            })
+            return [row[0] for row in cursor.fetchall()]
+
+    def release(self, user, eval_unit_id):
+        """Remove a unit from the user's batch, e.g. once they have opened or voted on it."""
+        return self.filter(user=user, eval_unit_id=eval_unit_id).delete()
+
+
+class SurveyLease(models.Model):
+    """
+    Unit of the survey queue handed out to a user for a limited time.
+    Leased units are not handed out to other users, so that two volunteers
+    are not sent to survey the same unit at the same time.
+    """
+    class Meta:
+        db_table = 'survey_leases'
+
+    eval_unit = models.OneToOneField(EvalUnit, on_delete=models.CASCADE, primary_key=True)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+    )
+    date_added = models.DateTimeField('date added', default=timezone.now)
+    date_expires = models.DateTimeField('date expires')
+
+    objects = SurveyLeaseQuerySet.as_manager()
+
+
 class NoBuildingFlag(models.Model):
     vote = models.OneToOneField(Vote, on_delete=models.CASCADE)
 
@@ -504,6 +945,93 @@ class HLMBuilding(models.Model):
             return 'E'
 
 
+class RollIngestionFileQuerySet(models.QuerySet):
+
+    def get_for_file(self, path: Path):
+        """
+        Returns the manifest entry of the roll XML, starting over if the file changed since it was recorded.
+        The file is only hashed when its size or modification time changed, e.g. after downloading it again.
+        """
+        stat = path.stat()
+        entry = self.filter(file_name=path.name).first()
+        if entry and entry.size == stat.st_size and entry.mtime == stat.st_mtime:
+            return entry
+
+        sha256 = file_sha256(path)
+        if entry is None or entry.sha256 != sha256:
+            if entry is not None:
+                entry.chunks.all().delete()
+            entry = self.model(file_name=path.name, sha256=sha256)
+        entry.size = stat.st_size
+        entry.mtime = stat.st_mtime
+        entry.save()
+        return entry
+
+    def mark_completed(self):
+        """Marks the files whose chunks are all done as done"""
+        return (
+            self.exclude(status=RollIngestionFile.Status.DONE)
+            .filter(chunks__isnull=False)
+            .exclude(chunks__done=False)
+            .update(status=RollIngestionFile.Status.DONE)
+        )
+
+
+class RollIngestionFile(models.Model):
+    """
+    Manifest entry of a roll XML ingested by process_roll_xml, recording how far it got in its chunks, 
+    so that an interrupted run skips the completed files and resumes the others.
+    """
+    class Status(models.TextChoices):
+        PENDING = "pending", _("Pending")
+        IN_PROGRESS = "in_progress", _("In Progress")
+        DONE = "done", _("Done")
+
+    class Meta:
+        db_table = 'roll_ingestion_files'
+
+    file_name = models.TextField(primary_key=True)
+    size = models.BigIntegerField()
+    mtime = models.FloatField()
+    sha256 = models.TextField()
+    status = models.TextField(choices=Status.choices, default=Status.PENDING)
+    date_modified = models.DateTimeField('date modified', auto_now=True)
+
+    objects = RollIngestionFileQuerySet.as_manager()
+
+    def __str__(self):
+        return f"{self.file_name}: {self.status}"
+
+
+class RollIngestionChunk(models.Model):
+    """
+    Byte range of a roll XML starting at a unit, processed as a single task by process_roll_xml.
+    Large files are split in several chunks so that any free worker can pick them up.
+    """
+    class Meta:
+        db_table = 'roll_ingestion_chunks'
+        constraints = [
+            models.UniqueConstraint(fields=['file', 'start'], name='unique_roll_ingestion_chunk_start'),
+        ]
+
+    file = models.ForeignKey(RollIngestionFile, on_delete=models.CASCADE, related_name='chunks')
+    # Offsets in the uncompressed file, stop is None for the last chunk
+    start = models.BigIntegerField()
+    stop = models.BigIntegerField(null=True)
+    # Units of the chunk read up to the last commit, skipped when resuming
+    num_units_done = models.IntegerField(default=0)
+    done = models.BooleanField(default=False)
+
+    def checkpoint(self, num_units_done, done=False):
+        """Records the progress, run it in the transaction committing the units"""
+        self.num_units_done = num_units_done
+        self.done = done
+        self.save(update_fields=['num_units_done', 'done'])
+
+    def __str__(self):
+        return f"{self.file_id} [{self.start}:{self.stop}]: {self.num_units_done} units{' (done)' if self.done else ''}"
+
+
 class UploadImageJob(models.Model):
     class Status(models.TextChoices):
         PENDING = "pending", _("Pending")
@@ -0,0 +1,24 @@
+from django.dispatch import receiver
+from django.db.models.signals import post_save, post_delete
+
+from buildings.models.models import EvalUnit, SurveyLease, SurveyQueueEntry, Vote
+
+# These run inside the transaction of the view creating or deleting the vote,
+# so the vote counts are always committed together with the votes themselves.
+
+@receiver(post_save, sender=Vote)
+def add_vote_to_counts(sender, instance, created, **kwargs):
+    # Votes are also saved when they are modified, only count new ones
+    if created:
+        EvalUnit.objects.add_votes(instance.eval_unit_id, 1)
+        SurveyQueueEntry.objects.add_votes(instance.eval_unit_id, 1)
+        # The unit is done for this user, take it out of their batch
+        SurveyLease.objects.release(instance.user_id, instance.eval_unit_id)
+        Vote.objects.invalidate_dashboard_stats(instance.user_id)
+
+
+@receiver(post_delete, sender=Vote)
+def remove_vote_from_counts(sender, instance, **kwargs):
+    EvalUnit.objects.add_votes(instance.eval_unit_id, -1)
+    SurveyQueueEntry.objects.add_votes(instance.eval_unit_id, -1)
+    Vote.objects.invalidate_dashboard_stats(instance.user_id)
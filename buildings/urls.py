@@ -29,4 +29,5 @@ urlpatterns = [
     path("login", views.login_page, name="login"),
     path("logout", views.logout_page, name="logout"),
     path("upload_imgs/<str:eval_unit_id>", views.upload_imgs, name="upload_imgs"),
+    path("tiles/<int:z>/<int:x>/<int:y>.mvt", views.tile, name="tile"),
 ]
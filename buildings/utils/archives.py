@@ -0,0 +1,93 @@
+"""
+Reading the downloaded datasets straight from their ZIP archives, without extracting them.
+
+find_files returns the files of a folder matching a pattern, whether they were extracted or are
+still in one of the folder's archives. The archive members are ZipMember objects, providing the
+parts of the Path API used to read files (name, stat() and open()), so they can be used in place of paths.
+"""
+import os
+import zipfile
+import shapefile
+
+from pathlib import Path, PurePosixPath
+from datetime import datetime
+from fnmatch import fnmatch
+from contextlib import ExitStack, contextmanager
+
+
+class ZipMember:
+    """File inside a ZIP archive"""
+
+    def __init__(self, zip_path, info: zipfile.ZipInfo):
+        self.zip_path = Path(zip_path)
+        self.info = info
+        self.name = PurePosixPath(info.filename).name
+
+    def __repr__(self):
+        return f"ZipMember('{self.zip_path}', '{self.info.filename}')"
+
+    def __str__(self):
+        return f"{self.zip_path}/{self.info.filename}"
+
+    def stat(self):
+        """Uncompressed size and modification time of the member, like Path.stat()"""
+        mtime = datetime(*self.info.date_time).timestamp()
+        return os.stat_result((0o100444, 0, 0, 1, 0, 0, self.info.file_size, mtime, mtime, mtime))
+
+    def open(self, mode='rb'):
+        """Decompressing stream of the member, seekable but only cheaply forwards"""
+        if mode != 'rb':
+            raise ValueError(f"Archive members can only be opened in 'rb' mode, not '{mode}'")
+        with zipfile.ZipFile(self.zip_path) as zf:
+            # The member stays readable after the archive is closed, until it is closed itself
+            return zf.open(self.info)
+
+    def with_suffix(self, suffix):
+        """Member next to this one with another extension (in any case), e.g. the .dbf of a .shp"""
+        target = PurePosixPath(self.info.filename).with_suffix(suffix).as_posix().lower()
+        with zipfile.ZipFile(self.zip_path) as zf:
+            for info in zf.infolist():
+                if info.filename.lower() == target:
+                    return ZipMember(self.zip_path, info)
+        raise FileNotFoundError(f"No {suffix} file next to {self}")
+
+
+def find_files(folder: Path, pattern: str):
+    """
+    Files of the folder (and its subfolders) whose name matches the pattern, e.g. '*.xml',
+    followed by the matching members of the ZIP archives it contains.
+    """
+    files = sorted(Path(folder).glob(f'**/{pattern}'))
+    for zip_path in sorted(Path(folder).glob('**/*.zip')):
+        with zipfile.ZipFile(zip_path) as zf:
+            infos = sorted(zf.infolist(), key=lambda info: info.filename)
+        files += [
+            ZipMember(zip_path, info) for info in infos
+            if not info.is_dir() and fnmatch(PurePosixPath(info.filename).name.lower(), pattern.lower())
+        ]
+    return files
+
+
+def remove_file(file):
+    """Deletes the file, or the whole archive if it is an archive member"""
+    Path(file.zip_path if isinstance(file, ZipMember) else file).unlink(missing_ok=True)
+
+
+@contextmanager
+def open_shapefile(shp):
+    """
+    shapefile.Reader of a .shp path or archive member. For members, the .dbf and .shx
+    are read from the same archive. Read them sequentially, e.g. with iterShapeRecords().
+    """
+    if not isinstance(shp, ZipMember):
+        with shapefile.Reader(shp) as reader:
+            yield reader
+        return
+
+    with ExitStack() as stack:
+        files = {
+            component: stack.enter_context(shp.with_suffix(f'.{component}').open())
+            for component in ('shp', 'shx', 'dbf')
+        }
+        with shapefile.Reader(**files) as reader:
+            yield reader
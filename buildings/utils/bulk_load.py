@@ -0,0 +1,149 @@
+"""
+Bulk loading of records into PostgreSQL with COPY.
+
+The records are streamed with COPY ... FROM STDIN (text format) into a temporary staging table
+with the same columns as the target, then merged into the target with a single
+INSERT ... SELECT ... ON CONFLICT. This skips the per-row overhead of INSERTs, and of model
+instances for the ORM, while keeping the conflict handling of an upsert.
+"""
+import io
+import json
+from datetime import date, time
+from collections.abc import Mapping
+
+from django.db import connection, transaction
+from django.contrib.gis.geos import GEOSGeometry
+
+# Size of the chunks read from the records by COPY
+COPY_BUFFER_SIZE = 64 * 1024
+
+# Special characters of the COPY text format
+COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+SQL_CREATE_STAGING = "CREATE TEMP TABLE {staging} AS SELECT {columns} FROM {table} WITH NO DATA;"
+SQL_COPY_STAGING = "COPY {staging} ({columns}) FROM STDIN;"
+SQL_MERGE_STAGING = "INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging} {on_conflict};"
+SQL_DROP_STAGING = "DROP TABLE {staging};"
+
+
+def to_copy_text(value):
+    """Formats a python value as a field of the COPY text format"""
+    if value is None:
+        return r'\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, GEOSGeometry):
+        # PostGIS parses hex EWKB, keeping the SRID
+        return value.hexewkb.decode()
+    if isinstance(value, (bytes, memoryview)):
+        return '\\\\x' + bytes(value).hex()
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    elif isinstance(value, (date, time)):
+        value = value.isoformat()
+    elif isinstance(value, float):
+        value = repr(value)
+    return str(value).translate(COPY_ESCAPES)
+
+
+class CopyStream(io.TextIOBase):
+    """Read only file over the COPY lines of the records, generated as COPY reads it"""
+
+    def __init__(self, records, columns):
+        self.lines = self._lines(records, columns)
+        self.buffer = ''
+
+    @staticmethod
+    def _lines(records, columns):
+        for record in records:
+            if isinstance(record, Mapping):
+                record = [record[column] for column in columns]
+            yield '\t'.join(to_copy_text(value) for value in record) + '\n'
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = float('inf')
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        for line in self.lines:
+            chunks.append(line)
+            length += len(line)
+            if length >= size:
+                break
+        data = ''.join(chunks)
+        if length > size:
+            data, self.buffer = data[:size], data[size:]
+        else:
+            self.buffer = ''
+        return data
+
+
+def copy_records(cursor, table, columns, records, conflict_target=None, update_columns=None):
+    """
+    Loads the records into the table through a COPY into a staging table, and returns the number
+    of rows inserted or updated. The records are sequences of values in the order of the columns,
+    or mappings with the columns as keys, and can be a generator: they are streamed to the database.
+
+    Rows conflicting with existing ones are skipped, or updated with the values of update_columns
+    if given, in which case conflict_target gives the conflicting columns, e.g. '(id)'.
+
+    Run it in a transaction (e.g. a psycopg2 connection before its commit, or transaction.atomic()),
+    so a failed load leaves the table untouched.
+    """
+    staging = f'{table}_staging'
+    column_list = ', '.join(columns)
+
+    if update_columns:
+        assignments = ', '.join(f'{column} = EXCLUDED.{column}' for column in update_columns)
+        on_conflict = f'ON CONFLICT {conflict_target} DO UPDATE SET {assignments}'
+    else:
+        on_conflict = f'ON CONFLICT {conflict_target or ""} DO NOTHING'
+
+    # The staging table only takes the column types, not the constraints or indexes
+    cursor.execute(SQL_CREATE_STAGING.format(staging=staging, columns=column_list, table=table))
+    cursor.copy_expert(
+        SQL_COPY_STAGING.format(staging=staging, columns=column_list),
+        CopyStream(records, columns),
+        size=COPY_BUFFER_SIZE,
+    )
+    cursor.execute(SQL_MERGE_STAGING.format(table=table, columns=column_list, staging=staging, on_conflict=on_conflict))
+    num_rows = cursor.rowcount
+    cursor.execute(SQL_DROP_STAGING.format(staging=staging))
+    return num_rows
+
+
+def copy_objects(model, objs, update_fields=None):
+    """
+    Same as model.objects.bulk_create(objs, ignore_conflicts=True), or an upsert of update_fields
+    on the primary key if given, loaded with copy_records on the default database connection.
+    """
+    fields = model._meta.concrete_fields
+    columns = [field.column for field in fields]
+
+    def records():
+        for obj in objs:
+            values = []
+            for field in fields:
+                # Sets e.g. the auto_now_add dates, like saving does
+                value = field.pre_save(obj, add=True)
+                if not isinstance(value, GEOSGeometry):
+                    value = field.get_db_prep_save(value, connection)
+                values.append(value)
+            yield values
+
+    update_columns = None
+    if update_fields:
+        update_columns = [model._meta.get_field(name).column for name in update_fields]
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        return copy_records(
+            cursor,
+            model._meta.db_table,
+            columns,
+            records(),
+            conflict_target=f'({model._meta.pk.column})',
+            update_columns=update_columns,
+        )
@@ -0,0 +1,118 @@
+"""
+Columnar snapshots of model instances in Parquet files, e.g. the parsed roll of process_roll_xml --to-parquet,
+and their bulk loading into the database.
+
+Needs pyarrow, which is optional and only imported when used: pip install pyarrow
+"""
+import os
+import tempfile
+from pathlib import Path
+
+from django.db import connection, transaction
+from django.contrib.gis.db.models import GeometryField
+
+from buildings.utils.bulk_load import copy_records
+
+# Rows read from the Parquet files at a time when loading them
+LOAD_BATCH_SIZE = 10_000
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Parquet snapshots need pyarrow, install it with: pip install pyarrow")
+    return pyarrow, pyarrow.parquet
+
+
+def arrow_type(field):
+    """Arrow type of the model field's values. JSON is kept as text and geometries as EWKB."""
+    pa, _ = import_pyarrow()
+    if isinstance(field, GeometryField):
+        return pa.binary()
+    if field.is_relation:
+        return arrow_type(field.target_field)
+    return {
+        'TextField': pa.string(),
+        'CharField': pa.string(),
+        'JSONField': pa.string(),
+        'SmallIntegerField': pa.int16(),
+        'IntegerField': pa.int32(),
+        'BigIntegerField': pa.int64(),
+        'FloatField': pa.float64(),
+        'BooleanField': pa.bool_(),
+        'DateField': pa.date32(),
+        'DateTimeField': pa.timestamp('us', tz='UTC'),
+    }[field.get_internal_type()]
+
+
+def arrow_schema(model):
+    pa, _ = import_pyarrow()
+    return pa.schema([
+        pa.field(field.column, arrow_type(field), nullable=field.null)
+        for field in model._meta.concrete_fields
+    ])
+
+
+def write_parquet(model, objs, path: Path):
+    """
+    Writes the model instances to a Parquet file, with a column per database column.
+    The values are converted as when saving them, e.g. '2022' to 2022 for integer fields.
+    """
+    pa, pq = import_pyarrow()
+    fields = model._meta.concrete_fields
+
+    columns = {field.column: [] for field in fields}
+    for obj in objs:
+        for field in fields:
+            # Sets e.g. the auto_now_add dates, like saving does
+            value = field.pre_save(obj, add=True)
+            if isinstance(field, GeometryField):
+                value = bytes(value.ewkb) if value is not None else None
+            else:
+                value = field.get_prep_value(value)
+            columns[field.column].append(value)
+
+    table = pa.Table.from_pydict(columns, schema=arrow_schema(model))
+
+    # Write to a temporary file first so an interrupted run never leaves a partial snapshot
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    os.close(fd)
+    pq.write_table(table, tmp_path, compression='zstd')
+    os.replace(tmp_path, path)
+    return table.num_rows
+
+
+def copy_parquet(model, path: Path):
+    """
+    Loads a Parquet file written by write_parquet into the model's table with copy_records,
+    skipping the rows already there. Returns the number of rows inserted.
+    """
+    _, pq = import_pyarrow()
+    parquet_file = pq.ParquetFile(path)
+
+    # Only the columns of the snapshot, in case it predates new nullable columns of the model
+    fields = [field for field in model._meta.concrete_fields if field.column in parquet_file.schema_arrow.names]
+    columns = [field.column for field in fields]
+    geometry_columns = {field.column for field in fields if isinstance(field, GeometryField)}
+
+    def records():
+        for batch in parquet_file.iter_batches(batch_size=LOAD_BATCH_SIZE, columns=columns):
+            values = [
+                # PostGIS parses hex EWKB
+                [ewkb.hex() if ewkb is not None else None for ewkb in batch.column(column).to_pylist()]
+                if column in geometry_columns else batch.column(column).to_pylist()
+                for column in columns
+            ]
+            yield from zip(*values)
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        return copy_records(
+            cursor,
+            model._meta.db_table,
+            columns,
+            records(),
+            conflict_target=f'({model._meta.pk.column})',
+        )
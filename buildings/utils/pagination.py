@@ -0,0 +1,191 @@
+"""
+Keyset (seek) pagination for large tables.
+
+Instead of OFFSET, each page starts right after (or before) the ordering value and id
+of the last (or first) row of the page the user comes from, given as an opaque cursor.
+With an index on (ordering field, id), any page is fetched in the same time as the first one.
+"""
+import json
+import base64
+import binascii
+from datetime import date, time
+
+from django.db import connection
+from django.db.models import Q
+from django.core.paginator import Paginator
+from django.core.exceptions import EmptyResultSet, ValidationError
+
+# Below this estimated number of rows, counting exactly is cheap enough
+EXACT_COUNT_THRESHOLD = 10_000
+
+
+def encode_cursor(value, pk):
+    # Not DjangoJSONEncoder, it truncates the timestamps to the millisecond
+    if isinstance(value, (date, time)):
+        value = value.isoformat()
+    data = json.dumps([value, pk])
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Returns the (value, pk) of the cursor, or None if it is invalid"""
+    try:
+        value, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return value, pk
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError):
+        return None
+
+
+def estimate_count(queryset):
+    """
+    Estimated number of rows of the queryset, from the table statistics if it is unfiltered,
+    otherwise from the planner's row estimate. Small results are counted exactly.
+    """
+    try:
+        sql, params = queryset.order_by().query.sql_with_params()
+    except EmptyResultSet:
+        # The filters can't match anything, e.g. queryset.none()
+        return 0, False
+
+    estimate = None
+    with connection.cursor() as cursor:
+        if not queryset.query.where:
+            cursor.execute(
+                "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+                [queryset.model._meta.db_table],
+            )
+            row = cursor.fetchone()
+            # -1 if the table was never vacuumed or analyzed
+            if row and row[0] >= 0:
+                estimate = row[0]
+
+        if estimate is None:
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+            plan = cursor.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            estimate = plan[0]["Plan"]["Plan Rows"]
+
+    if estimate < EXACT_COUNT_THRESHOLD:
+        return queryset.count(), False
+    return estimate, True
+
+
+class KeysetPage:
+    """Quacks like a Django Page for the templates, with cursors instead of page numbers"""
+
+    def __init__(self, object_list, paginator, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+
+class KeysetPaginator:
+    """
+    Paginates a queryset on a single ordering field (e.g. '-address'), with the primary key as tie breaker.
+    NULLs are sorted the way PostgreSQL does by default: last when ascending, first when descending.
+    """
+
+    def __init__(self, queryset, ordering, per_page):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.descending = ordering.startswith("-")
+        self.field = ordering.lstrip("-")
+        self.pk_name = queryset.model._meta.pk.name
+        self._count = None
+        self._count_is_estimate = None
+
+    def _get_count(self):
+        if self._count is None:
+            self._count, self._count_is_estimate = estimate_count(self.queryset)
+        return self._count, self._count_is_estimate
+
+    @property
+    def count(self):
+        return self._get_count()[0]
+
+    @property
+    def count_is_estimate(self):
+        return self._get_count()[1]
+
+    def _key(self, obj):
+        return getattr(obj, self.field), getattr(obj, self.pk_name)
+
+    def _order_by(self, descending):
+        prefix = "-" if descending else ""
+        if self.field == self.pk_name:
+            return (f"{prefix}{self.pk_name}",)
+        return (f"{prefix}{self.field}", f"{prefix}{self.pk_name}")
+
+    def _seek(self, value, pk, descending):
+        """Rows strictly after (value, pk) in the given direction"""
+        pk_after = Q(**{f"{self.pk_name}__{'lt' if descending else 'gt'}": pk})
+        if self.field == self.pk_name:
+            return pk_after
+
+        op = "lt" if descending else "gt"
+        if value is None:
+            # NULLs come first when descending, then all the non NULL values
+            if descending:
+                return (Q(**{f"{self.field}__isnull": True}) & pk_after) | Q(**{f"{self.field}__isnull": False})
+            return Q(**{f"{self.field}__isnull": True}) & pk_after
+
+        after = Q(**{f"{self.field}__{op}": value}) | (Q(**{self.field: value}) & pk_after)
+        if not descending:
+            # NULLs come last when ascending
+            after |= Q(**{f"{self.field}__isnull": True})
+        return after
+
+    def _fetch(self, descending, cursor=None):
+        qs = self.queryset.order_by(*self._order_by(descending))
+        if cursor is not None:
+            try:
+                qs = qs.filter(self._seek(*cursor, descending))
+            except (ValueError, TypeError, ValidationError):
+                # The cursor value does not fit the field, e.g. it was edited by hand
+                pass
+        # One extra row tells us if there is more after this page
+        rows = list(qs[: self.per_page + 1])
+        return rows[: self.per_page], len(rows) > self.per_page
+
+    def get_page(self, after=None, before=None, last=False):
+        """
+        Returns the page right after the `after` cursor, right before the `before` cursor,
+        the last page if `last` is set, or the first page. Invalid cursors give the first page.
+        """
+        after = decode_cursor(after) if after else None
+        before = decode_cursor(before) if before else None
+
+        if before or last:
+            # Walk backwards, then put the rows back in order
+            rows, has_more = self._fetch(not self.descending, before)
+            rows.reverse()
+            has_previous, has_next = has_more, before is not None
+        else:
+            rows, has_more = self._fetch(self.descending, after)
+            has_previous, has_next = after is not None, has_more
+
+        next_cursor = encode_cursor(*self._key(rows[-1])) if rows and has_next else None
+        previous_cursor = encode_cursor(*self._key(rows[0])) if rows and has_previous else None
+        return KeysetPage(rows, self, next_cursor, previous_cursor)
+
+
+class CountedPaginator(Paginator):
+    """Regular Paginator for when the total count is already known (e.g. cached), to skip the COUNT(*)"""
+
+    def __init__(self, object_list, per_page, count, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.count = count
@@ -0,0 +1,113 @@
+"""
+Columns of the evaluation units and where they come from in the roll XMLs, in one place.
+
+The parser reads the columns with a field code from the unit's field of that code, converted
+to their type or resolved to a readable value with their lookup table. The other columns are
+built from several fields (e.g. the address), come from the XML's header (e.g. the municipality)
+or from other datasets (e.g. the coordinates). The column lists of the bulk loads and the DDL of
+the tables holding units outside of the evalunits table (see aggregate_murbs) are derived from them.
+
+See the roll's documentation for the field codes:
+https://www.mamh.gouv.qc.ca/fileadmin/publications/evaluation_fonciere/manuel_evaluation_fonciere/2022/MEFQ_2022.pdf
+"""
+from buildings.utils.constants import (
+    OWNER_STATUSES, PHYSICAL_LINKS, CONSTRUCTION_TYPES, WAY_TYPES, WAY_LINKS, CARDINAL_POINTS,
+)
+
+
+class UnitColumn:
+    """
+    Column of the evaluation units, with its SQL definition. from_roll is False for
+    the columns filled from other datasets, kept when a newer roll updates the unit.
+    """
+
+    def __init__(self, name, ddl, code=None, convert=None, lookup=None, from_roll=True):
+        self.name = name
+        self.ddl = ddl
+        self.code = code
+        self.convert = convert
+        self.lookup = lookup
+        self.from_roll = from_roll
+
+    def __repr__(self):
+        return f"UnitColumn('{self.name}', '{self.code}')"
+
+
+UNIT_COLUMNS = [
+    # The municipality code of the header followed by the MAT18
+    UnitColumn('id', 'TEXT PRIMARY KEY CHECK(length(id)=23)'),
+    # From the roll shapefile and the lots, see process_roll_shp and process_lots
+    UnitColumn('lat', 'NUMERIC(20, 10) NOT NULL', from_roll=False),
+    UnitColumn('lng', 'NUMERIC(20, 10) NOT NULL', from_roll=False),
+    UnitColumn('point', 'GEOMETRY(POINT, 4326)', from_roll=False),
+    UnitColumn('lot_id', 'TEXT', from_roll=False),
+    # From the header, RLM02A and RLM01A
+    UnitColumn('year', 'SMALLINT NOT NULL'),
+    UnitColumn('muni', 'TEXT NOT NULL'),
+    UnitColumn('muni_code', 'TEXT NOT NULL'),
+    UnitColumn('arrond', 'TEXT', code='rl0102a'),
+    # RL0101x - Address, the address and street name are joined from its components
+    UnitColumn('address', 'TEXT NOT NULL'),
+    UnitColumn('num_adr_inf', 'TEXT', code='rl0101ax'),
+    UnitColumn('num_adr_inf_2', 'TEXT', code='rl0101bx'),
+    UnitColumn('num_adr_sup', 'TEXT', code='rl0101cx'),
+    UnitColumn('num_adr_sup_2', 'TEXT', code='rl0101dx'),
+    UnitColumn('street_name', 'TEXT'),
+    UnitColumn('apt_num', 'TEXT'),
+    UnitColumn('apt_num_1', 'TEXT', code='rl0101ix'),
+    UnitColumn('apt_num_2', 'TEXT', code='rl0101jx'),
+    # RL0104 - Joined, padding the optional parts with zeros
+    UnitColumn('mat18', 'TEXT NOT NULL CHECK(length(mat18)=18)'),
+    UnitColumn('cubf', 'SMALLINT NOT NULL', code='rl0105a', convert=int),
+    UnitColumn('file_num', 'TEXT', code='rl0106a'),
+    UnitColumn('nghbr_unit', 'TEXT', code='rl0107a'),
+    # RL0201x - Latest signup of the owners to the roll
+    UnitColumn('owner_date', 'DATE'),
+    UnitColumn('owner_type', 'TEXT'),
+    UnitColumn('owner_status', 'TEXT', code='rl0201u', lookup=OWNER_STATUSES),
+    # RL030Xx - Unit characteristics, rl0314 - rl0315 are related to agricultural zones and ignored
+    UnitColumn('lot_lin_dim', 'NUMERIC(8, 2)', code='rl0301a', convert=float),
+    UnitColumn('lot_area', 'NUMERIC(15, 2)', code='rl0302a', convert=float),
+    UnitColumn('max_floors', 'SMALLINT', code='rl0306a', convert=int),
+    UnitColumn('const_yr', 'SMALLINT', code='rl0307a', convert=int),
+    UnitColumn('const_yr_real', 'TEXT', code='rl0307b'),
+    UnitColumn('floor_area', 'NUMERIC(8, 1)', code='rl0308a', convert=float),
+    UnitColumn('phys_link', 'TEXT', code='rl0309a', lookup=PHYSICAL_LINKS),
+    UnitColumn('const_type', 'TEXT', code='rl0310a', lookup=CONSTRUCTION_TYPES),
+    UnitColumn('num_dwelling', 'SMALLINT', code='rl0311a', convert=int),
+    UnitColumn('num_rental', 'SMALLINT', code='rl0312a', convert=int),
+    UnitColumn('num_non_res', 'SMALLINT', code='rl0313a', convert=int),
+    # RL040Xx - Values
+    UnitColumn('apprais_date', 'DATE', code='rl0401a'),
+    UnitColumn('lot_value', 'INTEGER', code='rl0402a', convert=float),
+    UnitColumn('building_value', 'INTEGER', code='rl0403a', convert=float),
+    UnitColumn('value', 'INTEGER', code='rl0404a', convert=float),
+    UnitColumn('prev_value', 'INTEGER', code='rl0405a', convert=float),
+    UnitColumn('date_added', 'DATE', from_roll=False),
+]
+
+UNIT_COLUMN_NAMES = [column.name for column in UNIT_COLUMNS]
+
+# (code, column, convert, lookup) of the columns read from a single field, looped over for each unit
+FIELD_EXTRACTORS = tuple(
+    (column.code, column.name, column.convert, column.lookup) for column in UNIT_COLUMNS if column.code
+)
+
+# RL0101x - Codes of the street name components, in their order in the address, with their lookup tables
+STREET_COMPONENTS = (
+    ('rl0101ex', WAY_TYPES),
+    ('rl0101fx', WAY_LINKS),
+    ('rl0101gx', None),
+    ('rl0101hx', CARDINAL_POINTS),
+)
+
+
+def unit_table_ddl(table, extra_columns=None):
+    """
+    CREATE TABLE statement of a table with the columns of the units, and the extra columns
+    (name to SQL definition) after the ID, e.g. the ID of the aggregated MURB of disaggregated units.
+    """
+    definitions = [f'{UNIT_COLUMNS[0].name} {UNIT_COLUMNS[0].ddl}']
+    definitions += [f'{name} {ddl}' for name, ddl in (extra_columns or {}).items()]
+    definitions += [f'{column.name} {column.ddl}' for column in UNIT_COLUMNS[1:]]
+    return f"CREATE TABLE IF NOT EXISTS {table} (\n    " + ",\n    ".join(definitions) + "\n);"
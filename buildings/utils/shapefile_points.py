@@ -0,0 +1,125 @@
+"""
+Vectorized reader of point shapefiles, e.g. the roll points (rol_unite_p.shp), decoding all
+the points and an ID column at once into NumPy arrays instead of one pyshp object per record.
+
+The .shp records of a point shapefile all have the same size, so the file is read as an array of
+records: memory-mapped for files on disk, in memory for archive members. Shapefiles with null
+shapes or other shape types aren't supported, read them with pyshp.
+
+Needs numpy, which is optional and only imported when used: pip install numpy
+"""
+import struct
+from pathlib import Path
+
+from buildings.utils.archives import ZipMember
+
+SHP_HEADER_SIZE = 100
+SHAPE_TYPE_POINT = 1
+# Records of the roll points outside of it are dropped, (min lng, min lat, max lng, max lat)
+QUEBEC_BBOX = (-79.8, 44.9, -57.0, 62.6)
+# Records of the .dbf read at a time by iter_deleted_flags
+DBF_BLOCK_RECORDS = 10_000
+
+
+def import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("The vectorized shapefile reader needs numpy, install it with: pip install numpy")
+    return numpy
+
+
+def file_buffer(file):
+    """Read only buffer over the file's bytes, memory-mapped if it is on disk"""
+    np = import_numpy()
+    if isinstance(file, ZipMember):
+        with file.open() as f:
+            return np.frombuffer(f.read(), dtype=np.uint8)
+    return np.memmap(file, dtype=np.uint8, mode='r')
+
+
+def read_point_coords(shp):
+    """Longitudes and latitudes of the points of the .shp, as float64 arrays"""
+    np = import_numpy()
+    # Record header (big-endian), then the shape (little-endian)
+    record_dtype = np.dtype([('number', '>i4'), ('length', '>i4'), ('type', '<i4'), ('x', '<f8'), ('y', '<f8')])
+
+    data = file_buffer(shp)
+    num_bytes = len(data) - SHP_HEADER_SIZE
+    if num_bytes % record_dtype.itemsize:
+        raise ValueError(f"{shp} has records of different sizes, it isn't a point shapefile without null shapes")
+
+    records = np.frombuffer(data, dtype=record_dtype, offset=SHP_HEADER_SIZE, count=num_bytes // record_dtype.itemsize)
+    if not np.all(records['type'] == SHAPE_TYPE_POINT):
+        raise ValueError(f"{shp} has shapes other than points")
+    return records['x'].astype(np.float64), records['y'].astype(np.float64)
+
+
+def read_dbf_column(dbf, column=0):
+    """
+    Values of a column of the .dbf (its index or name), as a fixed-width bytes array with the
+    padding stripped, and the mask of the records not deleted.
+    """
+    np = import_numpy()
+    data = file_buffer(dbf)
+    num_records = int(data[4:8].view('<u4')[0])
+    header_size = int(data[8:10].view('<u2')[0])
+
+    # Field descriptors of 32 bytes follow the 32 bytes header, up to a 0x0D terminator
+    fields = []
+    for offset in range(32, header_size - 1, 32):
+        if data[offset] == 0x0D:
+            break
+        name = bytes(data[offset:offset + 11]).split(b'\x00')[0].decode('ascii')
+        fields.append((name, f'S{data[offset + 16]}'))
+
+    record_dtype = np.dtype([('deleted', 'S1'), *fields])
+    records = np.frombuffer(data, dtype=record_dtype, offset=header_size, count=num_records)
+    name = fields[column][0] if isinstance(column, int) else column
+    return np.char.strip(records[name]), records['deleted'] != b'*'
+
+
+def iter_deleted_flags(dbf):
+    """
+    Whether each record of the .dbf is deleted, read sequentially without numpy.
+    pyshp's iterRecords() skips the deleted records, so they tell which shapes have no record.
+    """
+    with dbf.open('rb') as f:
+        num_records, header_size, record_size = struct.unpack('<4xIHH', f.read(12))
+        f.read(header_size - 12)
+        for start in range(0, num_records, DBF_BLOCK_RECORDS):
+            block = f.read(record_size * min(DBF_BLOCK_RECORDS, num_records - start))
+            for offset in range(0, len(block), record_size):
+                yield block[offset:offset + 1] == b'*'
+
+
+def dbf_file(shp):
+    """The .dbf of a .shp path or archive member"""
+    dbf = shp.with_suffix('.dbf')
+    if not isinstance(shp, ZipMember) and not dbf.exists():
+        dbf = Path(shp).with_suffix('.DBF')
+    return dbf
+
+
+def in_bbox(lng, lat, bbox=QUEBEC_BBOX):
+    """Mask of the points inside the (min lng, min lat, max lng, max lat) box, NaNs are outside. Also works on scalars."""
+    min_lng, min_lat, max_lng, max_lat = bbox
+    return (lng >= min_lng) & (lng <= max_lng) & (lat >= min_lat) & (lat <= max_lat)
+
+
+def read_points(shp, id_column=0, bbox=QUEBEC_BBOX):
+    """
+    IDs (from the id_column of the .dbf), longitudes and latitudes of the points of a point shapefile,
+    path or archive member, dropping the deleted records and the points outside the bbox.
+    Returns them with the number of points dropped for being outside the bbox.
+    """
+    dbf = dbf_file(shp)
+    lng, lat = read_point_coords(shp)
+    ids, kept = read_dbf_column(dbf, id_column)
+    if len(ids) != len(lng):
+        raise ValueError(f"{shp} has {len(lng)} points but {len(ids)} records")
+
+    inside = in_bbox(lng, lat, bbox)
+    num_outside = int((kept & ~inside).sum())
+    kept &= inside
+    return ids[kept], lng[kept], lat[kept], num_outside
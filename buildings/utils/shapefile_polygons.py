@@ -0,0 +1,50 @@
+"""
+Encoding of the polygons of a shapefile as hex EWKB, e.g. the lots (usage_predominant_s_2022.shp),
+which PostGIS parses from the COPY text format into a geometry column, SRID included.
+
+The lots are in Web Mercator (EPSG:3857), reprojected to longitudes and latitudes (EPSG:4326)
+with its closed form inverse, the same as PostGIS' ST_Transform between them.
+"""
+import math
+import struct
+from itertools import chain
+
+# Radius of the sphere of the Web Mercator projection, the WGS84 semi-major axis
+WEB_MERCATOR_RADIUS = 6378137.0
+
+WKB_POLYGON = 3
+WKB_MULTIPOLYGON = 6
+# Set in the geometry type of EWKB when the SRID follows it
+EWKB_SRID_FLAG = 0x20000000
+
+
+def web_mercator_to_wgs84(ring):
+    """(lng, lat) coordinates of the (x, y) Web Mercator coordinates"""
+    return [
+        (math.degrees(x / WEB_MERCATOR_RADIUS), math.degrees(math.atan(math.sinh(y / WEB_MERCATOR_RADIUS))))
+        for x, y in ring
+    ]
+
+
+def multipolygon_ewkb(polygons, srid):
+    """Hex EWKB of a multipolygon, from its polygons' rings of (x, y) coordinates"""
+    parts = [struct.pack('<BIII', 1, WKB_MULTIPOLYGON | EWKB_SRID_FLAG, srid, len(polygons))]
+    for rings in polygons:
+        # The polygons of a multipolygon don't repeat the SRID
+        parts.append(struct.pack('<BII', 1, WKB_POLYGON, len(rings)))
+        for ring in rings:
+            parts.append(struct.pack(f'<I{2 * len(ring)}d', len(ring), *chain.from_iterable(ring)))
+    return b''.join(parts).hex()
+
+
+def shape_ewkb(shape, transform=web_mercator_to_wgs84, srid=4326):
+    """
+    Hex EWKB multipolygon of a pyshp polygon shape, with its coordinates transformed, or None
+    for a null shape. pyshp sorts the rings into polygons, holes after the ring containing them.
+    """
+    if not shape.points:
+        return None
+
+    geometry = shape.__geo_interface__
+    polygons = geometry['coordinates'] if geometry['type'] == 'MultiPolygon' else [geometry['coordinates']]
+    return multipolygon_ewkb([[transform(ring) for ring in rings] for rings in polygons], srid)
@@ -0,0 +1,37 @@
+"""
+In-process spatial join of points to the polygons containing them, e.g. the evaluation units to
+the lots without a single provincial ID, with a Shapely STRtree of the polygons queried for all
+the points at once instead of one ST_Intersects round trip per lot.
+
+Needs shapely 2, which is optional and only imported when used: pip install "shapely>=2"
+"""
+
+
+def import_shapely():
+    try:
+        import shapely
+    except ImportError:
+        raise ImportError('The shapely spatial engine needs shapely 2, install it with: pip install "shapely>=2"')
+    if int(shapely.__version__.split('.')[0]) < 2:
+        raise ImportError(f'The shapely spatial engine needs shapely 2, not {shapely.__version__}: pip install "shapely>=2"')
+    return shapely
+
+
+def polygons_bounds(polygons_wkb):
+    """Polygons of the WKBs, with their (min x, min y, max x, max y) bounds together"""
+    shapely = import_shapely()
+    polygons = shapely.from_wkb(polygons_wkb)
+    return polygons, tuple(float(bound) for bound in shapely.total_bounds(polygons))
+
+
+def points_in_polygons(polygons, xs, ys):
+    """
+    Indices of the (polygon, point) pairs of the points intersecting the polygons, like ST_Intersects,
+    so a point on the boundary of a polygon is in it. A point in several polygons has a pair with each.
+    """
+    shapely = import_shapely()
+    points = shapely.points(xs, ys)
+    tree = shapely.STRtree(polygons)
+    # With an array of geometries, the indices of the geometries then of the tree's geometries
+    point_indices, polygon_indices = tree.query(points, predicate='intersects')
+    return polygon_indices, point_indices
@@ -0,0 +1,137 @@
+"""
+Synthetic roll XMLs, with the structure and codes of the real ones, to measure and test
+the roll ingestion without downloading the real roll (~5GB).
+
+The units are spread over the municipalities with a Zipf distribution, like the real roll
+where Montréal alone has ~500k units and most municipalities a few thousand.
+"""
+import random
+from pathlib import Path
+from xml.sax.saxutils import escape
+
+from buildings.utils.constants import (
+    CUBF_TO_NAME_MAP, OWNER_STATUSES, PHYSICAL_LINKS, CONSTRUCTION_TYPES,
+    MUNICIPALITIES, WAY_TYPES, WAY_LINKS, CARDINAL_POINTS,
+)
+
+STREET_NAMES = [
+    'Saint-Denis', 'Sherbrooke', 'Des Pins', 'Notre-Dame', 'Principale', "De l'Église", 'Champlain',
+    'Du Lac', 'Laurier', 'Papineau', 'Des Érables', 'Saint-Laurent', 'Wellington', 'De la Gare',
+]
+ARRONDISSEMENTS = ['Plateau-Mont-Royal', 'Rosemont', 'Verdun', 'Ahuntsic', 'Outremont']
+# Most units are residential, 1000 being single dwellings
+CUBF_WEIGHTS = {1000: 60, 1211: 10, 1212: 5, 1921: 5}
+
+
+def municipality_sizes(num_units, num_files, skew=1.0):
+    """Number of units of each of the num_files municipalities, the i-th getting a share proportional to 1 / i ** skew"""
+    weights = [1 / (i + 1) ** skew for i in range(num_files)]
+    sizes = [int(num_units * weight / sum(weights)) for weight in weights]
+    # Rounding leftovers go to the largest
+    sizes[0] += num_units - sum(sizes)
+    return sizes
+
+
+def generate_roll(folder: Path, num_units, num_files=10, skew=1.0, year=2022, seed=0):
+    """
+    Writes num_units synthetic units in num_files roll XMLs of the folder, one per municipality,
+    and returns their paths. The same arguments give the same files.
+    """
+    rng = random.Random(seed)
+    folder.mkdir(parents=True, exist_ok=True)
+    muni_codes = rng.sample(sorted(code[2:] for code in MUNICIPALITIES), num_files)
+
+    paths = []
+    for muni_code, size in zip(muni_codes, municipality_sizes(num_units, num_files, skew)):
+        path = folder / f'RL{muni_code}.xml'
+        write_roll_xml(path, muni_code, year, size, rng)
+        paths.append(path)
+    return paths
+
+
+def write_roll_xml(path: Path, muni_code, year, num_units, rng: random.Random):
+    """Writes the roll XML of a municipality with num_units units"""
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<RL>\n')
+        f.write(f'<RLM01A>{muni_code}</RLM01A>\n<RLM02A>{year}</RLM02A>\n')
+        for i in range(num_units):
+            f.write(synthetic_unit(i, rng))
+        f.write('</RL>\n')
+
+
+def synthetic_unit(i, rng: random.Random):
+    """RLUEx element of the i-th unit of a municipality, its MAT18 being unique in the municipality"""
+    cubf = rng.choices(list(CUBF_WEIGHTS) + [rng.choice(list(CUBF_TO_NAME_MAP))], weights=[*CUBF_WEIGHTS.values(), 20])[0]
+    is_condo = cubf != 1000 and rng.random() < 0.5
+
+    # RL0101 - Address, a few units (e.g. streets) have no street numbers
+    address = []
+    if rng.random() > 0.03:
+        num_adr_inf = rng.randint(1, 9999)
+        address.append(('RL0101Ax', num_adr_inf))
+        if rng.random() < 0.02:
+            address.append(('RL0101Bx', 'A'))
+        if rng.random() < 0.2:
+            address.append(('RL0101Cx', num_adr_inf + 2 * rng.randint(1, 10)))
+    if rng.random() < 0.9:
+        address.append(('RL0101Ex', rng.choice(list(WAY_TYPES))))
+    if rng.random() < 0.1:
+        address.append(('RL0101Fx', rng.choice(list(WAY_LINKS))))
+    address.append(('RL0101Gx', rng.choice(STREET_NAMES)))
+    if rng.random() < 0.1:
+        address.append(('RL0101Hx', rng.choice(list(CARDINAL_POINTS))))
+    if is_condo:
+        address.append(('RL0101Ix', rng.randint(1, 400)))
+
+    # RL0104 - MAT18, from the unit's index so it is unique
+    mat18 = [
+        ('RL0104A', f'{i // 1_000_000:04d}'),
+        ('RL0104B', f'{i // 10_000 % 100:02d}'),
+        ('RL0104C', f'{i % 10_000:04d}'),
+    ]
+    if is_condo:
+        mat18 += [('RL0104D', '0'), ('RL0104E', f'{rng.randint(1, 999):03d}')]
+
+    fields = [('RL0105A', cubf)]
+    if rng.random() < 0.3:
+        fields.insert(0, ('RL0102A', rng.choice(ARRONDISSEMENTS)))
+    fields += [('RL0106A', rng.randint(1, 99999)), ('RL0107A', f'{rng.randint(1, 9999):04d}')]
+
+    # RL0201 - Owners, all the signups to the roll
+    owners = ''.join(
+        f'<RL0201x><RL0201Gx>{random_date(rng)}</RL0201Gx><RL0201Hx>{rng.choice("12")}</RL0201Hx></RL0201x>'
+        for _ in range(rng.randint(1, 3))
+    )
+    owners = f'<RL0201>{owners}<RL0201U>{rng.choice(list(OWNER_STATUSES))}</RL0201U></RL0201>'
+
+    # RL03 - Characteristics, RL04 - Values
+    floor_area = round(rng.uniform(50, 500), 1)
+    lot_value = rng.randint(10_000, 1_000_000)
+    building_value = rng.randint(0, 2_000_000)
+    characteristics = [
+        ('RL0301A', round(rng.uniform(5, 100), 2)), ('RL0302A', round(rng.uniform(100, 5000), 1)),
+        ('RL0306A', rng.randint(1, 4)), ('RL0307A', rng.randint(1850, 2022)), ('RL0307B', rng.choice('RE')),
+        ('RL0308A', floor_area), ('RL0309A', rng.choice(list(PHYSICAL_LINKS))),
+        ('RL0310A', rng.choice(list(CONSTRUCTION_TYPES))), ('RL0311A', rng.randint(0, 12)),
+        ('RL0312A', rng.randint(0, 2)), ('RL0313A', rng.randint(0, 2)),
+        ('RL0401A', random_date(rng)), ('RL0402A', lot_value), ('RL0403A', building_value),
+        ('RL0404A', lot_value + building_value), ('RL0405A', rng.randint(10_000, 3_000_000)),
+    ]
+
+    return (
+        f'<RLUEx>\n'
+        f'  <RL0101><RL0101x>{elements(address)}</RL0101x></RL0101>\n'
+        f'  <RL0104>{elements(mat18)}</RL0104>\n'
+        f'  {elements(fields)}\n'
+        f'  {owners}\n'
+        f'  {elements(characteristics)}\n'
+        f'</RLUEx>\n'
+    )
+
+
+def elements(fields):
+    return ''.join(f'<{tag}>{escape(str(value))}</{tag}>' for tag, value in fields)
+
+
+def random_date(rng: random.Random):
+    return f'{rng.randint(1950, 2022)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}'
@@ -0,0 +1,130 @@
+"""
+Mapbox vector tiles (MVT) of the lots and evaluation units, generated by PostGIS
+and cached on disk under TILE_CACHE_DIR/v{TILE_CACHE_VERSION}/{z}/{x}/{y}.mvt
+"""
+import os
+import math
+import time
+import hashlib
+import tempfile
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connection
+
+# Bump when the tile contents change (layers, attributes, simplification)
+TILE_CACHE_VERSION = 1
+
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+MAX_ZOOM = 20
+# Below these zooms the layers are left out of the tiles, there would be too many features to draw
+LOTS_MIN_ZOOM = 13
+EVALUNITS_MIN_ZOOM = 11
+# Width of the web mercator world in meters
+WORLD_WIDTH = 2 * math.pi * 6378137
+
+# The polygons are simplified to half a tile pixel, past that ST_AsMVTGeom snaps them to the grid anyway.
+# The bounding box filters use the lat/lng geometries to hit the spatial indexes.
+SQL_TILE = """
+    WITH bounds AS (
+        SELECT ST_TileEnvelope(%(z)s, %(x)s, %(y)s) AS geom,
+            ST_Transform(ST_TileEnvelope(%(z)s, %(x)s, %(y)s, margin => %(margin)s), 4326) AS geom_4326
+    )
+    SELECT
+        COALESCE((SELECT ST_AsMVT(t, 'lots', %(extent)s, 'geom') FROM (
+            SELECT l.gid, l.utilisatio AS cubf,
+                ST_AsMVTGeom(
+                    ST_SimplifyPreserveTopology(ST_Transform(l.geom, 3857), %(tolerance)s),
+                    b.geom, %(extent)s, %(buffer)s, true
+                ) AS geom
+            FROM lots l, bounds b
+            WHERE %(z)s >= %(lots_min_zoom)s AND l.geom && b.geom_4326
+        ) AS t WHERE t.geom IS NOT NULL), '')
+        ||
+        COALESCE((SELECT ST_AsMVT(t, 'evalunits', %(extent)s, 'geom') FROM (
+            SELECT e.id, e.cubf, e.num_votes, e.lot_id,
+                ST_AsMVTGeom(ST_Transform(e.point, 3857), b.geom, %(extent)s, %(buffer)s, true) AS geom
+            FROM evalunits e, bounds b
+            WHERE %(z)s >= %(evalunits_min_zoom)s AND e.point && b.geom_4326
+        ) AS t WHERE t.geom IS NOT NULL), '');
+"""
+
+
+def is_valid_tile(z, x, y):
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2**z and 0 <= y < 2**z
+
+
+def simplify_tolerance(z):
+    """Half the size of a tile pixel at zoom z, in web mercator meters"""
+    return WORLD_WIDTH / 2**z / TILE_EXTENT / 2
+
+
+def lng_lat_to_tile(lng, lat, z):
+    """Returns the x, y of the tile containing the point at zoom z"""
+    n = 2**z
+    x = int((lng + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    # Points on the east/south edges of the world belong to the last tile
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tiles_in_bbox(min_lng, min_lat, max_lng, max_lat, z):
+    """Yields the z, x, y of the tiles covering the bounding box at zoom z"""
+    min_x, min_y = lng_lat_to_tile(min_lng, max_lat, z)
+    max_x, max_y = lng_lat_to_tile(max_lng, min_lat, z)
+    for x in range(min_x, max_x + 1):
+        for y in range(min_y, max_y + 1):
+            yield z, x, y
+
+
+def tile_path(z, x, y) -> Path:
+    return Path(settings.TILE_CACHE_DIR) / f"v{TILE_CACHE_VERSION}" / str(z) / str(x) / f"{y}.mvt"
+
+
+def tile_etag(tile: bytes):
+    return f'"{hashlib.md5(tile).hexdigest()}"'
+
+
+def render_tile(z, x, y) -> bytes:
+    """Generates the tile from the database"""
+    with connection.cursor() as cursor:
+        cursor.execute(SQL_TILE, {
+            "z": z,
+            "x": x,
+            "y": y,
+            "extent": TILE_EXTENT,
+            "buffer": TILE_BUFFER,
+            "margin": TILE_BUFFER / TILE_EXTENT,
+            "tolerance": simplify_tolerance(z),
+            "lots_min_zoom": LOTS_MIN_ZOOM,
+            "evalunits_min_zoom": EVALUNITS_MIN_ZOOM,
+        })
+        return bytes(cursor.fetchone()[0])
+
+
+def get_tile(z, x, y, refresh=False):
+    """
+    Returns the tile and its ETag, from the disk cache if it's there and not older than TILE_CACHE_MAX_AGE.
+    Otherwise renders it and writes it to the cache.
+    """
+    path = tile_path(z, x, y)
+
+    if not refresh:
+        try:
+            if time.time() - path.stat().st_mtime < settings.TILE_CACHE_MAX_AGE:
+                tile = path.read_bytes()
+                return tile, tile_etag(tile)
+        except FileNotFoundError:
+            pass
+
+    tile = render_tile(z, x, y)
+
+    # Write to a temporary file first so concurrent requests never read a partial tile
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(tile)
+    os.replace(tmp_path, path)
+
+    return tile, tile_etag(tile)
@@ -62,6 +62,15 @@ def verify_github_signature(payload_body, secret_token, signature_header):
     return True
 
 
+def file_sha256(path, chunk_size=1024 * 1024):
+    """SHA-256 hex digest of the contents of the file (a Path or an archive member), read in chunks"""
+    sha256 = hashlib.sha256()
+    with path.open('rb') as f:
+        while chunk := f.read(chunk_size):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
 def sizeof_fmt(num, suffix="B"):
     """
     Human readable sizes in bytes
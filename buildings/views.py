@@ -13,19 +13,18 @@ from django.views import generic
 from django.conf import settings
 from django.db import transaction
 from django.contrib import messages
-from django.http import HttpResponse
-from django.core.paginator import Paginator
-from django.db.models import Avg, Count, Sum
-from django.db.models.functions import Round
+from django.http import Http404, HttpResponse
 from django.forms.models import model_to_dict
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import authenticate, login, logout
 from django.shortcuts import get_object_or_404, render, redirect
+from django.utils.cache import get_conditional_response, patch_cache_control
 from buildings.utils.constants import CUBF_TO_NAME_MAP
+from buildings.utils.tiles import get_tile, is_valid_tile
+from buildings.utils.pagination import CountedPaginator, KeysetPaginator
 from buildings.utils.utility import print_query_dict, verify_github_signature
-from django.core.serializers import serialize
 
 from .forms import CreateUserForm
 from .models.surveys import SurveyV1Form
@@ -48,20 +47,24 @@ log = logging.getLogger(__name__)
 def index(request):
     template = "buildings/index.html"
 
-    total_votes = Vote.objects.count() or 1
-    latest_votes = Vote.objects.order_by("-date_modified").all()
+    # Totals and leaderboard come from the cache, invalidated when votes are added or deleted
+    stats = Vote.objects.get_dashboard_stats()
+    total_votes = stats["total_votes"] or 1
+    top_3_users = stats["top_3_users"]
+    top_3_total_votes = stats["top_3_total_votes"]
+    top_3_vote_percentage = int(top_3_total_votes / total_votes * 100)
 
-    num_user_votes = Vote.objects.filter(user=request.user).count()
-    user_votes = Vote.objects.filter(user=request.user).order_by("-date_modified").all()
+    num_user_votes = Vote.objects.count_for_user(request.user.id)
 
-    top_3_users = User.objects.get_top_n(3)
-    top_3_total_votes = sum(t.num_votes for t in top_3_users)
-    top_3_vote_percentage = int(top_3_total_votes / total_votes * 100)
+    # The templates show the user and unit of each vote, and whether it's a no building flag
+    latest_votes = Vote.objects.select_related("user", "eval_unit", "nobuildingflag").order_by("-date_modified")
+    user_votes = latest_votes.filter(user=request.user)
 
+    # The cached counts spare the paginators their COUNT(*)
     page_num_latest = request.GET.get("latest_votes_page", 1)
     page_num_user = request.GET.get("user_votes_page", 1)
-    latest_votes_page = Paginator(latest_votes, 10).get_page(page_num_latest)
-    user_votes_page = Paginator(user_votes, 10).get_page(page_num_user)
+    latest_votes_page = CountedPaginator(latest_votes, 10, stats["total_votes"]).get_page(page_num_latest)
+    user_votes_page = CountedPaginator(user_votes, 10, num_user_votes).get_page(page_num_user)
     active_tab = request.GET.get("active_tab", "leaderboard")
 
     context = {
@@ -94,6 +97,9 @@ def _get_current_html_query_str(query):
         del query["order_by"]
     if "dir" in query:
         del query["dir"]
+    # Pagination cursors are not part of the search
+    for key in ["after", "before", "last", "page"]:
+        query.pop(key, None)
 
     for k, v in query.items():
         curr_query += f"&{k}={v}"
@@ -132,10 +138,15 @@ def all_buildings(request):
     log.debug(f"Ordering: {ordering}, direction: {direction}")
     qs = EvalUnit.objects.search(query=query, ordering=ordering)
 
-    paginator = Paginator(qs, 25)  # Show 25 per page.
+    # Seeks from the first/last row of the previous page instead of using OFFSET,
+    # and estimates the total count on large results
+    paginator = KeysetPaginator(qs, ordering, 25)  # Show 25 per page.
 
-    page_number = request.GET.get("page")
-    page_obj = paginator.get_page(page_number)
+    page_obj = paginator.get_page(
+        after=request.GET.get("after"),
+        before=request.GET.get("before"),
+        last="last" in request.GET,
+    )
 
     current_search_query = _get_current_html_query_str(query)
 
@@ -154,51 +165,44 @@ def all_buildings(request):
 
 
 @login_required(login_url="buildings:login")
-def survey(_):
-    random_unscored_unit = EvalUnit.objects.get_next_unit_to_survey()
+def survey(request):
+    random_unscored_unit = EvalUnit.objects.get_next_unit_to_survey(user=request.user)
     eval_unit_id = random_unscored_unit.id
     return redirect("buildings:survey_v1", eval_unit_id=eval_unit_id)
 
 
 @login_required(login_url="buildings:login")
 def survey_v1(request, eval_unit_id):
-    eval_unit = get_object_or_404(EvalUnit, pk=eval_unit_id)
-
-    hlms = None
-    hlm_info = None
+    # Loads the unit with its HLMs, the user's previous votes, the latest view data,
+    # the lot polygon and the next unit of the user's batch in a single query.
+    # This also takes the unit out of the batch leased to the user, since they are now on it.
+    eval_unit = EvalUnit.objects.get_survey_page_data(eval_unit_id, request.user.id)
+    if eval_unit is None:
+        raise Http404("No EvalUnit matches the given query.")
+
+    hlms = eval_unit.hlms
+    hlm_info = eval_unit.hlm_info
     avg_disrepair = None
 
-    # if eval_unit.associated is not None and 'hlm' in eval_unit.associated:
-    hlms = HLMBuilding.objects.filter(eval_unit=eval_unit).order_by("street_num")
-    if len(hlms) > 0:
-        hlm_info = hlms.aggregate(
-            num_hlms=Count("*"),
-            total_dwellings=Sum("num_dwellings"),
-            avg_ivp=Round(Avg("ivp"), precision=1),
-        )
+    if hlm_info:
         avg_disrepair = HLMBuilding.get_disrepair_state(hlm_info["avg_ivp"])
 
-    # Fetch any previous survey v1 entry for this building
-    # If none exist, initialize a survey with the building and user ids
-    # TODO: This might become slow once there are many Votes
-    previous_survey_vote = Vote.objects.filter(
-        user=request.user, eval_unit=eval_unit, surveyv1__isnull=False
-    ).first()
+    # Previous survey v1 entry for this building
+    previous_survey_vote = eval_unit.previous_survey_vote
+    prev_survey_instance = eval_unit.previous_survey
 
     if previous_survey_vote:
         log.debug("Found previous survey instance!")
-        # We know the survey is not null here since we filtered on that above
-        prev_survey_instance = previous_survey_vote.surveyv1
-    else:
-        prev_survey_instance = None
 
-    previous_no_building_vote = Vote.objects.filter(
-        user=request.user, eval_unit=eval_unit, nobuildingflag__isnull=False
-    ).first()
+    previous_no_building_vote = eval_unit.previous_no_building_vote
 
     if previous_no_building_vote:
         log.debug("Previously voted no building!")
 
+    # The lease on the current unit was released above, so this can't be the current unit
+    next_eval_unit_id = eval_unit.next_leased_id
+    latest_view_data_value = eval_unit.latest_view_data
+
     if request.method == "POST":
         # Save the last orientation/zoom for the building for later visits
         if "latest_view_data" in request.POST:
@@ -216,6 +220,9 @@ def survey_v1(request, eval_unit_id):
                     marker_lng=data["marker_lng"],
                 )
                 latest_view_data.save()
+                latest_view_data_value = model_to_dict(
+                    latest_view_data, exclude=["id", "user", "date_added"]
+                )
 
         if "no_building" in request.POST:
             # Because we'll be creating multiple DB objects with relations to each other,
@@ -233,9 +240,10 @@ def survey_v1(request, eval_unit_id):
                 no_building = NoBuildingFlag(vote=new_vote)
                 no_building.save()
 
-            next_eval_unit_id = EvalUnit.objects.get_next_unit_to_survey(
-                exclude_id=eval_unit.id, id_only=True
-            )
+            if next_eval_unit_id is None:
+                next_eval_unit_id = EvalUnit.objects.get_next_unit_to_survey(
+                    exclude_id=eval_unit.id, id_only=True, user=request.user
+                )
             return redirect("buildings:survey_v1", eval_unit_id=next_eval_unit_id)
 
         # Handle submission of the survey
@@ -267,58 +275,23 @@ def survey_v1(request, eval_unit_id):
                     form.save()
 
                 # Update the eval unit to a new one
-                next_eval_unit_id = EvalUnit.objects.get_next_unit_to_survey(
-                    exclude_id=eval_unit.id, id_only=True
-                )
+                if next_eval_unit_id is None:
+                    next_eval_unit_id = EvalUnit.objects.get_next_unit_to_survey(
+                        exclude_id=eval_unit.id, id_only=True, user=request.user
+                    )
                 # We redirect so the URL updates to the next building ID
                 return redirect("buildings:survey_v1", eval_unit_id=next_eval_unit_id)
             else:
                 log.error(form.errors)
 
-    # Fetch the latest view data for the current building if it exists
-    latest_view_data_value = EvalUnitLatestViewData.objects.get_latest_view_data(
-        eval_unit.id, request.user.id
-    )
-
-    if latest_view_data_value:
-        latest_view_data_value = model_to_dict(
-            latest_view_data_value, exclude=["id", "user", "date_added"]
+    # Get the next building if the user's batch is used up
+    if next_eval_unit_id is None:
+        next_eval_unit_id = EvalUnit.objects.get_next_unit_to_survey(
+            exclude_id=eval_unit.id, id_only=True, user=request.user
         )
 
-    # Get the next building
-    next_eval_unit_id = EvalUnit.objects.get_next_unit_to_survey(
-        exclude_id=eval_unit.id, id_only=True
-    )
-
     form = SurveyV1Form(instance=prev_survey_instance)
 
-    # Load the lot polygon
-    # https://django.readthedocs.io/en/stable/ref/contrib/gis/functions.html
-    # https://django.readthedocs.io/en/stable/ref/contrib/gis/serializers.html
-    # eval_unit.geom = eval_unit.geom.simplify(0.000005)
-    # lot_geojson = json.loads(serialize('geojson', [eval_unit], geometry_field='geom', fields=[]))
-
-    # lot_geojson = None
-    # with connection.cursor() as cursor:
-    #     cursor.execute(f"select st_asgeojson(st_simplify(lot_geom, 0.000005, true)) from evalunits where id = %s", [eval_unit_id])
-    #     row = cursor.fetchone()
-    #     # If we get a result
-    #     if row and row[0]:
-    #         print(cursor.mogrify(f"select st_asgeojson(st_simplify(lot_geom, 0.000005, true)) from evalunits where id = %s", [eval_unit_id]))
-    #         print(row)
-    #         lot_geojson = {
-    #             'type': 'Feature',
-    #             'geometry': json.loads(row[0])
-    #         }
-
-    lot_geojson = (
-        json.loads(
-            serialize("geojson", [eval_unit.lot], geometry_field="geom", fields=["gid"])
-        )
-        if eval_unit.lot
-        else None
-    )
-
     context = {
         "key": settings.GOOGLE_MAPS_API_KEY,
         "eval_unit": eval_unit,
@@ -326,7 +299,7 @@ def survey_v1(request, eval_unit_id):
             "lat": eval_unit.lat,
             "lng": eval_unit.lng,
         },
-        "geojson": lot_geojson,
+        "geojson": eval_unit.lot_geojson,
         "latest_view_data_value": latest_view_data_value,
         "next_eval_unit_id": next_eval_unit_id,
         "form": form,
@@ -339,6 +312,25 @@ def survey_v1(request, eval_unit_id):
     return render(request, "buildings/survey.html", context)
 
 
+@login_required(login_url="buildings:login")
+def tile(request, z, x, y):
+    """
+    Vector tile of the lots and evaluation units, served from the disk cache when possible.
+    Clients revalidate with the ETag and get a 304 if the tile did not change.
+    """
+    if not is_valid_tile(z, x, y):
+        raise Http404("Tile out of range")
+
+    mvt, etag = get_tile(z, x, y)
+
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = HttpResponse(mvt, content_type="application/vnd.mapbox-vector-tile")
+    response["ETag"] = etag
+    patch_cache_control(response, private=True, max_age=settings.TILE_CACHE_MAX_AGE)
+    return response
+
+
 class EvalUnitDetailView(generic.DetailView):
     """
     TODO: Create a detail view for out eval units, showing votes and info summary
@@ -34,6 +34,11 @@ env = environ.Env(
     POSTGRES_PORT=(int, ''),
     GDAL_LIBRARY_PATH=(str, ''),
     GEOS_LIBRARY_PATH=(str, ''),
+    CACHE_URL=(str, 'locmemcache://'),
+    TILE_CACHE_DIR=(str, ''),
+    TILE_CACHE_MAX_AGE=(int, 86400),
+    REQUEST_PROFILING=(bool, False),
+    REQUEST_PROFILING_LOG=(str, ''),
 )
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -71,6 +76,11 @@ B2_APPKEY_RW = env('B2_APPKEY_RW')
 B2_ENDPOINT = env('B2_ENDPOINT')
 B2_BUCKET_IMAGES = env('B2_BUCKET_IMAGES')
 
+# Vector tiles cached on disk, regenerated once older than the max age (in seconds)
+# A relative cache directory is taken from the project root
+TILE_CACHE_DIR = BASE_DIR / (env('TILE_CACHE_DIR') or 'data/tiles')
+TILE_CACHE_MAX_AGE = env('TILE_CACHE_MAX_AGE')
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/4.1/howto/static-files/
 STATIC_URL = env('STATIC_URL')
@@ -110,6 +120,29 @@ LOGGING = {
     },
 }
 
+# Per request timings and SQL stats, see buildings/middleware.py
+# Logged as JSON lines to a rotating file, relative paths are taken from the project root
+REQUEST_PROFILING = env('REQUEST_PROFILING')
+REQUEST_PROFILING_LOG = BASE_DIR / (env('REQUEST_PROFILING_LOG') or 'logs/profiling.log')
+
+if REQUEST_PROFILING:
+    REQUEST_PROFILING_LOG.parent.mkdir(parents=True, exist_ok=True)
+    LOGGING['formatters'] = {
+        'message_only': {'format': '%(message)s'},
+    }
+    LOGGING['handlers']['profiling'] = {
+        'class': 'logging.handlers.RotatingFileHandler',
+        'filename': REQUEST_PROFILING_LOG,
+        'maxBytes': 10 * 1024 * 1024,
+        'backupCount': 5,
+        'formatter': 'message_only',
+    }
+    LOGGING['loggers']['buildings.profiling'] = {
+        'level': 'INFO',
+        'handlers': ['profiling'],
+        'propagate': False,
+    }
+
 INSTALLED_APPS = [
     "buildings.apps.BuildingsConfig",
     "django.contrib.admin",
@@ -124,6 +157,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First so its timings cover the other middlewares, only active if REQUEST_PROFILING is set
+    "buildings.middleware.RequestProfilingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -178,6 +213,13 @@ DATABASES = {
     }
 }
 
+# Cache, process local by default. Use a shared one (e.g. redis://) in production
+# so that management commands can invalidate what the web server cached.
+# https://django-environ.readthedocs.io/en/latest/types.html#environ-env-cache-url
+CACHES = {
+    "default": env.cache('CACHE_URL'),
+}
+
 # https://docs.djangoproject.com/en/4.2/topics/auth/customizing/#extending-the-existing-user-model
 AUTH_USER_MODEL = "buildings.User"
 
@@ -0,0 +1,43 @@
+import unittest
+import tempfile
+import importlib.util
+from pathlib import Path
+
+from django.test import TestCase
+from django.contrib.gis.geos import Point
+from buildings.models import EvalUnit
+from buildings.utils.columnar import arrow_schema, copy_parquet, import_pyarrow, write_parquet
+from buildings.utils.synthetic_roll import generate_roll
+from buildings.management.commands.benchmark_roll_ingestion import parse_lxml
+
+
+@unittest.skipUnless(importlib.util.find_spec('pyarrow'), "pyarrow isn't installed")
+class ParquetSnapshotTestCase(TestCase):
+
+    def setUp(self):
+        tmp_folder = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_folder.cleanup)
+        self.folder = Path(tmp_folder.name)
+        self.units = list(parse_lxml(generate_roll(self.folder, 20, num_files=1, seed=4)))
+        self.units[0].point = Point(-73.5673, 45.5017, srid=4326)
+        self.units[0].associated = {'hlm': ['hlm1']}
+
+    def test_round_trip(self):
+        path = self.folder / self.units[0].muni_code / 'units.parquet'
+        self.assertEqual(write_parquet(EvalUnit, self.units, path), 20)
+        _, pq = import_pyarrow()
+        self.assertEqual(pq.read_schema(path), arrow_schema(EvalUnit))
+
+        # Already in the database, it is skipped
+        stored = self.units[1]
+        EvalUnit.objects.create(id=stored.id, year=2022, muni=stored.muni, address='Stored', mat18=stored.mat18, cubf=1000)
+
+        self.assertEqual(copy_parquet(EvalUnit, path), 19)
+        self.assertEqual(EvalUnit.objects.get(id=stored.id).address, 'Stored')
+
+        # The values are converted back to those of the fields, e.g. the year parsed from the XML's text,
+        # and the point with its SRID from its EWKB
+        for unit in [self.units[0], self.units[2]]:
+            loaded = EvalUnit.objects.get(id=unit.id)
+            for field in EvalUnit._meta.concrete_fields:
+                self.assertEqual(getattr(loaded, field.attname), field.to_python(getattr(unit, field.attname)), field.name)
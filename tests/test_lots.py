@@ -0,0 +1,67 @@
+import io
+import unittest
+import importlib.util
+from unittest import mock
+
+from django.db import connection
+from django.test import TransactionTestCase
+from django.contrib.gis.geos import MultiPolygon, Point, Polygon
+from buildings.models import EvalUnit
+from buildings.models.models import EvalUnitLot
+from buildings.management.commands import process_lots
+
+
+def squares(*xs):
+    """Lot of unit squares at these x, containing the units at (x + 0.5, 0.5)"""
+    return MultiPolygon([Polygon.from_bbox((x, 0, x + 1, 1)) for x in xs], srid=4326)
+
+
+class LotLinkingTestCase(TransactionTestCase):
+    """The linker commits on its own connection, so the lots and units must be committed"""
+
+    def setUp(self):
+        settings = connection.settings_dict
+        conn_str = (f"postgresql://{settings['USER']}:{settings['PASSWORD']}"
+                    f"@{settings['HOST']}:{settings['PORT']}/{settings['NAME']}")
+        for name, value in [('DB_CONN_STR', conn_str), ('LINK_CHUNK_SIZE', 2)]:
+            patcher = mock.patch.object(process_lots, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        for i, x in enumerate([0, 5, 10, 15], start=1):
+            EvalUnit.objects.create(id=f'u{i}', point=Point(x + 0.5, 0.5, srid=4326), year=2022, muni='test',
+                                    address=f'{i} Rue Test', mat18=f'{i:018d}', cubf=1000)
+
+        # The gids are text, so the chunks of 2 lots are: 6 and 5, 4 and 3, 2 and 10, then 1
+        lots = [
+            ('1', 'u1', None),
+            ('2', 'Multiple', squares(15)),
+            ('3', 'u2', None),
+            ('4', 'Multiple', squares(5)),
+            ('5', 'Multiple', squares(10)),
+            ('6', 'u3', None),
+            ('10', 'Multiple', squares(0, 15)),
+        ]
+        for gid, id_provinc, geom in lots:
+            EvalUnitLot.objects.create(gid=gid, id_provinc=id_provinc, code_mun='1', geom=geom)
+
+    def link(self, spatial_engine):
+        command = process_lots.Command(stdout=io.StringIO())
+        process_lots.link_lots_to_evalunits(command, spatial_engine=spatial_engine, num_workers=1)
+        return dict(EvalUnit.objects.values_list('id', 'lot_id'))
+
+    def test_smallest_gid_wins(self):
+        self.assertEqual(self.link('postgis'), {
+            # The single-ID lot over a 'Multiple' lot with a larger gid, in a later chunk
+            'u1': '1',
+            # Over a 'Multiple' lot with a larger gid in the same chunk
+            'u2': '3',
+            # The 'Multiple' lot over a single-ID lot with a larger gid in the same chunk
+            'u3': '5',
+            # The smallest gid in text order among 'Multiple' lots
+            'u4': '10',
+        })
+
+    @unittest.skipUnless(importlib.util.find_spec('shapely'), "shapely isn't installed")
+    def test_shapely_engine_agrees(self):
+        self.assertEqual(self.link('shapely'), {'u1': '1', 'u2': '3', 'u3': '5', 'u4': '10'})
@@ -1,5 +1,14 @@
+import os
+import tempfile
+from pathlib import Path
+
 from django.test import TestCase
-from buildings.models.models import EvalUnit, User, Vote
+from django.core.cache import cache
+from django.contrib.gis.geos import Point
+from buildings.models.models import (
+    EvalUnit, EvalUnitLot, RollIngestionFile, SurveyLease, SurveyQueueEntry, User, Vote, SURVEY_LEASE_BATCH_SIZE,
+)
+from buildings.utils.bulk_load import copy_objects
 
 class EvalUnitTestCase(TestCase):
     serialized_rollback = False
@@ -18,6 +27,23 @@ class EvalUnitTestCase(TestCase):
         self.eval_unit.cubf = 1234
         self.assertEqual(self.eval_unit.cubf_name(), "")
 
+    def test_search(self):
+        search = lambda query: sorted(EvalUnit.objects.search(query).values_list('id', flat=True))
+        self.eval_unit2.muni = 'laval'
+        self.eval_unit2.arrond = 'chomedey'
+        self.eval_unit2.cubf = 1211
+        self.eval_unit2.save()
+
+        self.assertListEqual(search({'q_locality': 'MTL'}), ['id1'])
+        self.assertListEqual(search({'q_region': 'chom'}), ['id2'])
+        # CUBF by code prefix or by name
+        self.assertListEqual(search({'q_cubf': '12'}), ['id2'])
+        self.assertListEqual(search({'q_cubf': 'maison mobi'}), ['id2'])
+        self.assertListEqual(search({'q_cubf': 'zzz'}), [])
+        # Free text, each word is a prefix
+        self.assertListEqual(search({'q': '465 lav'}), ['id2'])
+        self.assertListEqual(search({'q': 'a st'}), ['id1', 'id2'])
+
     # TODO: Worked before as we returned the least voted unit, but broken bc of unofficially prioritzing HLMs
     # def test_get_next_evalunit_to_vote(self):
     #     # create a new vote on the first eval unit
@@ -37,4 +63,186 @@ class EvalUnitTestCase(TestCase):
 
     #     # Now if we exlcude id1, it should give us id2
     #     eu = EvalUnit.objects.get_next_unit_to_survey(id_only=True, exclude_id='id1')
-    #     self.assertEqual(eu, self.eval_unit2.id)
\ No newline at end of file
+    #     self.assertEqual(eu, self.eval_unit2.id)
+
+class SurveyQueueTestCase(TestCase):
+    serialized_rollback = False
+
+    def setUp(self):
+        self.user = User.objects.create_superuser(username='testuser', password='testpw')
+        self.eval_unit = EvalUnit.objects.create(id='id1', lat=1.0, lng=1.5, muni='mtl', year=2005, address='123 a st', mat18='fsd', cubf=1000)
+        self.eval_unit2 = EvalUnit.objects.create(id='id2', lat=1.0, lng=1.5, muni='mtl',year=2005,  address='4656 a st', mat18='fsdfsd', cubf=1000)
+        SurveyQueueEntry.objects.create(eval_unit=self.eval_unit)
+        SurveyQueueEntry.objects.create(eval_unit=self.eval_unit2)
+
+    def test_votes_update_counts(self):
+        vote = Vote.objects.create(eval_unit = self.eval_unit, user = self.user)
+        self.assertEqual(SurveyQueueEntry.objects.get(pk='id1').num_votes, 1)
+        self.assertEqual(EvalUnit.objects.get(pk='id1').num_votes, 1)
+
+        # Modifying a vote should not count it twice
+        vote.save()
+        self.assertEqual(SurveyQueueEntry.objects.get(pk='id1').num_votes, 1)
+        self.assertEqual(EvalUnit.objects.get(pk='id1').num_votes, 1)
+
+        # Vote count filters use the denormalized column
+        self.assertListEqual(
+            list(EvalUnit.objects.search({'q_num_votes': 1, 'q_num_votes_op': 'eq'}).values_list('id', flat=True)), 
+            ['id1']
+        )
+
+        vote.delete()
+        self.assertEqual(SurveyQueueEntry.objects.get(pk='id1').num_votes, 0)
+        self.assertEqual(EvalUnit.objects.get(pk='id1').num_votes, 0)
+
+    def test_get_next_unit_from_least_voted_bucket(self):
+        Vote.objects.create(eval_unit = self.eval_unit, user = self.user)
+
+        # Now we should get the other as the next to vote on
+        eu = EvalUnit.objects.get_next_unit_to_survey(id_only=True)
+        self.assertEqual(eu, self.eval_unit2.id)
+
+        # vote on the second one twice
+        Vote.objects.create(eval_unit = self.eval_unit2, user = self.user)
+        Vote.objects.create(eval_unit = self.eval_unit2, user = self.user)
+
+        # Now it should return the least voted one, the first
+        eu = EvalUnit.objects.get_next_unit_to_survey(id_only=True)
+        self.assertEqual(eu, self.eval_unit.id)
+
+        # Now if we exlcude id1, it should give us id2
+        eu = EvalUnit.objects.get_next_unit_to_survey(id_only=True, exclude_id='id1')
+        self.assertEqual(eu, self.eval_unit2.id)
+
+    def test_leases_are_not_shared_between_users(self):
+        user2 = User.objects.create_user(username='testuser2', password='testpw')
+        # Two batches and one unit queued
+        for i in range(3, 2 * SURVEY_LEASE_BATCH_SIZE + 2):
+            eval_unit = EvalUnit.objects.create(id=f'id{i}', lat=1.0, lng=1.5, muni='mtl', year=2005, address=f'{i} a st', mat18=f'mat{i}', cubf=1000)
+            SurveyQueueEntry.objects.create(eval_unit=eval_unit)
+        leased_ids = lambda user: set(SurveyLease.objects.filter(user=user).values_list('eval_unit_id', flat=True))
+
+        eu = EvalUnit.objects.get_next_unit_to_survey(id_only=True, user=self.user)
+        eu2 = EvalUnit.objects.get_next_unit_to_survey(id_only=True, user=user2)
+        self.assertEqual(len(leased_ids(self.user)), SURVEY_LEASE_BATCH_SIZE)
+        self.assertEqual(len(leased_ids(user2)), SURVEY_LEASE_BATCH_SIZE)
+        self.assertSetEqual(leased_ids(self.user) & leased_ids(user2), set())
+        self.assertIn(eu, leased_ids(self.user))
+        self.assertIn(eu2, leased_ids(user2))
+
+        # Without a user, only the unit nobody leased is handed out
+        unleased_id, = {f'id{i}' for i in range(1, 2 * SURVEY_LEASE_BATCH_SIZE + 2)} - leased_ids(self.user) - leased_ids(user2)
+        self.assertEqual(EvalUnit.objects.get_next_unit_to_survey(id_only=True), unleased_id)
+
+        # The user keeps getting their oldest leased unit until they take it
+        self.assertEqual(EvalUnit.objects.get_next_unit_to_survey(id_only=True, user=self.user), eu)
+        SurveyLease.objects.release(self.user, eu)
+        self.assertNotIn(eu, leased_ids(self.user))
+        self.assertEqual(len(leased_ids(self.user)), SURVEY_LEASE_BATCH_SIZE - 1)
+        self.assertNotEqual(EvalUnit.objects.get_next_unit_to_survey(id_only=True, user=self.user), eu)
+
+
+    def test_dashboard_stats_are_cached_until_votes_change(self):
+        cache.clear()
+        self.assertEqual(Vote.objects.get_dashboard_stats()['total_votes'], 0)
+        self.assertEqual(Vote.objects.count_for_user(self.user.id), 0)
+        with self.assertNumQueries(0):
+            Vote.objects.get_dashboard_stats()
+            Vote.objects.count_for_user(self.user.id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Vote.objects.create(eval_unit = self.eval_unit, user = self.user)
+
+        stats = Vote.objects.get_dashboard_stats()
+        self.assertEqual(stats['total_votes'], 1)
+        self.assertEqual(stats['top_3_total_votes'], 1)
+        self.assertEqual(stats['top_3_users'][0].username, 'testuser')
+        self.assertEqual(Vote.objects.count_for_user(self.user.id), 1)
+
+
+class EvalUnitLotTestCase(TestCase):
+    serialized_rollback = False
+
+    def setUp(self):
+        EvalUnitLot.objects.invalidate_geojson_cache()
+        self.lot = EvalUnitLot.objects.create(gid='1', id_provinc='id1', geojson='{"type": "FeatureCollection", "features": []}')
+
+    def test_geojson_is_cached(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(EvalUnitLot.objects.get_geojson('1'), {"type": "FeatureCollection", "features": []})
+        with self.assertNumQueries(0):
+            self.assertEqual(EvalUnitLot.objects.get_geojson('1'), {"type": "FeatureCollection", "features": []})
+
+        # Reimported lots are fetched again
+        EvalUnitLot.objects.filter(gid='1').update(geojson='{"type": "FeatureCollection", "features": [{}]}')
+        EvalUnitLot.objects.invalidate_geojson_cache()
+        with self.assertNumQueries(1):
+            self.assertEqual(EvalUnitLot.objects.get_geojson('1'), {"type": "FeatureCollection", "features": [{}]})
+
+
+class BulkLoadTestCase(TestCase):
+    serialized_rollback = False
+
+    def setUp(self):
+        EvalUnit.objects.create(id='id1', lat=1.0, lng=1.5, muni='mtl', year=2005, address='123 a st', mat18='fsd', cubf=1000)
+
+    def test_copy_objects(self):
+        units = [
+            EvalUnit(id='id1', muni='laval', year=2005, address='123 a st', mat18='fsd', cubf=1000),
+            EvalUnit(id='id2', point=Point(1.5, 1.0, srid=4326), muni='mtl', year=2005,
+                     address='4656 a\tst\\', mat18='fsdfsd', cubf=1000, associated={'hlm': ['hlm1']}),
+        ]
+        # Existing units are left as they are
+        self.assertEqual(copy_objects(EvalUnit, units), 1)
+        self.assertEqual(EvalUnit.objects.get(id='id1').muni, 'mtl')
+
+        unit = EvalUnit.objects.get(id='id2')
+        self.assertEqual(unit.address, '4656 a\tst\\')
+        self.assertEqual(unit.point, Point(1.5, 1.0, srid=4326))
+        self.assertEqual(unit.associated, {'hlm': ['hlm1']})
+
+        # Or updated
+        self.assertEqual(copy_objects(EvalUnit, units[:1], update_fields=['muni']), 1)
+        self.assertEqual(EvalUnit.objects.get(id='id1').muni, 'laval')
+
+
+class RollIngestionFileTestCase(TestCase):
+    serialized_rollback = False
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tempdir.name) / 'RL66023.xml'
+        self.path.write_text('<RLUEx></RLUEx>')
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_progress_is_kept_until_the_file_changes(self):
+        entry = RollIngestionFile.objects.get_for_file(self.path)
+        self.assertEqual(entry.status, RollIngestionFile.Status.PENDING)
+        entry.chunks.create(start=0).checkpoint(1000)
+
+        # Same contents, e.g. downloaded again
+        self.path.write_text('<RLUEx></RLUEx>')
+        os.utime(self.path, (0, 0))
+        entry = RollIngestionFile.objects.get_for_file(self.path)
+        self.assertEqual(entry.chunks.get().num_units_done, 1000)
+
+        self.path.write_text('<RLUEx><RL0105A>1000</RL0105A></RLUEx>')
+        entry = RollIngestionFile.objects.get_for_file(self.path)
+        self.assertEqual(entry.status, RollIngestionFile.Status.PENDING)
+        self.assertFalse(entry.chunks.exists())
+
+    def test_files_are_done_when_all_their_chunks_are(self):
+        entry = RollIngestionFile.objects.get_for_file(self.path)
+        entry.chunks.create(start=0, stop=10).checkpoint(1, done=True)
+        chunk = entry.chunks.create(start=10)
+
+        RollIngestionFile.objects.mark_completed()
+        entry.refresh_from_db()
+        self.assertEqual(entry.status, RollIngestionFile.Status.PENDING)
+
+        chunk.checkpoint(1, done=True)
+        RollIngestionFile.objects.mark_completed()
+        entry.refresh_from_db()
+        self.assertEqual(entry.status, RollIngestionFile.Status.DONE)
@@ -0,0 +1,98 @@
+import re
+import tempfile
+from pathlib import Path
+
+from django.db import connection
+from django.test import TestCase
+from buildings.models import EvalUnit
+from buildings.utils.bulk_load import copy_objects
+from buildings.utils.roll_schema import unit_table_ddl
+from buildings.utils.synthetic_roll import generate_roll
+from buildings.management.commands.aggregate_murbs import MURB_DISAG_TABLE
+from buildings.management.commands.benchmark_roll_ingestion import parse_lxml
+from buildings.management.commands.process_roll_xml import (
+    add_missing_ids, delete_removed_units, parse_xml_chunk, plan_tasks_without_manifest,
+)
+
+
+def apply_delta(xml_files):
+    """Applies the XMLs as a delta in process, like launch_jobs. Returns the number of units deleted."""
+    removed_ids = {}
+    for task in plan_tasks_without_manifest([(xml_file, None) for xml_file in xml_files], delta=True):
+        _, _, missing = parse_xml_chunk(task)
+        if missing is not None:
+            add_missing_ids(removed_ids, *missing)
+    return delete_removed_units(removed_ids)
+
+
+class RollDeltaTestCase(TestCase):
+
+    def setUp(self):
+        tmp_folder = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_folder.cleanup)
+        self.xml_file, = generate_roll(Path(tmp_folder.name), 60, num_files=1, seed=2)
+
+        # The units of the XML, as imported then without the units missing street numbers
+        self.units = [unit for unit in parse_lxml([self.xml_file]) if unit.num_adr_inf or unit.num_adr_sup]
+        copy_objects(EvalUnit, self.units)
+        self.muni_code = self.units[0].muni_code
+
+    def stored_ids(self):
+        return set(EvalUnit.objects.values_list('id', flat=True))
+
+    def add_unit(self, id, muni_code=None):
+        return EvalUnit.objects.create(id=id, muni_code=muni_code or self.muni_code, year=2022, muni='test',
+                                       address='1 Rue Test', mat18=id[-18:], cubf=1000)
+
+    def break_unit(self, unit, pattern, replacement):
+        """Rewrites the unit's element in the XML, the unit being found by its MAT18 (RL0104C)"""
+        xml = self.xml_file.read_text()
+        units = xml.split('</RLUEx>')
+        i = next(i for i, unit_xml in enumerate(units) if f'<RL0104C>{unit.mat18[6:10]}</RL0104C>' in unit_xml)
+        units[i] = re.sub(pattern, replacement, units[i], count=1)
+        self.xml_file.write_text('</RLUEx>'.join(units))
+
+    def test_unchanged_roll(self):
+        self.assertEqual(apply_delta([self.xml_file]), 0)
+        self.assertEqual(self.stored_ids(), {unit.id for unit in self.units})
+
+    def test_inserts_updates_and_deletes(self):
+        removed, changed = self.units[:2]
+        EvalUnit.objects.filter(id=removed.id).delete()
+        EvalUnit.objects.filter(id=changed.id).update(address='Changed', content_hash='stale')
+        self.add_unit(self.muni_code + 'X' * 18)
+        # Another municipality isn't in the XMLs
+        other = self.add_unit('99999' + 'X' * 18, muni_code='99999')
+
+        self.assertEqual(apply_delta([self.xml_file]), 1)
+        self.assertEqual(self.stored_ids(), {unit.id for unit in self.units} | {other.id})
+        self.assertEqual(EvalUnit.objects.get(id=changed.id).address, changed.address)
+        self.assertEqual(EvalUnit.objects.get(id=removed.id).content_hash, removed.content_hash)
+
+    def test_aggregated_murbs_are_kept(self):
+        disaggregated = self.units[:2]
+        aggregated = self.add_unit(self.muni_code + 'MURB')
+        EvalUnit.objects.filter(id__in=[unit.id for unit in disaggregated]).delete()
+        with connection.cursor() as cursor:
+            cursor.execute(unit_table_ddl(MURB_DISAG_TABLE, {'agg_id': 'TEXT NOT NULL'}))
+            for unit in disaggregated:
+                cursor.execute(f"INSERT INTO {MURB_DISAG_TABLE} (id, agg_id, muni_code) VALUES (%s, %s, %s)",
+                               [unit.id, aggregated.id, self.muni_code])
+
+        self.assertEqual(apply_delta([self.xml_file]), 0)
+        # The aggregated MURB still replaces its units
+        self.assertEqual(self.stored_ids(), {unit.id for unit in self.units[2:]} | {aggregated.id})
+
+    def test_units_failing_to_parse_are_kept(self):
+        removed = self.add_unit(self.muni_code + 'X' * 18)
+        # The owner date is parsed after the ID is known
+        self.break_unit(self.units[0], r'<RL0201Gx>[^<]*', '<RL0201Gx>not a date')
+        self.assertEqual(apply_delta([self.xml_file]), 1)
+        self.assertNotIn(removed.id, self.stored_ids())
+        self.assertIn(self.units[0].id, self.stored_ids())
+
+        # Without its MAT18, the unit can't be told apart from the missing ones, none is deleted
+        removed = self.add_unit(self.muni_code + 'X' * 18)
+        self.break_unit(self.units[1], r'<RL0104A>[^<]*</RL0104A>', '')
+        self.assertEqual(apply_delta([self.xml_file]), 0)
+        self.assertEqual(self.stored_ids(), {unit.id for unit in self.units} | {removed.id})
@@ -0,0 +1,39 @@
+import tempfile
+from pathlib import Path
+
+from django.test import TestCase
+from buildings.models import EvalUnit, RollIngestionFile
+from buildings.utils.synthetic_roll import generate_roll
+from buildings.management.commands.benchmark_roll_ingestion import parse_lxml
+from buildings.management.commands.process_roll_xml import get_xmls_to_process, parse_xml_chunk, plan_tasks
+
+
+def import_roll(xml_files, restart=False):
+    """Imports the XMLs in process, like launch_jobs. Returns the number of units created."""
+    tasks = plan_tasks(get_xmls_to_process(xml_files, restart=restart))
+    num_created = sum(parse_xml_chunk(task)[0] for task in tasks)
+    RollIngestionFile.objects.mark_completed()
+    return num_created
+
+
+class RollImportTestCase(TestCase):
+
+    def setUp(self):
+        tmp_folder = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_folder.cleanup)
+        self.xml_files = generate_roll(Path(tmp_folder.name), 60, num_files=2, seed=5)
+        self.ids = {unit.id for unit in parse_lxml(self.xml_files)}
+
+    def test_import(self):
+        self.assertEqual(len(get_xmls_to_process(self.xml_files)), 2)
+        self.assertEqual(import_roll(self.xml_files), 60)
+        self.assertEqual(set(EvalUnit.objects.values_list('id', flat=True)), self.ids)
+
+        # The completed XMLs are skipped by the next run
+        self.assertEqual(get_xmls_to_process(self.xml_files), [])
+        self.assertEqual(import_roll(self.xml_files), 0)
+
+    def test_restart_skips_the_existing_units(self):
+        num_units = import_roll(self.xml_files[:1])
+        self.assertEqual(import_roll(self.xml_files, restart=True), 60 - num_units)
+        self.assertEqual(EvalUnit.objects.count(), 60)
@@ -0,0 +1,64 @@
+import zipfile
+import tempfile
+from pathlib import Path
+
+from django.test import SimpleTestCase
+from django.forms.models import model_to_dict
+from buildings.models import EvalUnit
+from buildings.utils.archives import ZipMember, find_files
+from buildings.utils.roll_schema import UNIT_COLUMN_NAMES
+from buildings.utils.synthetic_roll import generate_roll
+from buildings.management.commands.benchmark_roll_ingestion import parse_lxml, parse_pulldom
+from buildings.management.commands.process_roll_xml import ROLL_ARCHIVE, find_chunk_starts, find_roll_xmls, iter_units_lxml
+
+
+class RollParsingTestCase(SimpleTestCase):
+
+    def setUp(self):
+        tmp_folder = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_folder.cleanup)
+        self.xml_files = generate_roll(Path(tmp_folder.name), 300, num_files=3, seed=1)
+
+    def test_parsers_agree(self):
+        lxml_units = [model_to_dict(unit, exclude=['date_added']) for unit in parse_lxml(self.xml_files)]
+        pulldom_units = [model_to_dict(unit, exclude=['date_added']) for unit in parse_pulldom(self.xml_files)]
+        self.assertEqual(len(lxml_units), 300)
+        self.assertEqual(len({unit['id'] for unit in lxml_units}), 300)
+        self.assertEqual(lxml_units, pulldom_units)
+
+    def test_chunks_cover_the_file(self):
+        xml_file = self.xml_files[0]
+        starts = find_chunk_starts(xml_file, chunk_size=10_000)
+        self.assertGreater(len(starts), 2)
+
+        ids = lambda units: [elem.findtext('RL0104/RL0104C') for _, _, elem in units]
+        chunk_ids = [
+            id for start, stop in zip(starts, starts[1:] + [None])
+            for id in ids(iter_units_lxml(xml_file, start, stop))
+        ]
+        self.assertEqual(chunk_ids, ids(iter_units_lxml(xml_file)))
+
+    def test_archive_members_are_not_split(self):
+        xml_file = self.xml_files[0]
+        with zipfile.ZipFile(xml_file.with_suffix('.zip'), 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.write(xml_file, xml_file.name)
+        member, = [f for f in find_files(xml_file.parent, xml_file.name) if isinstance(f, ZipMember)]
+        self.assertEqual(find_chunk_starts(member, chunk_size=10_000), [0])
+
+    def test_only_the_year_archive_is_read(self):
+        folder = self.xml_files[0].parent
+        for year, xml_files in [(2022, self.xml_files[:2]), (2024, self.xml_files[2:])]:
+            with zipfile.ZipFile(folder / ROLL_ARCHIVE.format(year=year), 'w') as zf:
+                for xml_file in xml_files:
+                    zf.write(xml_file, xml_file.name)
+
+        members = find_roll_xmls(folder, 2024)
+        self.assertEqual([member.name for member in members], [self.xml_files[2].name])
+        self.assertTrue(all(isinstance(member, ZipMember) for member in members))
+        # The extracted XMLs are only read without the year's archive
+        self.assertEqual(find_roll_xmls(folder, 2023), sorted(self.xml_files))
+        self.assertEqual(find_roll_xmls(folder, 2023, extracted=False), [])
+
+    def test_schema_columns_are_evalunit_columns(self):
+        columns = {field.column for field in EvalUnit._meta.concrete_fields}
+        self.assertEqual(set(UNIT_COLUMN_NAMES) - columns, set())
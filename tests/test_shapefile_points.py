@@ -0,0 +1,50 @@
+import struct
+import tempfile
+import unittest
+import importlib.util
+from pathlib import Path
+
+import shapefile
+from django.test import SimpleTestCase
+from buildings.utils.shapefile_points import read_points
+from buildings.management.commands.process_roll_shp import read_coords_pyshp
+
+
+@unittest.skipUnless(importlib.util.find_spec('numpy'), "numpy isn't installed")
+class ShapefilePointsTestCase(SimpleTestCase):
+
+    def setUp(self):
+        tmp_folder = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_folder.cleanup)
+        self.shp = Path(tmp_folder.name) / 'points.shp'
+
+        with shapefile.Writer(str(self.shp.with_suffix('')), shapeType=shapefile.POINT) as writer:
+            writer.field('ID', 'C', 23)
+            writer.field('VALUE', 'N', 10)
+            for i, (lng, lat) in enumerate([(-73.5, 45.5), (2.35, 48.85), (-71.2, 46.8)]):
+                writer.point(lng, lat)
+                writer.record(f'id{i}', i)
+
+    def test_read_points(self):
+        ids, lng, lat, num_outside = read_points(self.shp)
+        # The second point is in Paris
+        self.assertEqual(num_outside, 1)
+        self.assertEqual(ids.tolist(), [b'id0', b'id2'])
+        self.assertEqual(lng.tolist(), [-73.5, -71.2])
+        self.assertEqual(lat.tolist(), [45.5, 46.8])
+
+    def test_read_points_by_column_name(self):
+        values, _, _, _ = read_points(self.shp, id_column='VALUE')
+        self.assertEqual(values.tolist(), [b'0', b'2'])
+
+    def test_pyshp_reader_agrees(self):
+        # Mark the first record deleted
+        with open(self.shp.with_suffix('.dbf'), 'r+b') as f:
+            header_size, = struct.unpack('<H', f.read(10)[8:10])
+            f.seek(header_size)
+            f.write(b'*')
+
+        ids, lng, lat, _ = read_points(self.shp)
+        coords = list(read_coords_pyshp(self.shp))
+        self.assertEqual(coords, list(zip(ids.astype(str).tolist(), lng.tolist(), lat.tolist())))
+        self.assertEqual(coords, [('id2', -71.2, 46.8)])
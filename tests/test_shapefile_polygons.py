@@ -0,0 +1,29 @@
+import struct
+
+import shapefile
+from django.test import SimpleTestCase
+from buildings.utils.shapefile_polygons import shape_ewkb, web_mercator_to_wgs84
+
+
+class ShapefilePolygonsTestCase(SimpleTestCase):
+
+    def test_web_mercator_to_wgs84(self):
+        # Origin, and New York City
+        (lng0, lat0), (lng, lat) = web_mercator_to_wgs84([(0.0, 0.0), (-8238310.24, 4970071.58)])
+        self.assertEqual((lng0, lat0), (0.0, 0.0))
+        self.assertAlmostEqual(lng, -74.0060, places=4)
+        self.assertAlmostEqual(lat, 40.7128, places=4)
+
+    def test_shape_ewkb(self):
+        outer = [(0, 0), (0, 10), (10, 10), (10, 0), (0, 0)]
+        hole = [(2, 2), (4, 2), (4, 4), (2, 4), (2, 2)]
+        other = [(20, 0), (20, 10), (30, 10), (30, 0), (20, 0)]
+        shape = shapefile.Shape(shapeType=shapefile.POLYGON, points=outer + hole + other, parts=[0, 5, 10])
+
+        ewkb = bytes.fromhex(shape_ewkb(shape, transform=list, srid=3857))
+        # Multipolygon with an SRID, of 2 polygons, the first with 2 rings of 5 points
+        self.assertEqual(struct.unpack_from('<BIII', ewkb), (1, 0x20000006, 3857, 2))
+        self.assertEqual(struct.unpack_from('<BIII', ewkb, 13), (1, 3, 2, 5))
+        self.assertEqual(struct.unpack_from('<2d', ewkb, 26), (0.0, 0.0))
+
+        self.assertIsNone(shape_ewkb(shapefile.Shape(shapeType=shapefile.NULL)))
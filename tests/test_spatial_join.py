@@ -0,0 +1,21 @@
+import unittest
+import importlib.util
+
+from django.test import SimpleTestCase
+from buildings.utils.spatial_join import polygons_bounds, points_in_polygons
+
+
+@unittest.skipUnless(importlib.util.find_spec('shapely'), "shapely isn't installed")
+class SpatialJoinTestCase(SimpleTestCase):
+
+    def test_points_in_polygons(self):
+        import shapely
+        squares = [shapely.box(0, 0, 2, 2), shapely.box(1, 1, 3, 3)]
+        polygons, bounds = polygons_bounds(shapely.to_wkb(squares))
+        self.assertEqual(bounds, (0.0, 0.0, 3.0, 3.0))
+
+        # In the first square, in both, on the boundary of the second, outside
+        xs, ys = [0.5, 1.5, 3.0, 5.0], [0.5, 1.5, 2.0, 5.0]
+        polygon_indices, point_indices = points_in_polygons(polygons, xs, ys)
+        pairs = sorted(zip(polygon_indices.tolist(), point_indices.tolist()))
+        self.assertEqual(pairs, [(0, 0), (0, 1), (1, 1), (1, 2)])
@@ -1,7 +1,9 @@
+from datetime import timedelta
 from django.test import TestCase
+from django.utils import timezone
 from django.forms.models import model_to_dict
 from buildings.models import SurveyV1Form, User, EvalUnit
-from buildings.models.models import Vote
+from buildings.models.models import SurveyLease, SurveyQueueEntry, Vote
 
 
 class MyTests(TestCase):
@@ -78,3 +80,27 @@ class MyTests(TestCase):
             "roof_geometry": ['flat'],
             "new_or_renovated": ['recently_renovated'],   
         })
+
+    def test_survey_page_query_count(self):
+        self.client.login(username='testuser', password='testpw')
+        SurveyQueueEntry.objects.create(eval_unit=self.eval_unit)
+        SurveyQueueEntry.objects.create(eval_unit=self.eval_unit2)
+        lease_next = lambda: SurveyLease.objects.update_or_create(
+            eval_unit=self.eval_unit2, defaults={'user': self.user, 'date_expires': timezone.now() + timedelta(minutes=5)}
+        )
+        lease_next()
+
+        # Session, user, then a single query for the unit and everything shown with it
+        with self.assertNumQueries(3):
+            response = self.client.get("/survey/v1/id1")
+        self.assertEqual(response.context['next_eval_unit_id'], 'id2')
+        self.assertFalse(response.context['form'].was_filled)
+
+        self.client.post("/survey/v1/id1", data=self.form_data)
+        lease_next()
+
+        # Same count once the unit has a previous survey to fill the form with
+        with self.assertNumQueries(3):
+            response = self.client.get("/survey/v1/id1")
+        self.assertTrue(response.context['form'].was_filled)
+        self.assertEqual(response.context['next_eval_unit_id'], 'id2')
@@ -1,6 +1,10 @@
 import code
+import tempfile
+from pathlib import Path
 from http import HTTPStatus
-from django.test import TestCase, Client
+from django.test import TestCase, Client, override_settings
+from django.contrib.gis.geos import Point
+from buildings.utils.tiles import tile_path
 from buildings.models.models import User, EvalUnit
 
 
@@ -60,4 +64,110 @@ class SurveyViewTests(TestCase):
         response = self.client.get("/survey/v1/id1", follow=True)
         self.assertEqual(response.status_code, HTTPStatus.OK)
         self.assertListEqual(response.redirect_chain, [])
-        self.assertEqual(response.context['eval_unit'], self.eval_unit)
\ No newline at end of file
+        self.assertEqual(response.context['eval_unit'], self.eval_unit)
+
+
+class TileViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='testuser', password='testpw')
+        cls.eval_unit = EvalUnit.objects.create(id='id1', lat=45.5017, lng=-73.5673, point=Point(-73.5673, 45.5017, srid=4326), muni='mtl', year=2005, address='123 a st', mat18='fsd', cubf=1000, associated={'hlm': ['hlm1']})
+        cls.client = Client()
+
+    def setUp(self):
+        # Each test caches its tiles in a folder of its own, removed after it
+        tmp_folder = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_folder.cleanup)
+        tile_cache = override_settings(TILE_CACHE_DIR=Path(tmp_folder.name))
+        tile_cache.enable()
+        self.addCleanup(tile_cache.disable)
+
+    def test_out_of_range_tile(self):
+        self.client.login(username='testuser', password='testpw')
+        response = self.client.get("/tiles/14/16384/0.mvt")
+        self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND)
+
+    def test_tile_is_cached_and_revalidated(self):
+        self.client.login(username='testuser', password='testpw')
+        response = self.client.get("/tiles/14/4843/5861.mvt")
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(response['Content-Type'], 'application/vnd.mapbox-vector-tile')
+        self.assertGreater(len(response.content), 0)
+        self.assertTrue(tile_path(14, 4843, 5861).exists())
+
+        response = self.client.get("/tiles/14/4843/5861.mvt", HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, HTTPStatus.NOT_MODIFIED)
+
+
+class AllBuildingsViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='testuser', password='testpw')
+        for i in range(30):
+            EvalUnit.objects.create(id=f'id{i:02}', lat=1.0, lng=1.5, muni='mtl', year=2005, address=f'{i % 10} a st', mat18='fsd', cubf=1000, associated={'hlm': ['hlm1']})
+        cls.client = Client()
+
+    def _ids(self, response):
+        return [unit.id for unit in response.context['page_obj']]
+
+    def test_keyset_pagination(self):
+        self.client.login(username='testuser', password='testpw')
+        # Addresses repeat, so the ids break the ties
+        expected = [u.id for u in EvalUnit.objects.order_by('address', 'id')]
+
+        response = self.client.get("/all_buildings?order_by=address&dir=asc")
+        page_obj = response.context['page_obj']
+        self.assertListEqual(self._ids(response), expected[:25])
+        self.assertFalse(page_obj.has_previous())
+        self.assertEqual(page_obj.paginator.count, 30)
+        self.assertFalse(page_obj.paginator.count_is_estimate)
+
+        response = self.client.get(f"/all_buildings?order_by=address&dir=asc&after={page_obj.next_cursor}")
+        page_obj = response.context['page_obj']
+        self.assertListEqual(self._ids(response), expected[25:])
+        self.assertFalse(page_obj.has_next())
+
+        response = self.client.get(f"/all_buildings?order_by=address&dir=asc&before={page_obj.previous_cursor}")
+        self.assertListEqual(self._ids(response), expected[:25])
+
+        response = self.client.get("/all_buildings?order_by=address&dir=asc&last")
+        self.assertListEqual(self._ids(response), expected[5:])
+        self.assertTrue(response.context['page_obj'].has_previous())
+
+    def test_search_without_results(self):
+        self.client.login(username='testuser', password='testpw')
+        # No CUBF name or code matches
+        response = self.client.get("/all_buildings?q_cubf=zzz")
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertListEqual(self._ids(response), [])
+        self.assertEqual(response.context['page_obj'].paginator.count, 0)
+
+    def test_unsortable_fields_order_by_address(self):
+        self.client.login(username='testuser', password='testpw')
+        expected = [u.id for u in EvalUnit.objects.order_by('-address', '-id')][:25]
+        # Not scalar, their values can't be put in a cursor
+        for field in ('lot', 'point'):
+            response = self.client.get(f"/all_buildings?order_by={field}")
+            self.assertEqual(response.status_code, HTTPStatus.OK)
+            self.assertListEqual(self._ids(response), expected)
+            self.assertIsNotNone(response.context['page_obj'].next_cursor)
+
+
+class ProfilingMiddlewareTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='testuser', password='testpw')
+
+    @override_settings(REQUEST_PROFILING=True)
+    def test_server_timing_header(self):
+        # The middleware is loaded by the first request of a new client
+        client = Client()
+        client.login(username='testuser', password='testpw')
+        with self.assertLogs('buildings.profiling', level='INFO') as logs:
+            response = client.get("/all_buildings")
+        self.assertRegex(response['Server-Timing'], r'sql;dur=[\d.]+;desc="\d+ queries"')
+        self.assertIn('"url_name": "buildings:all_buildings"', logs.output[0])
+
+    def test_disabled_by_default(self):
+        response = Client().get("/login")
+        self.assertNotIn('Server-Timing', response)